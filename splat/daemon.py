@@ -38,30 +38,343 @@
 
 import splat
 from splat import plugin
+from splat.ldaputils import client as ldapclient
+from splat.ldaputils import filter as ldapfilter
 
-from twisted.internet import reactor, task, defer
+from twisted.internet import reactor, task, defer, threads
+from twisted.python import failure
 
-import ldap, logging
+import ldap, logging, os, random, socket, base64
+
+try:
+    from hashlib import md5
+except ImportError:
+    # Python 2.4
+    from md5 import new as md5
+
+# Change sources. Services are always polled at their configured
+# frequency; additional change sources deliver modified entries
+# to the service between polls.
+CHANGE_SOURCE_POLL = 'poll'
+CHANGE_SOURCE_SYNCREPL = 'syncrepl'
+CHANGE_SOURCE_CHANGELOG = 'changelog'
+CHANGE_SOURCES = (CHANGE_SOURCE_POLL, CHANGE_SOURCE_SYNCREPL, CHANGE_SOURCE_CHANGELOG)
+
+# LDAP errors indicating that the connection to the server has failed,
+# requiring the daemon context to be restarted. Any other helper failure
+# only affects the failing service.
+CONNECTION_ERRORS = ldapclient.CONNECTION_ERRORS
+
+def readStateFile(path):
+    """
+    Return the contents of a state file written by writeStateFile(),
+    or None if the file does not exist.
+    @param path: State file path
+    """
+    if (not os.path.exists(path)):
+        return None
+    f = open(path, 'r')
+    try:
+        return f.read().strip()
+    finally:
+        f.close()
+
+def writeStateFile(path, value):
+    """
+    Atomically replace the contents of a state file.
+    @param path: State file path
+    @param value: String to write
+    """
+    tmpPath = path + '.tmp'
+    f = open(tmpPath, 'w')
+    try:
+        f.write(value + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmpPath, path)
+
+def phaseOffset(name, interval, hostname=None):
+    """
+    Return a deterministic offset, in seconds, within the given interval
+    for the named timer on this host. Different hosts running the same
+    timers are spread evenly across the interval.
+    @param name: Timer name; eg, the service name
+    @param interval: Interval in seconds
+    @param hostname: Host name. Defaults to the local host name.
+    """
+    if (not interval):
+        return 0
+    if (hostname == None):
+        hostname = socket.gethostname()
+    digest = md5('%s/%s' % (hostname, name)).hexdigest()
+    return (int(digest[:8], 16) % int(interval * 1000)) / 1000.0
+
+class ServiceTimer(object):
+    """
+    Periodically invoke a helper run, measuring the duration of each run.
+    Unlike a LoopingCall, runs that overrun their interval are logged
+    and counted, the ticks they missed are coalesced into a single run,
+    and a minimum idle period is always left between runs. In adaptive
+    mode, the interval is stretched while runs take up much of it, and
+    shrunk back towards the configured interval when they are cheap.
+    """
+    # Scheduling clock. Replaced by tests.
+    clock = reactor
+
+    # Adaptive mode: stretch the interval while runs take more than this
+    # fraction of it, and shrink it while they take less than shrinkLoad.
+    stretchLoad = 0.5
+    shrinkLoad = 0.1
+    # Maximum multiple of the configured interval
+    maxStretch = 8
+
+    def __init__(self, name, f, interval, minIdle=0, adaptive=False, phase=None, jitter=0):
+        """
+        Initialize a new service timer.
+        @param name: Service name, used for logging.
+        @param f: Callable to invoke. May return a Deferred, in which case the run is complete when it fires.
+        @param interval: Run interval in seconds. An interval of '0' will cause f to be run only once.
+        @param minIdle: Minimum time, in seconds, between the end of a run and the start of the next. Defaults to 0.
+        @param adaptive: Adapt the interval to the duration of recent runs. Defaults to False.
+        @param phase: If set, runs are aligned to the wall clock, occurring this many seconds after each multiple of the interval since the epoch. Defaults to None, in which case runs are aligned to when the timer was started.
+        @param jitter: Delay each run by a random time of up to this many seconds, without affecting the schedule of later runs. Defaults to 0.
+        """
+        self.name = name
+        self.f = f
+        self.baseInterval = interval
+        self.interval = interval
+        self.minIdle = minIdle
+        self.adaptive = adaptive
+        self.phase = phase
+        self.jitter = jitter
+        self.running = False
+        self._call = None
+
+        # Run statistics
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.lastDuration = 0
+        self.maxDuration = 0
+
+    def start(self, now=True):
+        """
+        Start invoking the callable.
+        @param now: If True, run immediately, rather than after the first interval.
+        """
+        self.running = True
+        current = self.clock.seconds()
+        self._scheduled = current
+        if (now):
+            self._call = self.clock.callLater(0, self._run)
+            return
+
+        if (self.phase != None and self.interval):
+            # The first tick matching our phase
+            self._scheduled = current - ((current - self.phase) % self.interval) + self.interval
+        else:
+            self._scheduled = current + self.interval
+        self._schedule(current)
+
+    def _schedule(self, current):
+        delay = self._scheduled - current
+        if (self.jitter):
+            delay = delay + random.uniform(0, self.jitter)
+        self._call = self.clock.callLater(delay, self._run)
+
+    def stop(self):
+        """
+        Stop invoking the callable. A run in progress is allowed to complete.
+        """
+        self.running = False
+        if (self._call != None and self._call.active()):
+            self._call.cancel()
+        self._call = None
+
+    def _run(self):
+        self._call = None
+        started = self.clock.seconds()
+        d = defer.maybeDeferred(self.f)
+        d.addCallbacks(self._cbRun, self._ebRun, callbackArgs=(started,))
+        return d
+
+    def _ebRun(self, failure):
+        # Unhandled run failures stop the timer
+        self.running = False
+        return failure
+
+    def _cbRun(self, result, started):
+        logger = logging.getLogger(splat.LOG_NAME)
+        now = self.clock.seconds()
+        duration = now - started
+        self.runs = self.runs + 1
+        self.lastDuration = duration
+        self.maxDuration = max(self.maxDuration, duration)
+
+        if (not self.running):
+            return
+
+        # Run once
+        if (self.baseInterval == 0):
+            self.running = False
+            return
+
+        if (self.adaptive):
+            self._adapt(duration)
+
+        # Coalesce any ticks missed during the run into a single run, at
+        # the next tick that leaves at least minIdle seconds to spare
+        nextRun = self._scheduled + self.interval
+        missed = 0
+        while (nextRun < now + self.minIdle):
+            nextRun = nextRun + self.interval
+            missed = missed + 1
+
+        if (duration > self.interval):
+            self.overruns = self.overruns + 1
+            logger.warning("Run of service %s took %.1f seconds, overrunning its interval of %d seconds" % (self.name, duration, self.interval))
+        if (missed > 0):
+            self.skipped = self.skipped + missed
+            logger.info("Skipped %d runs of service %s" % (missed, self.name))
+
+        self._scheduled = nextRun
+        self._schedule(now)
+
+    def _adapt(self, duration):
+        logger = logging.getLogger(splat.LOG_NAME)
+        interval = self.interval
+        if (duration > self.interval * self.stretchLoad):
+            interval = min(self.interval * 2, self.baseInterval * self.maxStretch)
+        elif (duration < self.interval * self.shrinkLoad):
+            interval = max(self.interval / 2, self.baseInterval)
+
+        if (interval != self.interval):
+            logger.info("Adjusting interval of service %s from %d to %d seconds" % (self.name, self.interval, interval))
+            self.interval = interval
 
 class Context(object):
+    # Interval, in seconds, at which content synchronization searches are polled
+    syncInterval = 1
+
+    # Initial time, in seconds, for which a failed service is not run.
+    # The delay is doubled with each successive failure.
+    initialBackoff = 10
+    # Maximum time for which a failed service is not run (5 minutes)
+    maxBackoff = 300
+
+    # Backoff clock. Replaced by tests.
+    clock = reactor
+
     # Splat Daemon Context
-    def __init__(self, ldapConnection):
+    def __init__(self, ldapConnection, groupCacheTTL=0, sharedSearchTTL=60, workers=0, stagger=False, jitter=0, stateDir=None):
         """
         Initialize a Splat Daemon context
-        @param ldapConnection: A connected instance of ldaputils.client.Connection
+        @param ldapConnection: A connected instance of ldaputils.client.Connection or ldaputils.client.ConnectionPool
+        @param groupCacheTTL: Time, in seconds, for which group memberships fetched by one helper are re-used by all helpers. Defaults to 0, which disables sharing.
+        @param sharedSearchTTL: Time, in seconds, for which search snapshots are shared between helpers with sharedSearch enabled. Defaults to 60.
+        @param workers: Number of threads in which helpers are run, allowing independent helpers to run in parallel. Helpers share the LDAP connection, which handles one request at a time, so only helpers spending their time outside LDAP run faster. Defaults to 0, in which case helpers are run in the reactor thread.
+        @param stagger: Run each helper at a fixed offset within its interval, derived from the host and helper names, so that hosts sharing a configuration do not run in lockstep. Defaults to False.
+        @param jitter: Delay each helper run by a random time of up to this many seconds. Defaults to 0.
+        @param stateDir: Directory in which the progress of each helper is saved, so that a restarted daemon does not consider every entry modified. Defaults to None, in which case progress is not saved.
         """
         self.svc = {}
         self.tasks = {}
+        self.changeSources = {}
+        self.syncConsumers = {}
+        # Synchronization cookies of stopped consumers, keyed by helper name
+        self.syncCookies = {}
+        # Synchronization cookies as of which every entry sent by the
+        # server has been handled, keyed by helper name
+        self.handledCookies = {}
+        self.syncTask = None
+        self.changeLog = None
+        self.changeLogConfig = None
+        self.changeLogTask = None
+        self.healthTask = None
         self.stopping = False
         self.failure = None
+        self.workers = workers
+        self.stagger = stagger
+        self.jitter = jitter
+        # Pending helper invocations, in order, keyed by helper name
+        self.queues = {}
+        # Running cooperative tasks
+        self.cooperativeTasks = []
         self.ldapConnection = ldapConnection
+        self.groupCache = ldapclient.GroupCache(groupCacheTTL)
+        self.sharedSearchTTL = sharedSearchTTL
+        # Shared search snapshots, keyed by normalized search base
+        self.snapshots = {}
+        self.stateDir = stateDir
+        # Last saved helper checkpoints, keyed by helper name
+        self.checkpoints = {}
+        # Number of successive failures, and the time until which the
+        # service is not run, keyed by the names of failed helpers
+        self.backoffs = {}
+        # Pending runs of failed helpers, scheduled for when their backoff
+        # expires, keyed by helper name
+        self.retryCalls = {}
 
-    def addHelper(self, controller):
+    def addHelper(self, controller, changeSource=CHANGE_SOURCE_POLL):
         """
         Add a helper controller to the daemon context
         @param controller: HelperController
+        @param changeSource: Additional source of modified entries. One of CHANGE_SOURCES. Defaults to CHANGE_SOURCE_POLL.
         """
+        if (changeSource not in CHANGE_SOURCES):
+            raise splat.SplatError, "Unknown change source '%s' for helper %s" % (changeSource, controller.name)
+
+        # Shards are forked, which is only safe from the reactor thread
+        if (controller.shards > 1 and self.workers > 0):
+            raise splat.SplatError, "Helper %s can not be sharded when run in worker threads" % controller.name
+        if (controller.shards > 1 and self.ldapConnection.nonBlocking):
+            raise splat.SplatError, "Helper %s can not be sharded when using a non-blocking LDAP connection" % controller.name
+
+        # Share a single search snapshot between all helpers searching
+        # the same base
+        if (controller.sharedSearch):
+            key = ldapclient.normalizeDN(controller.searchBase)
+            if (not self.snapshots.has_key(key)):
+                self.snapshots[key] = ldapclient.SearchSnapshot(controller.searchBase, ldap.SCOPE_SUBTREE, self.sharedSearchTTL)
+            try:
+                controller.setSearchSnapshot(self.snapshots[key])
+            except ldapfilter.LDAPUtilsFilterError, e:
+                raise splat.SplatError, "Search filter for helper %s can not be shared: %s" % (controller.name, e)
+
+        # Resume from the helper's saved progress
+        if (self.stateDir != None):
+            self._loadCheckpoint(controller)
+
         self.svc[controller.name] = controller
+        self.changeSources[controller.name] = changeSource
+
+        # Share group memberships between all helpers
+        controller.groupCache = self.groupCache
+
+    def setChangeLog(self, baseDN, format, stateFile, interval):
+        """
+        Configure the server-side change log read on behalf of helpers
+        added with CHANGE_SOURCE_CHANGELOG. Entries named by the change log
+        are re-fetched and dispatched to every interested helper.
+        @param baseDN: Change log suffix; eg, cn=accesslog
+        @param format: One of ldaputils.client.CHANGELOG_FORMATS
+        @param stateFile: Path of the file used to persist the change log position across restarts.
+        @param interval: Interval, in seconds, at which the change log is read.
+        """
+        self.changeLogConfig = (baseDN, format, stateFile, interval)
+
+    def setConnection(self, ldapConnection):
+        """
+        Replace the context's LDAP connection; eg, after reconnecting to
+        the server following a failure. Helper controllers, their state,
+        and any shared caches are preserved. The context must be stopped.
+        @param ldapConnection: A connected instance of ldaputils.client.Connection
+        """
+        if (len(self.tasks) > 0):
+            raise splat.SplatError, "The connection of a running daemon context can not be replaced"
+        self.ldapConnection = ldapConnection
 
     def removeHelper(self, name):
         """
@@ -73,8 +386,18 @@ class Context(object):
             self.tasks[name].stop()
             self.tasks.pop(name)
 
+        # Abandon any content synchronization search
+        if (self.syncConsumers.has_key(name)):
+            self.syncConsumers.pop(name).stop()
+        self.syncCookies.pop(name, None)
+        self.handledCookies.pop(name, None)
+        self.checkpoints.pop(name, None)
+        self.backoffs.pop(name, None)
+        self._cancelRetry(name)
+
         # Delete the controller entry
         self.svc.pop(name)
+        self.changeSources.pop(name)
 
     def _invokeHelper(self, name):
         # Has helper been removed?
@@ -85,16 +408,405 @@ class Context(object):
         if (self.stopping):
             return
 
+        # Has the helper recently failed?
+        if (self._isBackingOff(name)):
+            return
+
         ctrl = self.svc[name]
+        if (self._isCooperative(ctrl)):
+            d = self._dispatch(name, False, self._cooperate, ctrl.workIter(self.ldapConnection))
+        else:
+            d = self._dispatch(name, self.workers > 0, ctrl.work, self.ldapConnection)
+        # The helper's task is not re-scheduled until the run completes
+        d.addCallback(self._cbInvokeHelper, name)
+        d.addErrback(self._ebHelper, name)
+        return d
+
+    def _cbInvokeHelper(self, result, name):
+        # The service has recovered
+        if (self.backoffs.has_key(name)):
+            logger = logging.getLogger(splat.LOG_NAME)
+            logger.info("Service %s has recovered" % name)
+            self.backoffs.pop(name)
+
+        # Save the helper's progress
+        if (self.stateDir != None and self.svc.has_key(name)):
+            self._saveCheckpoint(self.svc[name])
+        return result
+
+    def _isBackingOff(self, name):
+        """
+        Returns True if the named service has failed, and should not yet
+        be run again.
+        """
+        if (not self.backoffs.has_key(name)):
+            return False
+        failures, until = self.backoffs[name]
+        return (self.clock.seconds() < until)
+
+    def _stateFile(self, name):
+        return os.path.join(self.stateDir, '%s.state' % name)
+
+    def _loadCheckpoint(self, ctrl):
+        """
+        Restore the helper controller's progress from its state file, if any.
+        """
+        logger = logging.getLogger(splat.LOG_NAME)
         try:
-            ctrl.work(self.ldapConnection)
-        except Exception, e:
-            # Stop the presses
-            self._stopAllTasks()
-            # Propigate helper errors
-            self.failure = e
-            self._checkStop()
+            value = readStateFile(self._stateFile(ctrl.name))
+        except (IOError, OSError), e:
+            raise splat.SplatError, "Unable to read the state file of helper %s: %s" % (ctrl.name, e)
+        if (value == None):
+            return
+
+        # The synchronization cookie is only present for helpers using
+        # content synchronization
+        fields = value.split()
+        cookie = None
+        try:
+            if (len(fields) == 4):
+                cookie = base64.b64decode(fields.pop())
+            configHash, lastRun, lastFullRun = fields
+            checkpoint = (configHash, int(lastRun), int(lastFullRun))
+        except (ValueError, TypeError):
+            logger.warning("Ignoring invalid state file for helper %s" % ctrl.name)
+            return
+
+        if (ctrl.restoreCheckpoint(checkpoint)):
+            self.checkpoints[ctrl.name] = checkpoint + (cookie,)
+            # Resume content synchronization from the saved cookie, rather
+            # than refreshing, and considering modified, every entry
+            if (cookie != None):
+                self.syncCookies[ctrl.name] = cookie
+                self.handledCookies[ctrl.name] = cookie
+        else:
+            logger.info("Configuration of helper %s has changed, all entries will be considered modified" % ctrl.name)
+
+    def _saveCheckpoint(self, ctrl):
+        """
+        Write the helper controller's progress to its state file, if it
+        has changed since it was last saved.
+        """
+        cookie = self.handledCookies.get(ctrl.name)
+        checkpoint = ctrl.getCheckpoint() + (cookie,)
+        if (self.checkpoints.get(ctrl.name) == checkpoint):
             return
+        value = '%s %d %d' % checkpoint[:3]
+        if (cookie != None):
+            value = '%s %s' % (value, base64.b64encode(cookie))
+        try:
+            writeStateFile(self._stateFile(ctrl.name), value)
+        except (IOError, OSError), e:
+            # Retried after the next run
+            logger = logging.getLogger(splat.LOG_NAME)
+            logger.error("Unable to write the state file of helper %s: %s" % (ctrl.name, e))
+            return
+        self.checkpoints[ctrl.name] = checkpoint
+
+    def _dispatch(self, name, threaded, f, *args):
+        """
+        Invoke a helper controller method once any previously dispatched
+        invocations for the same helper have completed, so that a helper
+        is never run concurrently with itself.
+        @param name: Helper name
+        @param threaded: If True, f is invoked in the thread pool, otherwise in the reactor thread.
+        @param f: Callable to invoke
+        @return A deferred whose callback is invoked with the result of
+        f, or whose errback is invoked with any exception raised by f.
+        """
+        d = defer.Deferred()
+        queue = self.queues.setdefault(name, [])
+        queue.append((f, args, threaded, d))
+        if (len(queue) == 1):
+            self._runNext(name)
+        return d
+
+    def _isCooperative(self, ctrl):
+        """
+        Returns True if the helper controller's entries should be processed
+        in chunks, yielding to the reactor between each chunk.
+        Asynchronous helpers, and all helpers using a non-blocking LDAP
+        connection, are always run cooperatively.
+        """
+        return (ctrl.asynchronous or self.ldapConnection.nonBlocking or (ctrl.chunkSize > 0 and self.workers == 0))
+
+    def _isThreadedPoll(self):
+        """
+        Returns True if change sources should be read in the thread pool.
+        Helpers run in worker threads hold the blocking LDAP connection's
+        lock for the duration of each request, and reading from the
+        connection in the reactor thread would stall the reactor until
+        they release it.
+        """
+        return (self.workers > 0 and not self.ldapConnection.nonBlocking)
+
+    def _cooperate(self, iterator):
+        """
+        Run a helper iterator cooperatively with the reactor.
+        @return A deferred whose callback is invoked when the iterator is exhausted.
+        """
+        t = task.cooperate(iterator)
+        self.cooperativeTasks.append(t)
+        d = t.whenDone()
+        d.addBoth(self._cbCooperate, t)
+        return d
+
+    def _cbCooperate(self, result, t):
+        self.cooperativeTasks.remove(t)
+        return result
+
+    def _runNext(self, name):
+        f, args, threaded, d = self.queues[name][0]
+        if (self.stopping):
+            # Skip remaining invocations. Any entries sent by a content
+            # synchronization search would be lost, so the next search
+            # must start afresh.
+            self.syncCookies.pop(name, None)
+            result = defer.succeed(None)
+        elif (threaded):
+            result = threads.deferToThread(f, *args)
+        else:
+            result = defer.maybeDeferred(f, *args)
+        result.addBoth(self._cbDispatch, name)
+
+    def _cbDispatch(self, result, name):
+        queue = self.queues[name]
+        f, args, threaded, d = queue.pop(0)
+        if (len(queue) > 0):
+            self._runNext(name)
+
+        if (isinstance(result, failure.Failure)):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def _ebHelper(self, failure, name):
+        """
+        Handle helper invocation failures. LDAP connection failures stop
+        the daemon context; any other failure only causes the failing
+        service to back off.
+        """
+        # Cooperative tasks are stopped on shutdown
+        if (failure.check(task.TaskStopped)):
+            return
+
+        if (failure.check(*CONNECTION_ERRORS)):
+            self._fail(failure.value)
+        else:
+            self._serviceFailed(name, failure)
+
+    def _serviceFailed(self, name, failure):
+        """
+        Stop running the named service for a time that doubles with each
+        successive failure. Other services are unaffected.
+        """
+        logger = logging.getLogger(splat.LOG_NAME)
+        failures, until = self.backoffs.get(name, (0, 0))
+        failures = failures + 1
+        delay = min(self.initialBackoff * 2 ** (failures - 1), self.maxBackoff)
+        self.backoffs[name] = (failures, self.clock.seconds() + delay)
+        logger.error("Service %s failed, and will not be run for %d seconds: %s" % (name, delay, failure.getErrorMessage()))
+
+        # Run the service as soon as the backoff expires, rather than at
+        # its next scheduled run
+        self._cancelRetry(name)
+        self.retryCalls[name] = self.clock.callLater(delay, self._retryService, name)
+
+    def _retryService(self, name):
+        del self.retryCalls[name]
+        self._invokeHelper(name)
+
+    def _cancelRetry(self, name):
+        if (self.retryCalls.has_key(name)):
+            call = self.retryCalls.pop(name)
+            if (call.active()):
+                call.cancel()
+
+    def _pollSync(self):
+        """
+        Dispatch entries reported by content synchronization searches to
+        their helper controllers.
+        """
+        for name, consumer in self.syncConsumers.items():
+            # Has helper been removed?
+            if (not self.svc.has_key(name)):
+                continue
+
+            # Are we shutting down?
+            if (self.stopping):
+                return
+
+            # Changes are left with the server until the helper recovers
+            if (self._isBackingOff(name)):
+                continue
+
+            if (self._isThreadedPoll()):
+                # Busy helpers are polled again at the next interval, once
+                # their running invocations complete
+                if (len(self.queues.get(name, [])) > 0):
+                    continue
+                d = self._dispatch(name, True, consumer.poll)
+            else:
+                d = defer.maybeDeferred(consumer.poll)
+            d.addCallbacks(self._dispatchSync, self._ebHelper, callbackArgs=(name, consumer), errbackArgs=(name,))
+
+    def _dispatchSync(self, entries, name, consumer):
+        """
+        Dispatch the entries read from a content synchronization search to
+        its helper controller.
+        """
+        # Has helper been removed, or are we shutting down?
+        if (self.syncConsumers.get(name) != consumer or self.stopping):
+            return
+
+        cookie = consumer.cookie
+        if (len(entries) > 0):
+            ctrl = self.svc[name]
+            if (self._isCooperative(ctrl)):
+                d = self._dispatch(name, False, self._cooperate, ctrl.workEntriesIter(self.ldapConnection, entries))
+            else:
+                d = self._dispatch(name, self.workers > 0, ctrl.workEntries, self.ldapConnection, entries)
+        elif (self.stateDir != None and cookie != self.handledCookies.get(name)):
+            # Record the new cookie once any entries already
+            # dispatched have been handled
+            d = self._dispatch(name, False, lambda: None)
+        else:
+            return
+        d.addCallback(self._cbPollSync, name, cookie)
+        d.addErrback(self._ebHelper, name)
+
+    def _cbPollSync(self, result, name, cookie):
+        # Entries skipped during shutdown have not been handled
+        if (self.stopping or not self.svc.has_key(name)):
+            return
+        self.handledCookies[name] = cookie
+        if (self.stateDir != None):
+            self._saveCheckpoint(self.svc[name])
+
+    def _pollChangeLog(self):
+        """
+        Re-fetch entries named by the change log, and dispatch them to
+        interested helper controllers.
+        """
+        position = self.changeLog.position
+        if (self.ldapConnection.nonBlocking):
+            d = self.changeLog.asyncPoll()
+        elif (self._isThreadedPoll()):
+            d = threads.deferToThread(self.changeLog.poll)
+        else:
+            d = defer.maybeDeferred(self.changeLog.poll)
+        d.addCallbacks(self._dispatchChangeLog, self._ebPollChangeLog, callbackArgs=(position,))
+        return d
+
+    def _ebPollChangeLog(self, failure):
+        if (failure.check(*CONNECTION_ERRORS)):
+            self._fail(failure.value)
+            return
+        # Read again at the next interval
+        logger = logging.getLogger(splat.LOG_NAME)
+        logger.error("Unable to read the change log: %s" % failure.getErrorMessage())
+
+    def _dispatchChangeLog(self, dns, position):
+        """
+        Dispatch the DNs read from the change log to interested helper
+        controllers.
+        """
+        baseDN, format, stateFile, interval = self.changeLogConfig
+        deferreds = []
+        for name, ctrl in self.svc.items():
+            if (self.changeSources[name] != CHANGE_SOURCE_CHANGELOG):
+                continue
+
+            # Changes missed by a failed service are picked up by its
+            # periodic runs
+            if (self._isBackingOff(name)):
+                continue
+
+            dispatchDNs = [dn for dn in dns if ldapclient.isDescendant(dn, ctrl.searchBase)]
+            if (len(dispatchDNs) > 0):
+                # Cooperative runs must be started from the reactor thread
+                threaded = (self.workers > 0 and not self._isCooperative(ctrl))
+                d = self._dispatch(name, threaded, self._workChangeLog, ctrl, dispatchDNs)
+                d.addErrback(self._ebHelper, name)
+                deferreds.append(d)
+
+        # Save our position once all changes have been dispatched, and wait
+        # to read the change log again until then
+        d = defer.DeferredList(deferreds)
+        d.addCallback(self._cbPollChangeLog, stateFile, position)
+        return d
+
+    def _workChangeLog(self, ctrl, dns):
+        """
+        Re-fetch the entries named by the change log, and pass them
+        to the helper controller.
+        """
+        searches = [(dn, ldap.SCOPE_BASE, ctrl.searchFilter, ctrl.searchAttr) for dn in dns]
+        if (self.ldapConnection.nonBlocking):
+            d = self.ldapConnection.asyncSearchMany(searches)
+            d.addCallback(self._workChangedEntries, ctrl)
+            return d
+        return self._workChangedEntries(self.ldapConnection.searchMany(searches), ctrl)
+
+    def _workChangedEntries(self, results, ctrl):
+        """
+        Pass the entries re-fetched by _workChangeLog() to the helper
+        controller.
+        """
+        entries = []
+        for result in results:
+            # None if deleted since it was logged
+            if (result != None):
+                entries.extend(result)
+
+        if (len(entries) > 0):
+            if (self._isCooperative(ctrl)):
+                return self._cooperate(ctrl.workEntriesIter(self.ldapConnection, entries))
+            ctrl.workEntries(self.ldapConnection, entries)
+
+    def _cbPollChangeLog(self, result, stateFile, position):
+        # Are we shutting down?
+        if (self.stopping or self.failure):
+            return
+
+        if (self.changeLog.position != position):
+            try:
+                writeStateFile(stateFile, self.changeLog.position)
+            except (IOError, OSError), e:
+                # Retried after the next read
+                logger = logging.getLogger(splat.LOG_NAME)
+                logger.error("Unable to write the change log state file: %s" % e)
+
+    def _checkHealth(self):
+        """
+        Probe the servers of our connection pool, and reconnect failed
+        servers. Probes may block, so are run in the thread pool, if any.
+        """
+        if (self.workers > 0):
+            d = threads.deferToThread(self.ldapConnection.checkHealth)
+        else:
+            d = defer.maybeDeferred(self.ldapConnection.checkHealth)
+        d.addErrback(self._ebCheckHealth)
+        return d
+
+    def _ebCheckHealth(self, failure):
+        logger = logging.getLogger(splat.LOG_NAME)
+        logger.error("LDAP server health check failed: %s" % failure.getErrorMessage())
+
+    def _fail(self, failure):
+        """
+        Stop all tasks and report the failure to our caller.
+        """
+        # Only the first failure is reported
+        if (self.failure != None):
+            return
+
+        # Stop the presses, skipping any pending helper invocations
+        self._stopAllTasks()
+        self.stopping = True
+        # Propigate helper errors
+        self.failure = failure
+        self._checkStop()
 
     def start(self):
         """
@@ -105,12 +817,53 @@ class Context(object):
         """
         self.deferResult = defer.Deferred()
         self.stopping = False
+        self.failure = None
+
+        if (self.workers > 0):
+            reactor.suggestThreadPoolSize(self.workers)
 
         for name, ctrl in self.svc.items():
-            t = task.LoopingCall(self._invokeHelper, name)
-            t.start(ctrl.interval, False)
+            phase = None
+            if (self.stagger):
+                phase = phaseOffset(name, ctrl.interval)
+            t = ServiceTimer(name, lambda name=name: self._invokeHelper(name), ctrl.interval, ctrl.minIdle, ctrl.adaptive, phase, self.jitter)
+            t.start(False)
             self.tasks[name] = t
 
+            # Open content synchronization searches. Entries sent by the
+            # server are dispatched as they arrive, in addition to the
+            # periodic run.
+            if (self.changeSources[name] == CHANGE_SOURCE_SYNCREPL):
+                try:
+                    # Resume from where the previous search left off
+                    consumer = ldapclient.SyncReplConsumer(self.ldapConnection, ctrl.searchBase, ldap.SCOPE_SUBTREE, ctrl.searchFilter, ctrl.searchAttr, self.syncCookies.get(name))
+                    consumer.start()
+                except Exception, e:
+                    self._fail(e)
+                    return self.deferResult
+                self.syncConsumers[name] = consumer
+
+        if (len(self.syncConsumers) > 0):
+            self.syncTask = task.LoopingCall(self._pollSync)
+            self.syncTask.start(self.syncInterval, False)
+
+        # Start reading the change log, resuming from the saved position
+        if (self.changeLogConfig != None and CHANGE_SOURCE_CHANGELOG in self.changeSources.values()):
+            baseDN, format, stateFile, interval = self.changeLogConfig
+            try:
+                self.changeLog = ldapclient.ChangeLogConsumer(self.ldapConnection, baseDN, format, readStateFile(stateFile))
+                writeStateFile(stateFile, self.changeLog.position)
+            except Exception, e:
+                self._fail(e)
+                return self.deferResult
+            self.changeLogTask = task.LoopingCall(self._pollChangeLog)
+            self.changeLogTask.start(interval, False)
+
+        # Periodically probe pooled LDAP servers
+        if (isinstance(self.ldapConnection, ldapclient.ConnectionPool)):
+            self.healthTask = task.LoopingCall(self._checkHealth)
+            self.healthTask.start(self.ldapConnection.checkInterval, False)
+
         # Provide the caller our deferred result
         return self.deferResult
 
@@ -123,15 +876,55 @@ class Context(object):
             task = self.tasks.pop(key)
             task.stop()
 
+        # Cancel the runs of failed services
+        for key in self.retryCalls.keys():
+            self._cancelRetry(key)
+
+        # Stop polling for synchronization updates
+        if (self.syncTask != None):
+            self.syncTask.stop()
+            self.syncTask = None
+
+        # Stop reading the change log
+        if (self.changeLogTask != None):
+            self.changeLogTask.stop()
+            self.changeLogTask = None
+
+        # Stop probing pooled LDAP servers
+        if (self.healthTask != None):
+            self.healthTask.stop()
+            self.healthTask = None
+
+        # Abandon any cooperative runs in progress
+        for t in self.cooperativeTasks[:]:
+            t.stop()
+
+        for key in self.syncConsumers.keys():
+            consumer = self.syncConsumers.pop(key)
+            self.syncCookies[key] = consumer.cookie
+            try:
+                consumer.stop()
+            except ldap.LDAPError:
+                # The connection may already be gone
+                pass
+
     def _checkStop(self):
         # Check if all tasks have completed
-        for name,task in self.tasks:
+        for name,task in self.tasks.items():
             if (task.running):
                 # Task is still running ...
                 reactor.callLater(0, self._checkStop)
                 return
 
+        # Wait for running helpers to complete
+        for queue in self.queues.values():
+            if (len(queue) > 0):
+                reactor.callLater(0.1, self._checkStop)
+                return
+
         # All tasks have been stopped
+        if (self.deferResult.called):
+            return
         if (self.failure):
             self.deferResult.errback(self.failure)
         else:
@@ -48,6 +48,9 @@ class WriterContext(object):
         self.postcreate = None
 
 class Writer(plugin.Helper):
+    # Each entry is handled independently of the others
+    shardable = True
+
     @classmethod
     def attributes(self):
         return homeutils.requiredAttributes()
@@ -59,6 +59,9 @@ class WriterContext(object):
         self.makehome = False
 
 class Writer(plugin.Helper):
+    # Each entry is handled independently of the others
+    shardable = True
+
     # Required Attributes
     @classmethod
     def attributes(self): 
@@ -125,6 +125,15 @@ class Writer(plugin.Helper):
         # We want all attributes
         return None
 
+    @classmethod
+    def attributesForContext(self, context):
+        # Only the mapped attributes are used
+        attributes = []
+        for attribute in context.attrmap.itervalues():
+            if (attribute != None and attribute not in attributes):
+                attributes.append(attribute)
+        return tuple(attributes)
+
     @classmethod
     def parseOptions(self, options):
         context = WriterContext()
@@ -60,6 +60,9 @@ class WriterContext(object):
         self.purgeArchiveWait = 14
 
 class Writer(plugin.Helper):
+    # Each entry is handled independently of the others
+    shardable = True
+
     @classmethod
     def attributes(self): 
         return ('pendingPurge', 'uid') + homeutils.requiredAttributes()
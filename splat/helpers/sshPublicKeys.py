@@ -57,6 +57,9 @@ class WriterContext(object):
         self.command = None
 
 class Writer(plugin.Helper):
+    # Each entry is handled independently of the others
+    shardable = True
+
     # Required Attributes
     @classmethod
     def attributes(self): 
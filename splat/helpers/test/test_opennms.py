@@ -120,6 +120,11 @@ class PluginTestCase(unittest.TestCase):
         self.assertEquals(context.attrmap[opennms.OU_USERNAME], 'uid')
         self.assertEquals(context.attrmap[opennms.OU_FULLNAME], 'cn')
 
+    def test_attributes(self):
+        """ Test Attributes Derived From Options """
+        # Only the mapped attributes are requested
+        self.assertEquals(set(self.hc.searchAttr), set(('uid', 'cn', 'mail', 'modifyTimestamp')))
+
     def test_work(self):
         context = self.hc.helperClass.parseOptions(self.options)
         plugin = self.hc.helperClass()
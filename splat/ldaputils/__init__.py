@@ -33,7 +33,7 @@
 
 import os
 
-__all__ = ['client']
+__all__ = ['client', 'filter']
 
 # Useful Constants
 INSTALL_DIR = os.path.dirname(__file__)
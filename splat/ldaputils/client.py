@@ -32,23 +32,87 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import ldap, ldap.modlist, ldap.sasl
-import time
+import ldap, ldap.modlist, ldap.sasl, ldap.controls, ldap.dn
+import time, threading, random, logging
+
+from twisted.internet import defer, task
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.python import failure
+from zope.interface import implements
+
+import splat
+from splat.ldaputils import filter as ldapfilter
+
+try:
+    # Content synchronization controls require pyasn1
+    from ldap import syncrepl
+except ImportError:
+    syncrepl = None
 
 class LDAPUtilsClientError(Exception):
     pass
 
+# Change log formats
+CHANGELOG_ACCESSLOG = 'accesslog'
+CHANGELOG_RETRO = 'changelog'
+CHANGELOG_FORMATS = (CHANGELOG_ACCESSLOG, CHANGELOG_RETRO)
+
+# LDAP errors indicating that the connection to the server has failed
+CONNECTION_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT, ldap.UNAVAILABLE)
+
+def normalizeDN(dn):
+    """
+    Return a normalized form of the given DN, suitable for comparison
+    against other normalized DNs. Attribute types and values are
+    compared case-insensitively, and insignificant whitespace is removed.
+    @param dn: Distinguished name.
+    """
+    try:
+        return ldap.dn.dn2str(ldap.dn.str2dn(dn.lower()))
+    except ldap.DECODING_ERROR:
+        return dn.lower()
+
+def isDescendant(dn, baseDN):
+    """
+    Returns True if dn is equal to, or subordinate to, baseDN.
+    @param dn: Distinguished name.
+    @param baseDN: Distinguished name of the potential ancestor.
+    """
+    dn = normalizeDN(dn)
+    baseDN = normalizeDN(baseDN)
+    if (baseDN == ''):
+        return True
+    return dn == baseDN or dn.endswith(',' + baseDN)
+
+def generalizedTime(seconds):
+    """
+    Convert a time in seconds since epoch to an LDAP GeneralizedTime string,
+    suitable for use in search filters against attributes such as
+    modifyTimestamp.
+    @param seconds: Seconds since epoch.
+    """
+    return time.strftime("%Y%m%d%H%M%SZ", time.gmtime(seconds))
+
 class Connection(object):
     """
     Simple wrapper around an LDAP connection
     """
-    def __init__(self, uri):
+    # True if the asyncSearch(), asyncCompare() and asyncModify() methods
+    # are supported. See TwistedConnection.
+    nonBlocking = False
+
+    # Default maximum number of pipelined operations outstanding at once
+    pipelineDepth = 16
+
+    def __init__(self, uri, pageSize=None):
         """
         Initialize a new LDAP connection with the given URI and LDAP version
         @param uri: URI of LDAP server(s).
+        @param pageSize: Default RFC 2696 paged results page size used for searches. None disables paging. Defaults to None.
         """
         self._ldap = ldap.initialize(uri)
         self._ldap.protocol_version = ldap.VERSION3
+        self.pageSize = pageSize
 
     def simple_bind(self, bind_dn, password):
         """
@@ -73,7 +137,7 @@ class Connection(object):
         """
         self._ldap.sasl_interactive_bind_s('', ldap.sasl.gssapi(authz_id))
 
-    def search(self, base_dn, scope, filter, attributes=None):
+    def search(self, base_dn, scope, filter, attributes=None, pageSize=None):
         """ 
         Search the given base DN of the given LDAP server within
         the given scope (defaulting to subtree), applying
@@ -83,24 +147,152 @@ class Connection(object):
         @param scope: Search scope. One of ldap.SCOPE_SUBTREE, ldap.SCOPE_BASE, or ldap.SCOPE_ONE
         @param filter: LDAP search filter.
         @param attributes: Attributes to return. None causes all attributes to be returned. Defaults to None.
+        @param pageSize: Paged results page size. Defaults to the connection's page size.
+        """
+        return list(self.iterSearch(base_dn, scope, filter, attributes, pageSize))
+
+    def iterSearch(self, base_dn, scope, filter, attributes=None, pageSize=None):
+        """
+        Search the given base DN, returning a generator of Entry objects
+        that are yielded as results arrive from the server, rather than
+        a list of the complete result set.
+
+        If a page size is set, the search is issued using the RFC 2696
+        simple paged results control, so that no more than a single page of
+        results is outstanding at any time, and server size limits apply
+        per-page rather than to the entire result set.
+        @param base_dn: Search base DN.
+        @param scope: Search scope. One of ldap.SCOPE_SUBTREE, ldap.SCOPE_BASE, or ldap.SCOPE_ONE
+        @param filter: LDAP search filter.
+        @param attributes: Attributes to return. None causes all attributes to be returned. Defaults to None.
+        @param pageSize: Paged results page size. Defaults to the connection's page size. A page size of 0 disables paging.
         """
-        # Search the directory using the given base and filter, if we get
-        # results, put them in a list, and hand off to SearchResults
-        result_id = self._ldap.search(base_dn, scope, filter, attributes)
-        result_set = []
+        if (pageSize == None):
+            pageSize = self.pageSize
+
+        # Non-paged search
+        if (not pageSize):
+            result_id = self._ldap.search(base_dn, scope, filter, attributes)
+            for entry in self._iterResults(result_id):
+                yield entry
+            return
+
+        # Paged search. Request the next page until the server hands us
+        # back an empty cookie.
+        cookie = ''
         while 1:
-            result_type,result_data = self._ldap.result(result_id, 0)
-            if result_data == []:
+            pageControl = ldap.controls.SimplePagedResultsControl(True, size=pageSize, cookie=cookie)
+            result_id = self._ldap.search_ext(base_dn, scope, filter, attributes, serverctrls=[pageControl])
+            serverControls = []
+            for entry in self._iterResults(result_id, serverControls):
+                yield entry
+
+            cookie = None
+            for control in serverControls:
+                if (control.controlType == ldap.controls.SimplePagedResultsControl.controlType):
+                    cookie = control.cookie
+                    break
+
+            if (not cookie):
                 break
-            else:
-                if result_type == ldap.RES_SEARCH_ENTRY:
-                    result_set.append(result_data)
-        result = []
-        for entry in result_set:
-            dn = entry[0][0]
-            attrs = entry[0][1]
-            result.append(Entry(dn, attrs))
-        return result
+
+    def _iterResults(self, result_id, serverControls=None):
+        """
+        Yield Entry objects for a single outstanding search, abandoning the
+        search if the caller stops iterating before it completes.
+        @param result_id: Message ID of the search.
+        @param serverControls: If supplied, a list to be extended with the controls returned with the final search result.
+        """
+        done = False
+        try:
+            while 1:
+                result_type, result_data, result_msgid, result_controls = self._ldap.result3(result_id, 0)
+                if (result_type == ldap.RES_SEARCH_RESULT):
+                    done = True
+                    if (serverControls != None):
+                        serverControls.extend(result_controls)
+                    break
+                elif (result_type == ldap.RES_SEARCH_ENTRY):
+                    for dn, attrs in result_data:
+                        yield Entry(dn, attrs)
+        finally:
+            if (not done):
+                try:
+                    self._ldap.abandon(result_id)
+                except ldap.LDAPError:
+                    pass
+
+    def searchMany(self, searches, depth=None):
+        """
+        Issue several searches without waiting for the results of each
+        before sending the next, so that the round trip time to the server
+        is paid once, rather than once per search. Results are not paged.
+        @param searches: List of (base_dn, scope, filter, attributes) tuples.
+        @param depth: Maximum number of searches outstanding at once. Defaults to the connection's pipelineDepth.
+        @result Returns a list containing, for each search in order, a list of Entry objects, or None if the search base does not exist.
+        """
+        return self._pipeline(searches, self._ldap.search_ext, self._searchResult, depth)
+
+    def compareMany(self, compares, depth=None):
+        """
+        Issue several server-side compares without waiting for the result
+        of each before sending the next.
+        @param compares: List of (dn, attribute, value) tuples.
+        @param depth: Maximum number of compares outstanding at once. Defaults to the connection's pipelineDepth.
+        @result Returns a list of True or False, in the order of compares.
+        """
+        return self._pipeline(compares, self._ldap.compare_ext, self._compareResult, depth)
+
+    def _pipeline(self, requests, start, finish, depth):
+        """
+        Issue requests with up to depth outstanding at once, collecting
+        their results in order. Outstanding requests are abandoned if any
+        request fails.
+        @param start: Callable issuing a request, returning its message ID.
+        @param finish: Callable returning the result of a message ID.
+        """
+        if (depth == None):
+            depth = self.pipelineDepth
+
+        results = []
+        outstanding = []
+        done = False
+        try:
+            for request in requests:
+                # Wait for the oldest result before issuing any more
+                if (len(outstanding) >= depth):
+                    results.append(finish(outstanding.pop(0)))
+                outstanding.append(start(*request))
+
+            while (len(outstanding) > 0):
+                results.append(finish(outstanding.pop(0)))
+            done = True
+        finally:
+            if (not done):
+                for msgid in outstanding:
+                    try:
+                        self._ldap.abandon(msgid)
+                    except ldap.LDAPError:
+                        pass
+
+        return results
+
+    def _searchResult(self, msgid):
+        try:
+            result_type, result_data, result_msgid, result_controls = self._ldap.result3(msgid, 1)
+        except ldap.NO_SUCH_OBJECT:
+            return None
+        # Skip search references
+        return [Entry(dn, attrs) for dn, attrs in result_data if dn != None]
+
+    def _compareResult(self, msgid):
+        try:
+            self._ldap.result3(msgid, 1)
+        except ldap.COMPARE_TRUE:
+            return True
+        except ldap.COMPARE_FALSE:
+            return False
+        raise LDAPUtilsClientError, "Compare operation returned an unexpected result"
 
     def compare(self, dn, attribute, value):
         """
@@ -121,6 +313,649 @@ class Connection(object):
         """
         self._ldap.modify_s(mod.dn, mod.modlist)
 
+    def whoami(self):
+        """
+        RFC 4532 "Who am I?" operation.
+        @result Returns the authorization identity of the connection.
+        """
+        return self._ldap.whoami_s()
+
+    def pinnedConnection(self):
+        """
+        Return the Connection to be used for operations spanning multiple
+        requests that must be sent to a single server, such as persistent
+        searches.
+        """
+        return self
+
+    def connectionFailed(self, conn):
+        """
+        Report the failure of a connection returned by pinnedConnection().
+        @result Returns True if another connection is available.
+        """
+        return False
+
+class ConnectionPool(object):
+    """
+    Pool of bound connections to several LDAP servers; eg, replicas of
+    a single directory. Provides the same interface as Connection.
+
+    Reads are spread across the available servers, favouring those with
+    the lowest latency, as measured by checkHealth(). If a server fails,
+    the operation is transparently repeated on another server, and the
+    failed server is reconnected by a later checkHealth(). Modifications
+    are sent to the first available server, in the order given.
+    """
+    # Time, in seconds, before reconnecting to a failed server
+    retryInterval = 30
+    # Network timeout, in seconds, for connecting to a server
+    networkTimeout = 10
+    # Weight of each new latency measurement in the moving average
+    latencyWeight = 0.3
+    # Pooled connections block
+    nonBlocking = False
+
+    def __init__(self, uris, pageSize=None, checkInterval=30):
+        """
+        Initialize a new connection pool. No connections are made until bound.
+        @param uris: List of LDAP server URIs.
+        @param pageSize: Default RFC 2696 paged results page size used for searches. None disables paging. Defaults to None.
+        @param checkInterval: Interval, in seconds, at which the caller should invoke checkHealth(). Defaults to 30.
+        """
+        if (len(uris) == 0):
+            raise LDAPUtilsClientError, "No LDAP servers specified"
+
+        self.pageSize = pageSize
+        self.checkInterval = checkInterval
+        self.members = [_PoolMember(uri) for uri in uris]
+        # Bind method name and arguments, re-used when reconnecting
+        self._bind = None
+        self._lock = threading.Lock()
+
+    def simple_bind(self, bind_dn, password):
+        """
+        Connect to all servers with a simple bind. Succeeds if any server
+        could be contacted.
+        @param bind_dn: Bind DN
+        @param password: Bind Password
+        """
+        self._bindAll('simple_bind', (bind_dn, password))
+
+    def gssapi_bind(self, authz_id=''):
+        """
+        Connect to all servers with a GSSAPI (Kerberos 5) SASL bind.
+        Succeeds if any server could be contacted.
+        @param authz_id: Kerberos principal. Omit to use your default principal.
+        """
+        self._bindAll('gssapi_bind', (authz_id,))
+
+    def _bindAll(self, method, args):
+        self._bind = (method, args)
+        error = None
+        for member in self.members:
+            try:
+                self._connect(member)
+            except CONNECTION_ERRORS, e:
+                error = e
+
+        if (len(self._available()) == 0):
+            raise error
+
+    def _connect(self, member):
+        """
+        Open and bind a connection to the member's server.
+        """
+        method, args = self._bind
+        conn = Connection(member.uri, self.pageSize)
+        conn._ldap.set_option(ldap.OPT_NETWORK_TIMEOUT, self.networkTimeout)
+
+        start = time.time()
+        try:
+            getattr(conn, method)(*args)
+        except CONNECTION_ERRORS:
+            self._lock.acquire()
+            try:
+                member.retryTime = time.time() + self.retryInterval
+            finally:
+                self._lock.release()
+            raise
+
+        self._lock.acquire()
+        try:
+            member.conn = conn
+            member.sample(time.time() - start, self.latencyWeight)
+        finally:
+            self._lock.release()
+
+    def _failed(self, member, conn):
+        """
+        Mark a member's server as failed, unless the connection has
+        already been replaced.
+        """
+        self._lock.acquire()
+        try:
+            if (member.conn is not conn):
+                return
+            member.conn = None
+            member.retryTime = time.time() + self.retryInterval
+        finally:
+            self._lock.release()
+
+        logger = logging.getLogger(splat.LOG_NAME)
+        logger.warning("Lost connection to LDAP server %s, will reconnect in %d seconds" % (member.uri, self.retryInterval))
+
+    def _available(self, exclude=()):
+        """
+        Returns a list of (member, connection) tuples for all connected
+        servers, in the order given.
+        """
+        self._lock.acquire()
+        try:
+            return [(member, member.conn) for member in self.members if member.conn != None and member not in exclude]
+        finally:
+            self._lock.release()
+
+    def _chooseRead(self, exclude):
+        """
+        Choose a server for a read, with a probability inversely
+        proportional to its latency.
+        """
+        available = self._available(exclude)
+        if (len(available) == 0):
+            return (None, None)
+
+        weights = [1.0 / max(member.latency, 0.001) for member, conn in available]
+        choice = random.uniform(0, sum(weights))
+        for i in range(len(available)):
+            choice = choice - weights[i]
+            if (choice <= 0):
+                break
+        return available[i]
+
+    def _chooseWrite(self, exclude):
+        available = self._available(exclude)
+        if (len(available) == 0):
+            return (None, None)
+        return available[0]
+
+    def _failover(self, choose, f):
+        """
+        Invoke f with a connection, repeating it with other connections if
+        the server fails.
+        @param choose: Method used to choose a connection.
+        @param f: Callable accepting a Connection instance.
+        """
+        tried = []
+        error = ldap.SERVER_DOWN({'desc': "No LDAP server available"})
+        while 1:
+            member, conn = choose(tried)
+            if (member == None):
+                raise error
+
+            try:
+                return f(conn)
+            except CONNECTION_ERRORS, e:
+                self._failed(member, conn)
+                tried.append(member)
+                error = e
+
+    def search(self, base_dn, scope, filter, attributes=None, pageSize=None):
+        """
+        Search the given base DN, as per Connection.search().
+        """
+        return self._failover(self._chooseRead, lambda conn: conn.search(base_dn, scope, filter, attributes, pageSize))
+
+    def iterSearch(self, base_dn, scope, filter, attributes=None, pageSize=None):
+        """
+        Search the given base DN, as per Connection.iterSearch(). If the
+        server fails part way through the search, it is repeated on another
+        server, skipping any entries that have already been returned.
+        """
+        tried = []
+        error = ldap.SERVER_DOWN({'desc': "No LDAP server available"})
+        # DNs of returned entries. Replicas return identical DNs, so there
+        # is no need to normalize them.
+        returned = {}
+        while 1:
+            member, conn = self._chooseRead(tried)
+            if (member == None):
+                raise error
+
+            try:
+                for entry in conn.iterSearch(base_dn, scope, filter, attributes, pageSize):
+                    if (returned.has_key(entry.dn)):
+                        continue
+                    returned[entry.dn] = True
+                    yield entry
+                return
+            except CONNECTION_ERRORS, e:
+                self._failed(member, conn)
+                tried.append(member)
+                error = e
+
+    def searchMany(self, searches, depth=None):
+        """
+        Issue several searches at once, as per Connection.searchMany().
+        """
+        return self._failover(self._chooseRead, lambda conn: conn.searchMany(searches, depth))
+
+    def compare(self, dn, attribute, value):
+        """
+        Server-side compare, as per Connection.compare().
+        """
+        return self._failover(self._chooseRead, lambda conn: conn.compare(dn, attribute, value))
+
+    def compareMany(self, compares, depth=None):
+        """
+        Issue several server-side compares at once, as per Connection.compareMany().
+        """
+        return self._failover(self._chooseRead, lambda conn: conn.compareMany(compares, depth))
+
+    def modify(self, mod):
+        """
+        Modify an entry, as per Connection.modify().
+        """
+        return self._failover(self._chooseWrite, lambda conn: conn.modify(mod))
+
+    def whoami(self):
+        """
+        RFC 4532 "Who am I?" operation, as per Connection.whoami().
+        """
+        return self._failover(self._chooseRead, lambda conn: conn.whoami())
+
+    def pinnedConnection(self):
+        """
+        Return the connection to the first available server, in the
+        order given, for operations that must be sent to a single server.
+        """
+        member, conn = self._chooseWrite(())
+        if (member == None):
+            raise ldap.SERVER_DOWN({'desc': "No LDAP server available"})
+        return conn
+
+    def connectionFailed(self, conn):
+        """
+        Report the failure of a connection returned by pinnedConnection().
+        @result Returns True if another connection is available.
+        """
+        for member, available in self._available():
+            if (available is conn):
+                self._failed(member, conn)
+        return (len(self._available()) > 0)
+
+    def checkHealth(self):
+        """
+        Probe each connected server with a "Who am I?" operation, updating
+        its measured latency, and reconnect to failed servers once their
+        retry interval has elapsed.
+        """
+        logger = logging.getLogger(splat.LOG_NAME)
+        for member in self.members:
+            conn = member.conn
+            if (conn == None):
+                if (time.time() < member.retryTime):
+                    continue
+                try:
+                    self._connect(member)
+                except CONNECTION_ERRORS:
+                    continue
+                except ldap.LDAPError, e:
+                    # Eg, our credentials were rejected
+                    logger.error("Unable to bind to LDAP server %s: %s" % (member.uri, e))
+                    member.retryTime = time.time() + self.retryInterval
+                    continue
+                logger.info("Reconnected to LDAP server %s" % member.uri)
+                continue
+
+            start = time.time()
+            try:
+                conn.whoami()
+            except CONNECTION_ERRORS:
+                self._failed(member, conn)
+                continue
+            except ldap.LDAPError:
+                # The operation is unsupported, but the server is alive
+                pass
+
+            self._lock.acquire()
+            try:
+                member.sample(time.time() - start, self.latencyWeight)
+            finally:
+                self._lock.release()
+
+class _PoolMember(object):
+    """
+    A server in a ConnectionPool
+    """
+    def __init__(self, uri):
+        self.uri = uri
+        # Bound Connection, or None if not connected
+        self.conn = None
+        # Moving average of the measured latency, in seconds
+        self.latency = None
+        # Time after which a failed server may be reconnected
+        self.retryTime = 0
+
+    def sample(self, latency, weight):
+        if (self.latency == None):
+            self.latency = latency
+        else:
+            self.latency = weight * latency + (1 - weight) * self.latency
+
+class TwistedConnection(Connection):
+    """
+    LDAP connection integrated with the Twisted reactor. In addition to
+    the blocking Connection methods, operations may be issued with
+    asyncSearch(), asyncIterSearch(), asyncSearchMany(), asyncCompare()
+    and asyncModify(), whose results are read as they arrive on the
+    connection's socket, without blocking the reactor. The async methods
+    must be called from the reactor thread.
+    """
+    implements(IReadDescriptor)
+
+    nonBlocking = True
+
+    # Interval, in seconds, at which outstanding operations are polled.
+    # Results read from the socket by a blocking call on the same connection
+    # are queued by libldap, and would otherwise never be noticed.
+    pollInterval = 0.5
+
+    def __init__(self, uri, pageSize=None, reactor=None):
+        """
+        Initialize a new LDAP connection
+        @param uri: URI of LDAP server(s).
+        @param pageSize: Default RFC 2696 paged results page size used for searches. None disables paging. Defaults to None.
+        @param reactor: Reactor from which results are read. Defaults to the global reactor.
+        """
+        Connection.__init__(self, uri, pageSize)
+        if (reactor == None):
+            from twisted.internet import reactor
+        self.reactor = reactor
+        # Outstanding operations, by message ID
+        self._operations = {}
+        self._pollTask = None
+
+    def asyncSearch(self, base_dn, scope, filter, attributes=None, pageSize=None):
+        """
+        Search without blocking, as per search().
+        @result Returns a Deferred whose callback is invoked with a list of Entry objects.
+        """
+        if (pageSize == None):
+            pageSize = self.pageSize
+        return self._start(_AsyncSearch(self, base_dn, scope, filter, attributes, pageSize))
+
+    def asyncIterSearch(self, base_dn, scope, filter, attributes=None, pageSize=None):
+        """
+        Search without blocking, as per iterSearch(). The returned iterable
+        yields Entry objects as they arrive and, whenever none are
+        available, a Deferred whose callback is invoked once more results
+        have been read, and which the caller must wait for before
+        continuing; eg, by yielding it to twisted.internet.task.cooperate().
+        Each page is only requested once the previous page has been
+        consumed, so that no more than a single page of entries is held in
+        memory. Errors are raised by the iterator.
+        @result Returns an iterable of Entry objects and Deferreds.
+        """
+        if (pageSize == None):
+            pageSize = self.pageSize
+        search = _AsyncIterSearch(self, base_dn, scope, filter, attributes, pageSize)
+        self._start(search)
+        return search
+
+    def asyncSearchMany(self, searches, depth=None):
+        """
+        Issue several searches without blocking, as per searchMany().
+        @param searches: List of (base_dn, scope, filter, attributes) tuples.
+        @param depth: Maximum number of searches outstanding at once. Defaults to the connection's pipelineDepth.
+        @result Returns a Deferred whose callback is invoked with a list containing, for each search in order, a list of Entry objects, or None if the search base does not exist.
+        """
+        if (depth == None):
+            depth = self.pipelineDepth
+
+        semaphore = defer.DeferredSemaphore(depth)
+        deferreds = []
+        for base_dn, scope, filter, attributes in searches:
+            d = semaphore.run(self.asyncSearch, base_dn, scope, filter, attributes, 0)
+            d.addErrback(_ebNoSuchObject)
+            deferreds.append(d)
+
+        d = defer.DeferredList(deferreds, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(_cbResults, _ebFirstError)
+        return d
+
+    def asyncCompare(self, dn, attribute, value):
+        """
+        Server-side compare without blocking, as per compare().
+        @result Returns a Deferred whose callback is invoked with True or False.
+        """
+        return self._start(_AsyncCompare(self._ldap.compare_ext, dn, attribute, value))
+
+    def asyncModify(self, mod):
+        """
+        Modify an LDAP entry without blocking, as per modify().
+        @result Returns a Deferred whose callback is invoked once the modification is complete.
+        """
+        return self._start(_AsyncOperation(self._ldap.modify_ext, mod.dn, mod.modlist))
+
+    def _start(self, operation):
+        try:
+            self._addOperation(operation.issue(), operation)
+        except ldap.LDAPError, e:
+            operation.error(e)
+        return operation.deferred
+
+    def _addOperation(self, msgid, operation):
+        self._operations[msgid] = operation
+        if (self._pollTask == None):
+            self.reactor.addReader(self)
+            self._pollTask = task.LoopingCall(self._poll)
+            self._pollTask.clock = self.reactor
+            self._pollTask.start(self.pollInterval, False)
+
+    def _poll(self):
+        """
+        Read the available results of all outstanding operations.
+        """
+        for msgid in self._operations.keys():
+            # Completed operations' callbacks may have failed the rest
+            operation = self._operations.get(msgid)
+            while (operation != None):
+                try:
+                    result_type, result_data, result_msgid, result_controls = self._ldap.result3(msgid, 0, 0)
+                except ldap.LDAPError, e:
+                    self._operations.pop(msgid)
+                    operation.error(e)
+                    break
+
+                # No results available
+                if (result_type == None):
+                    break
+
+                if (operation.result(result_type, result_data, result_controls)):
+                    self._operations.pop(msgid, None)
+                    break
+
+        if (len(self._operations) == 0):
+            self._stopReading()
+
+    def _stopReading(self):
+        if (self._pollTask != None):
+            self.reactor.removeReader(self)
+            self._pollTask.stop()
+            self._pollTask = None
+
+    def fileno(self):
+        return self._ldap.get_option(ldap.OPT_DESC)
+
+    def doRead(self):
+        self._poll()
+
+    def connectionLost(self, reason):
+        """
+        Fail all outstanding operations.
+        """
+        self._stopReading()
+        operations = self._operations.values()
+        self._operations = {}
+        for operation in operations:
+            operation.error(reason)
+
+    def logPrefix(self):
+        return self.__class__.__name__
+
+def _ebNoSuchObject(failure):
+    # Searches of missing bases have no results
+    failure.trap(ldap.NO_SUCH_OBJECT)
+    return None
+
+def _cbResults(results):
+    return [result for success, result in results]
+
+def _ebFirstError(failure):
+    # Report the failure of the operation itself
+    failure.trap(defer.FirstError)
+    return failure.value.subFailure
+
+class _AsyncOperation(object):
+    """
+    An outstanding TwistedConnection operation
+    """
+    def __init__(self, f, *args):
+        """
+        @param f: python-ldap method issuing the operation, returning its message ID.
+        """
+        self.f = f
+        self.args = args
+        self.deferred = defer.Deferred()
+
+    def issue(self):
+        return self.f(*self.args)
+
+    def result(self, result_type, result_data, result_controls):
+        """
+        Handle a result message.
+        @result Returns True once the operation is complete.
+        """
+        self.deferred.callback(None)
+        return True
+
+    def error(self, e):
+        self.deferred.errback(e)
+
+class _AsyncCompare(_AsyncOperation):
+    def error(self, e):
+        # The outcome of a compare is returned as an error
+        if (isinstance(e, ldap.COMPARE_TRUE)):
+            self.deferred.callback(True)
+        elif (isinstance(e, ldap.COMPARE_FALSE)):
+            self.deferred.callback(False)
+        else:
+            self.deferred.errback(e)
+
+class _AsyncSearch(_AsyncOperation):
+    def __init__(self, conn, base_dn, scope, filter, attributes, pageSize):
+        _AsyncOperation.__init__(self, conn._ldap.search_ext, base_dn, scope, filter, attributes)
+        self.conn = conn
+        self.pageSize = pageSize
+        self.entries = []
+
+    def issue(self, cookie=''):
+        if (not self.pageSize):
+            return _AsyncOperation.issue(self)
+        pageControl = ldap.controls.SimplePagedResultsControl(True, size=self.pageSize, cookie=cookie)
+        return self.f(serverctrls=[pageControl], *self.args)
+
+    def result(self, result_type, result_data, result_controls):
+        if (result_type == ldap.RES_SEARCH_ENTRY):
+            for dn, attrs in result_data:
+                self.entries.append(Entry(dn, attrs))
+            return False
+        elif (result_type != ldap.RES_SEARCH_RESULT):
+            # Search references
+            return False
+
+        # Request the next page, if any
+        cookie = self._pageCookie(result_controls)
+        if (cookie):
+            try:
+                self.conn._addOperation(self.issue(cookie), self)
+            except ldap.LDAPError, e:
+                self.error(e)
+        else:
+            self.deferred.callback(self.entries)
+        return True
+
+    def _pageCookie(self, result_controls):
+        for control in result_controls:
+            if (control.controlType == ldap.controls.SimplePagedResultsControl.controlType):
+                return control.cookie
+        return None
+
+class _AsyncIterSearch(_AsyncSearch):
+    """
+    An outstanding search whose entries are consumed as they arrive. Only
+    the entries not yet consumed are held.
+    """
+    def __init__(self, conn, base_dn, scope, filter, attributes, pageSize):
+        _AsyncSearch.__init__(self, conn, base_dn, scope, filter, attributes, pageSize)
+        # Cookie of the next page, once the current page is complete
+        self.cookie = None
+        self.done = False
+        self.failure = None
+        # Deferred awaiting further results, if any
+        self.waiting = None
+
+    def result(self, result_type, result_data, result_controls):
+        if (result_type == ldap.RES_SEARCH_ENTRY):
+            for dn, attrs in result_data:
+                self.entries.append(Entry(dn, attrs))
+            self._wake()
+            return False
+        elif (result_type != ldap.RES_SEARCH_RESULT):
+            # Search references
+            return False
+
+        # The next page, if any, is requested once this page is consumed
+        self.cookie = self._pageCookie(result_controls)
+        self.done = not self.cookie
+        self._wake()
+        return True
+
+    def error(self, e):
+        if (not isinstance(e, failure.Failure)):
+            e = failure.Failure(e)
+        self.failure = e
+        self._wake()
+
+    def _wake(self):
+        if (self.waiting != None):
+            d = self.waiting
+            self.waiting = None
+            d.callback(None)
+
+    def __iter__(self):
+        while (1):
+            if (len(self.entries) > 0):
+                entries = self.entries
+                self.entries = []
+                for entry in entries:
+                    yield entry
+            elif (self.failure != None):
+                self.failure.raiseException()
+            elif (self.done):
+                return
+            else:
+                if (self.cookie):
+                    cookie = self.cookie
+                    self.cookie = None
+                    try:
+                        self.conn._addOperation(self.issue(cookie), self)
+                    except ldap.LDAPError, e:
+                        self.error(e)
+                        continue
+                self.waiting = defer.Deferred()
+                yield self.waiting
+
 class Entry(object):
     """
     LDAP Entry
@@ -184,18 +1019,22 @@ class GroupFilter(object):
     """
     LDAP Group Filter Object
     """
-    def __init__(self, baseDN, scope, filter, memberAttribute='uniqueMember'):
+    def __init__(self, baseDN, scope, filter, memberAttribute='uniqueMember', nested=False):
         """
         Initialize a new group filter object
         @param baseDN: LDAP search base
         @param scope: LDAP search scope
         @param filter: LDAP search filter
         @param memberAttribute: Attribute containing member DN. Defaults to 'uniqueMember'
+        @param nested: Include the members of member groups found within the search base and scope, recursively, when calling getMembership(). Defaults to False.
         """
         self.baseDN = baseDN
         self.scope = scope
         self.filter = filter
         self.memberAttribute = memberAttribute
+        self.nested = nested
+        # Cached (fetch time, GroupMembership) of nested groups
+        self._nestedCache = None
 
     def isMember(self, ldapConnection, dn):
         """
@@ -205,10 +1044,859 @@ class GroupFilter(object):
         @param dn: DN to test against group list
         """
         groups = ldapConnection.search(self.baseDN, self.scope, self.filter, [])
-        for group in groups:
-            if (ldapConnection.compare(group.dn, self.memberAttribute, dn)):
-                return True
 
-        # DN not found, fall through.
+        # Compare against all groups at once
+        compares = [(group.dn, self.memberAttribute, dn) for group in groups]
+        return (True in ldapConnection.compareMany(compares))
+
+    def getMembership(self, ldapConnection, fetchMembers=True):
+        """
+        Fetch the members and modification time of the group(s) returned by
+        the LDAP search specified at instance initialization, allowing any
+        number of DNs to be tested without further LDAP operations.
+        @param ldapConnection: A valid LDAP Connection instance
+        @param fetchMembers: If False, only the group DNs and modification time are fetched; eg, when membership will be tested using entries' memberOf attribute. Defaults to True.
+        @result Returns a GroupMembership instance.
+        """
+        if (self.nested and fetchMembers):
+            return self._getNestedMembership(ldapConnection)
+
+        fetchTime = int(time.time())
+        baseDN, scope, filter, attributes = self._membershipSearch(fetchMembers)
+        return self._membership(ldapConnection.iterSearch(baseDN, scope, filter, attributes), fetchTime)
+
+    def asyncGetMembership(self, ldapConnection, fetchMembers=True):
+        """
+        Fetch the membership of the group(s) without blocking, as per
+        getMembership(). Must be called from the reactor thread.
+        @param ldapConnection: A TwistedConnection instance
+        @param fetchMembers: See getMembership(). Defaults to True.
+        @result Returns a Deferred whose callback is invoked with a GroupMembership instance.
+        """
+        fetchTime = int(time.time())
+        if (not (self.nested and fetchMembers)):
+            baseDN, scope, filter, attributes = self._membershipSearch(fetchMembers)
+            d = ldapConnection.asyncSearch(baseDN, scope, filter, attributes)
+            d.addCallback(self._membership, fetchTime)
+            return d
+
+        # Nested memberships are re-used if the probe finds them current
+        if (self._nestedCache != None):
+            baseDN, scope, filter, attributes = self._nestedSearch(False)
+            d = ldapConnection.asyncSearch(baseDN, scope, filter, attributes)
+            d.addCallback(self._cachedNestedMembership, fetchTime)
+        else:
+            d = defer.succeed(None)
+        d.addCallback(self._cbAsyncNestedMembership, ldapConnection, fetchTime)
+        return d
+
+    def _cbAsyncNestedMembership(self, membership, ldapConnection, fetchTime):
+        if (membership != None):
+            return membership
+        searches = [self._nestedSearch(True), (self.baseDN, self.scope, self.filter, ['modifyTimestamp'])]
+        d = ldapConnection.asyncSearchMany(searches)
+        d.addCallback(self._cbAsyncNestedGroups, fetchTime)
+        return d
+
+    def _cbAsyncNestedGroups(self, results, fetchTime):
+        groupEntries, matchingEntries = results
+        if (groupEntries == None or matchingEntries == None):
+            raise ldap.NO_SUCH_OBJECT({'desc': "No such object", 'matched': self.baseDN})
+        return self._nestedMembership(groupEntries, matchingEntries, fetchTime)
+
+    def _membershipSearch(self, fetchMembers):
+        """
+        Returns the (base DN, scope, filter, attributes) of the search
+        performed by getMembership().
+        """
+        attributes = ['modifyTimestamp']
+        if (fetchMembers):
+            attributes.append(self.memberAttribute)
+        return (self.baseDN, self.scope, self.filter, attributes)
+
+    def _membership(self, groupEntries, fetchTime):
+        """
+        Compute the membership of the supplied group entries.
+        """
+        members = set()
+        groups = set()
+        modTime = 0
+
+        for group in groupEntries:
+            groups.add(normalizeDN(group.dn))
+            for member in ldapfilter._getValues(group, self.memberAttribute):
+                members.add(normalizeDN(member))
+
+            # If any group is missing a timestamp, assume the groups have
+            # been modified.
+            groupModTime = None
+            if (group.attributes.has_key('modifyTimestamp')):
+                groupModTime = group.getModTime()
+            if (groupModTime == None or modTime == None):
+                modTime = None
+            else:
+                modTime = max(modTime, groupModTime)
+
+        return GroupMembership(members, groups, modTime, fetchTime)
+
+    def _getNestedMembership(self, ldapConnection):
+        """
+        Compute the transitive closure of the group(s) returned by the LDAP
+        search, expanding any members that are themselves groups. The
+        result is cached until a group within the search base is added,
+        modified or deleted.
+        """
+        fetchTime = int(time.time())
+        if (self._nestedCache != None):
+            baseDN, scope, filter, attributes = self._nestedSearch(False)
+            membership = self._cachedNestedMembership(ldapConnection.iterSearch(baseDN, scope, filter, attributes), fetchTime)
+            if (membership != None):
+                return membership
+
+        baseDN, scope, filter, attributes = self._nestedSearch(True)
+        return self._nestedMembership(ldapConnection.iterSearch(baseDN, scope, filter, attributes),
+                ldapConnection.search(self.baseDN, self.scope, self.filter, ['modifyTimestamp']), fetchTime)
+
+    def _nestedSearch(self, fetchMembers):
+        """
+        Returns the (base DN, scope, filter, attributes) of the search for
+        every group within the search base, fetching their members, or only
+        their modification stamps.
+        """
+        attributes = ['modifyTimestamp', 'entryCSN']
+        if (fetchMembers):
+            attributes.append(self.memberAttribute)
+        return (self.baseDN, self.scope, '(%s=*)' % self.memberAttribute, attributes)
+
+    def _cachedNestedMembership(self, groupEntries, fetchTime):
+        """
+        Return the cached nested membership if the server reports the same
+        set of groups, with the same modification stamps, as when it was
+        computed, or None. Our own clock is not consulted.
+        """
+        stamps, membership = self._nestedCache
+        current = {}
+        for group in groupEntries:
+            current[normalizeDN(group.dn)] = _groupStamp(group)
+        if (current != stamps):
+            return None
+        # The membership is known to be current as of this probe
+        membership.fetchTime = fetchTime
+        return membership
+
+    def _nestedMembership(self, groupEntries, matchingEntries, fetchTime):
+        """
+        Compute, and cache, the nested membership of the groups matching
+        our filter.
+        @param groupEntries: Every group within the search base
+        @param matchingEntries: The groups matching our filter
+        """
+        # Index every group within the search base by normalized DN
+        groupMembers = {}
+        groupModTimes = {}
+        stamps = {}
+        for group in groupEntries:
+            groupDN = normalizeDN(group.dn)
+            stamps[groupDN] = _groupStamp(group)
+            groupMembers[groupDN] = [normalizeDN(member) for member in ldapfilter._getValues(group, self.memberAttribute)]
+            groupModTimes[groupDN] = None
+            if (group.attributes.has_key('modifyTimestamp')):
+                groupModTimes[groupDN] = group.getModTime()
+
+        # Walk the membership graph from the groups matching our filter,
+        # visiting each group once to break any cycles.
+        members = set()
+        groups = set()
+        modTime = 0
+        pending = [normalizeDN(group.dn) for group in matchingEntries]
+        while (len(pending) > 0):
+            groupDN = pending.pop()
+            if (groupDN in groups):
+                continue
+            groups.add(groupDN)
+
+            # Empty groups lack a member attribute, and are not indexed
+            if (not groupMembers.has_key(groupDN)):
+                continue
+
+            groupModTime = groupModTimes[groupDN]
+            if (groupModTime == None or modTime == None):
+                modTime = None
+            else:
+                modTime = max(modTime, groupModTime)
+
+            for member in groupMembers[groupDN]:
+                members.add(member)
+                if (groupMembers.has_key(member)):
+                    pending.append(member)
+
+        membership = GroupMembership(members, groups, modTime, fetchTime)
+        self._nestedCache = (stamps, membership)
+        return membership
+
+def _groupStamp(group):
+    """
+    Returns the modifyTimestamp and entryCSN values of a group entry.
+    """
+    return (tuple(ldapfilter._getValues(group, 'modifyTimestamp')), tuple(ldapfilter._getValues(group, 'entryCSN')))
+
+def getMemberships(ldapConnection, groupFilters, fetchMembers=True):
+    """
+    Fetch the membership of several group filters, as per
+    GroupFilter.getMembership(), issuing their searches at once.
+    @param ldapConnection: A valid LDAP Connection instance
+    @param groupFilters: List of GroupFilter instances
+    @param fetchMembers: See GroupFilter.getMembership(). Defaults to True.
+    @result Returns a list of GroupMembership instances, in the order of groupFilters.
+    """
+    fetchTime = int(time.time())
+    pipelined, searches = _membershipSearches(groupFilters, fetchMembers)
+    results = _pipelinedMemberships(pipelined, ldapConnection.searchMany(searches), fetchTime)
+
+    memberships = []
+    for groupFilter in groupFilters:
+        if (results.has_key(groupFilter)):
+            memberships.append(results[groupFilter])
+        else:
+            memberships.append(groupFilter.getMembership(ldapConnection, fetchMembers))
+    return memberships
+
+def asyncGetMemberships(ldapConnection, groupFilters, fetchMembers=True):
+    """
+    Fetch the membership of several group filters without blocking, as per
+    getMemberships(). Must be called from the reactor thread.
+    @param ldapConnection: A TwistedConnection instance
+    @param groupFilters: List of GroupFilter instances
+    @param fetchMembers: See GroupFilter.getMembership(). Defaults to True.
+    @result Returns a Deferred whose callback is invoked with a list of GroupMembership instances, in the order of groupFilters.
+    """
+    fetchTime = int(time.time())
+    pipelined, searches = _membershipSearches(groupFilters, fetchMembers)
+    d = ldapConnection.asyncSearchMany(searches)
+    d.addCallback(_cbAsyncGetMemberships, ldapConnection, groupFilters, pipelined, fetchMembers, fetchTime)
+    return d
+
+def _cbAsyncGetMemberships(groupEntries, ldapConnection, groupFilters, pipelined, fetchMembers, fetchTime):
+    results = _pipelinedMemberships(pipelined, groupEntries, fetchTime)
+    deferreds = []
+    for groupFilter in groupFilters:
+        if (results.has_key(groupFilter)):
+            deferreds.append(defer.succeed(results[groupFilter]))
+        else:
+            deferreds.append(groupFilter.asyncGetMembership(ldapConnection, fetchMembers))
+
+    d = defer.DeferredList(deferreds, fireOnOneErrback=True, consumeErrors=True)
+    d.addCallbacks(_cbResults, _ebFirstError)
+    return d
+
+def _membershipSearches(groupFilters, fetchMembers):
+    """
+    Returns the group filters whose memberships may be fetched at once,
+    and their searches. Nested memberships require searches of their own.
+    """
+    pipelined = [groupFilter for groupFilter in groupFilters if not (groupFilter.nested and fetchMembers)]
+    searches = [groupFilter._membershipSearch(fetchMembers) for groupFilter in pipelined]
+    return (pipelined, searches)
+
+def _pipelinedMemberships(pipelined, groupEntries, fetchTime):
+    """
+    Returns the memberships computed from the results of the searches
+    returned by _membershipSearches(), keyed by group filter.
+    """
+    results = {}
+    for groupFilter, entries in zip(pipelined, groupEntries):
+        if (entries == None):
+            raise ldap.NO_SUCH_OBJECT({'desc': "No such object", 'matched': groupFilter.baseDN})
+        results[groupFilter] = groupFilter._membership(entries, fetchTime)
+    return results
+
+class GroupMembership(object):
+    """
+    Membership of the group(s) matched by a GroupFilter
+    """
+    def __init__(self, members, groups, modTime, fetchTime=None):
+        """
+        Initialize a new group membership object
+        @param members: Set of normalized member DNs
+        @param groups: Set of normalized group DNs
+        @param modTime: Most recent modification time of the groups, in seconds since epoch. None if unknown.
+        @param fetchTime: Time, in seconds since epoch, as of which the membership is known to be current. Defaults to the current time.
+        """
+        self.members = members
+        self.groups = groups
+        self.modTime = modTime
+        if (fetchTime == None):
+            fetchTime = int(time.time())
+        self.fetchTime = fetchTime
+
+    def isMember(self, dn):
+        """
+        Returns True if dn is a member of the group(s).
+        @param dn: DN to test against group list
+        """
+        return normalizeDN(dn) in self.members
+
+    def matchesMemberOf(self, entry):
+        """
+        Returns True if the entry's memberOf attribute, as maintained by
+        servers supporting it, names any of the group(s).
+        @param entry: Entry instance, retrieved with the memberOf attribute
+        """
+        for groupDN in ldapfilter._getValues(entry, 'memberOf'):
+            if (normalizeDN(groupDN) in self.groups):
+                return True
         return False
 
+    def isModified(self, since):
+        """
+        Returns True if the group(s) may have been modified at or after
+        the given time.
+        @param since: Time in seconds since epoch
+        """
+        return self.modTime == None or self.modTime >= since
+
+class SearchSnapshot(object):
+    """
+    Shared search result snapshot. Any number of searches, differing only
+    in filter and attributes, are satisfied by a single LDAP search for
+    the union of their filters and attributes, re-issued once the snapshot
+    is older than its time to live. Each search's own filter is then
+    evaluated locally. Thread-safe.
+    """
+    def __init__(self, baseDN, scope, ttl):
+        """
+        Initialize a new search snapshot
+        @param baseDN: LDAP search base
+        @param scope: LDAP search scope
+        @param ttl: Time, in seconds, for which fetched entries are re-used.
+        """
+        self.baseDN = baseDN
+        self.scope = scope
+        self.ttl = ttl
+        self._filters = []
+        self._attributes = []
+        self._snapshot = None
+        self._lock = threading.Lock()
+        # Deferreds awaiting an asyncFetch()
+        self._waiters = []
+
+    def addSearch(self, filter, attributes=None):
+        """
+        Include the given search in the snapshot. Raises
+        ldaputils.filter.LDAPUtilsFilterError if the filter can not be
+        evaluated locally.
+        @param filter: LDAP search filter
+        @param attributes: Attributes to return. None causes all attributes to be returned. Defaults to None.
+        @result Returns an opaque search handle, to be passed to search().
+        """
+        parsed = ldapfilter.parse(filter)
+        if (attributes == None):
+            attributes = ('*',)
+
+        self._lock.acquire()
+        try:
+            if (not filter.startswith('(')):
+                filter = '(%s)' % filter
+            self._filters.append(filter)
+            # The filter is evaluated locally, and so must be able to
+            # see every attribute it references
+            for attribute in list(attributes) + parsed.attributes():
+                if (attribute.lower() not in [attr.lower() for attr in self._attributes]):
+                    self._attributes.append(attribute)
+            # Force a fetch including the new search
+            self._snapshot = None
+        finally:
+            self._lock.release()
+
+        return (parsed, attributes)
+
+    def search(self, ldapConnection, handle, snapshot=None):
+        """
+        Return the snapshot's entries matching a search added with
+        addSearch(), fetching the snapshot if it has expired.
+        @param ldapConnection: A valid LDAP Connection instance
+        @param handle: Search handle returned by addSearch()
+        @param snapshot: Snapshot returned by asyncFetch(). If supplied, it is searched, expired or not, and nothing is fetched. Defaults to None.
+        @result Returns a (fetch time, entries) tuple. The fetch time, in seconds since epoch, is the time as of which the entries are known to be current.
+        """
+        parsed, attributes = handle
+        if (snapshot == None):
+            snapshot = self._fetch(ldapConnection)
+        fetchTime, entries = snapshot
+
+        # Entries only carry the attributes requested for this search, and
+        # not those fetched for other searches or for filter evaluation
+        names = [attribute.lower() for attribute in attributes]
+        allUser = '*' in names
+        results = []
+        for entry in entries:
+            if (not parsed.matches(entry)):
+                continue
+            if (allUser):
+                results.append(entry)
+                continue
+            values = {}
+            for key, value in entry.attributes.iteritems():
+                if (key.lower() in names):
+                    values[key] = value
+            results.append(Entry(entry.dn, values))
+
+        return (fetchTime, results)
+
+    def asyncFetch(self, ldapConnection):
+        """
+        Fetch the snapshot if it has expired, using the asyncSearch()
+        method of a non-blocking connection. Passing the result to
+        search() ensures it does not block, even if the snapshot has
+        expired again since. Concurrent callers share a single fetch. Must
+        be called from the reactor thread.
+        @param ldapConnection: A TwistedConnection instance
+        @result Returns a Deferred whose callback is invoked with the current snapshot.
+        """
+        self._lock.acquire()
+        try:
+            if (not self._isExpired()):
+                return defer.succeed(self._snapshot)
+            d = defer.Deferred()
+            self._waiters.append(d)
+            fetching = (len(self._waiters) > 1)
+            filter = self._filter()
+        finally:
+            self._lock.release()
+
+        if (not fetching):
+            fetchTime = int(time.time())
+            search = ldapConnection.asyncSearch(self.baseDN, self.scope, filter, self._attributes)
+            search.addBoth(self._cbAsyncFetch, fetchTime)
+        return d
+
+    def _cbAsyncFetch(self, result, fetchTime):
+        self._lock.acquire()
+        try:
+            if (not isinstance(result, failure.Failure)):
+                result = (fetchTime, result)
+                self._snapshot = result
+            waiters = self._waiters
+            self._waiters = []
+        finally:
+            self._lock.release()
+
+        for d in waiters:
+            if (isinstance(result, failure.Failure)):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _isExpired(self):
+        return (self._snapshot == None or time.time() - self._snapshot[0] >= self.ttl)
+
+    def _filter(self):
+        if (len(self._filters) == 1):
+            return self._filters[0]
+        return '(|%s)' % ''.join(self._filters)
+
+    def _fetch(self, ldapConnection):
+        self._lock.acquire()
+        try:
+            if (self._isExpired()):
+                fetchTime = int(time.time())
+                entries = ldapConnection.search(self.baseDN, self.scope, self._filter(), self._attributes)
+                self._snapshot = (fetchTime, entries)
+            return self._snapshot
+        finally:
+            self._lock.release()
+
+class GroupCache(object):
+    """
+    Group membership cache, shared by any number of GroupFilter users.
+    Group filters with the same search base, scope, filter and member
+    attribute share a single cached GroupMembership, which is re-fetched
+    once it is older than the cache's time to live. Thread-safe.
+    """
+    def __init__(self, ttl):
+        """
+        Initialize a new group cache
+        @param ttl: Time, in seconds, for which a fetched membership is re-used. A ttl of '0' disables caching.
+        """
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def getMembership(self, groupFilter, ldapConnection, fetchMembers=True):
+        """
+        Return the membership of the group filter's groups, fetching
+        it from the LDAP server if not cached, or if the cached
+        membership has expired.
+        @param groupFilter: GroupFilter instance
+        @param ldapConnection: A valid LDAP Connection instance
+        @param fetchMembers: See GroupFilter.getMembership(). Defaults to True.
+        @result Returns a GroupMembership instance.
+        """
+        return self.getMemberships([groupFilter], ldapConnection, fetchMembers)[0]
+
+    def getMemberships(self, groupFilters, ldapConnection, fetchMembers=True):
+        """
+        Return the memberships of several group filters, as per
+        getMembership(). Any memberships that must be fetched are
+        fetched at once.
+        @param groupFilters: List of GroupFilter instances
+        @param ldapConnection: A valid LDAP Connection instance
+        @param fetchMembers: See GroupFilter.getMembership(). Defaults to True.
+        @result Returns a list of GroupMembership instances, in the order of groupFilters.
+        """
+        if (not self.ttl):
+            return getMemberships(ldapConnection, groupFilters, fetchMembers)
+
+        # Hold the lock while fetching, so that concurrent callers
+        # share a single fetch.
+        self._lock.acquire()
+        try:
+            memberships, missing = self._lookup(groupFilters, fetchMembers)
+            cacheTime = time.time()
+            self._store(missing, getMemberships(ldapConnection, missing, fetchMembers), fetchMembers, cacheTime, memberships)
+            return [memberships[self._key(groupFilter)] for groupFilter in groupFilters]
+        finally:
+            self._lock.release()
+
+    def asyncGetMemberships(self, groupFilters, ldapConnection, fetchMembers=True):
+        """
+        Return the memberships of several group filters without blocking,
+        as per getMemberships(). Must be called from the reactor thread.
+        Concurrent callers do not share a single fetch.
+        @param groupFilters: List of GroupFilter instances
+        @param ldapConnection: A TwistedConnection instance
+        @param fetchMembers: See GroupFilter.getMembership(). Defaults to True.
+        @result Returns a Deferred whose callback is invoked with a list of GroupMembership instances, in the order of groupFilters.
+        """
+        if (not self.ttl):
+            return asyncGetMemberships(ldapConnection, groupFilters, fetchMembers)
+
+        self._lock.acquire()
+        try:
+            memberships, missing = self._lookup(groupFilters, fetchMembers)
+        finally:
+            self._lock.release()
+
+        cacheTime = time.time()
+        d = asyncGetMemberships(ldapConnection, missing, fetchMembers)
+        d.addCallback(self._cbAsyncGetMemberships, groupFilters, missing, fetchMembers, cacheTime, memberships)
+        return d
+
+    def _cbAsyncGetMemberships(self, fetched, groupFilters, missing, fetchMembers, cacheTime, memberships):
+        self._lock.acquire()
+        try:
+            self._store(missing, fetched, fetchMembers, cacheTime, memberships)
+        finally:
+            self._lock.release()
+        return [memberships[self._key(groupFilter)] for groupFilter in groupFilters]
+
+    def _lookup(self, groupFilters, fetchMembers):
+        """
+        Returns the current cached memberships, keyed by cache key, and
+        the group filters whose memberships must be fetched.
+        """
+        memberships = {}
+        missing = []
+        missingKeys = set()
+        for groupFilter in groupFilters:
+            key = self._key(groupFilter)
+            if (self._cache.has_key(key)):
+                cacheTime, hasMembers, membership = self._cache[key]
+                # A membership fetched without members can not satisfy
+                # a request for members
+                if (time.time() - cacheTime < self.ttl and (hasMembers or not fetchMembers)):
+                    memberships[key] = membership
+                    continue
+            if (not key in missingKeys):
+                missingKeys.add(key)
+                missing.append(groupFilter)
+        return (memberships, missing)
+
+    def _store(self, missing, fetched, fetchMembers, cacheTime, memberships):
+        """
+        Cache the fetched memberships of the missing group filters, adding
+        them to memberships.
+        """
+        for groupFilter, membership in zip(missing, fetched):
+            key = self._key(groupFilter)
+            memberships[key] = membership
+            self._cache[key] = (cacheTime, fetchMembers, membership)
+
+    def _key(self, groupFilter):
+        return (normalizeDN(groupFilter.baseDN), groupFilter.scope, groupFilter.filter,
+                groupFilter.memberAttribute.lower(), groupFilter.nested)
+
+    def clear(self):
+        """
+        Discard all cached memberships.
+        """
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+class SyncReplConsumer(object):
+    """
+    RFC 4533 Content Synchronization consumer. Maintains a persistent
+    refreshAndPersist search, and the synchronization cookie required
+    to resume it.
+    """
+    def __init__(self, ldapConnection, baseDN, scope, filter, attributes=None, cookie=None):
+        """
+        Initialize a new content synchronization consumer.
+        @param ldapConnection: A valid LDAP Connection instance
+        @param baseDN: LDAP search base
+        @param scope: LDAP search scope
+        @param filter: LDAP search filter
+        @param attributes: Attributes to return. None causes all attributes to be returned. Defaults to None.
+        @param cookie: Synchronization cookie returned by a previous session, if any.
+        """
+        if (syncrepl == None):
+            raise LDAPUtilsClientError, "Content synchronization requires python-ldap syncrepl support"
+
+        self.ldapConnection = ldapConnection
+        self.baseDN = baseDN
+        self.scope = scope
+        self.filter = filter
+        self.attributes = attributes
+        self.cookie = cookie
+        # True once the initial refresh phase has completed
+        self.refreshDone = False
+        self._msgid = None
+        # Connection to the server handling the persistent search
+        self._conn = None
+
+    def start(self):
+        """
+        Issue the refreshAndPersist search, resuming from the current cookie.
+        """
+        control = syncrepl.SyncRequestControl(cookie=self.cookie, mode='refreshAndPersist')
+        self.refreshDone = False
+        self._conn = self.ldapConnection.pinnedConnection()
+        self._msgid = self._conn._ldap.search_ext(self.baseDN, self.scope, self.filter, self.attributes, serverctrls=[control])
+
+    def stop(self):
+        """
+        Abandon the persistent search.
+        """
+        if (self._msgid != None):
+            msgid = self._msgid
+            self._msgid = None
+            self._conn._ldap.abandon(msgid)
+
+    def poll(self):
+        """
+        Collect any changes sent by the server, without blocking. If the
+        server has ended the persistent search, it is re-issued.
+        Returns a list of added or modified Entry objects.
+        """
+        if (self._msgid == None):
+            self.start()
+
+        entries = []
+        while 1:
+            try:
+                result_type, result_data, result_msgid, result_controls, result_name, result_value = self._conn._ldap.result4(self._msgid, 0, 0, add_ctrls=1, add_intermediates=1)
+            except CONNECTION_ERRORS:
+                # Resume from our cookie on another server, if possible
+                if (not self.ldapConnection.connectionFailed(self._conn)):
+                    raise
+                self._msgid = None
+                break
+
+            # Nothing pending
+            if (result_type == None):
+                break
+
+            if (result_type == ldap.RES_SEARCH_ENTRY):
+                for dn, attrs, controls in result_data:
+                    for control in controls:
+                        if (not isinstance(control, syncrepl.SyncStateControl)):
+                            continue
+                        # Deleted entries are of no interest to helpers, and
+                        # present entries have not changed.
+                        if (control.state in ('add', 'modify')):
+                            entries.append(Entry(dn, attrs))
+                        if (control.cookie != None):
+                            self.cookie = control.cookie
+                        break
+
+            elif (result_type == ldap.RES_INTERMEDIATE):
+                for name, value, controls in result_data:
+                    if (name != syncrepl.SyncInfoMessage.responseName):
+                        continue
+                    self._handleSyncInfo(syncrepl.SyncInfoMessage(value))
+
+            elif (result_type == ldap.RES_SEARCH_RESULT):
+                # The server has ended the session. Save the final cookie,
+                # and resume on the next poll.
+                for control in result_controls:
+                    if (isinstance(control, syncrepl.SyncDoneControl) and control.cookie != None):
+                        self.cookie = control.cookie
+                self._msgid = None
+                break
+
+        return entries
+
+    def _handleSyncInfo(self, message):
+        """
+        Process a Sync Info intermediate response.
+        """
+        if (message.newcookie != None):
+            self.cookie = message.newcookie
+            return
+
+        for phase in (message.refreshDelete, message.refreshPresent, message.syncIdSet):
+            if (phase == None):
+                continue
+            if (phase.get('cookie') != None):
+                self.cookie = phase['cookie']
+            if (phase.get('refreshDone')):
+                self.refreshDone = True
+
+def _renamedDN(dn, newRDN, newSuperior=None):
+    """
+    Return the DN given to an entry by a modrdn operation.
+    @param dn: Distinguished name of the entry before it was renamed.
+    @param newRDN: New relative distinguished name.
+    @param newSuperior: Distinguished name of the entry's new parent. If None, the entry's parent is unchanged.
+    """
+    if (newSuperior == None):
+        newSuperior = ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:])
+    if (newSuperior == ''):
+        return newRDN
+    return newRDN + ',' + newSuperior
+
+class ChangeLogConsumer(object):
+    """
+    Reads the DNs of modified entries from a server-side change log; either
+    an OpenLDAP accesslog database, or a retro change log.
+    """
+    # Period, in seconds, searched for the newest accesslog change when
+    # the log's suffix entry does not record one. Changes logged earlier
+    # are not read, allowing for our clock being ahead of the server's.
+    positionWindow = 86400
+
+    def __init__(self, ldapConnection, baseDN, format=CHANGELOG_ACCESSLOG, position=None):
+        """
+        Initialize a new change log consumer.
+        @param ldapConnection: A valid LDAP Connection instance
+        @param baseDN: Change log suffix; eg, cn=accesslog or cn=changelog.
+        @param format: Change log format. One of CHANGELOG_FORMATS. Defaults to CHANGELOG_ACCESSLOG.
+        @param position: Resume point returned by a previous consumer. If None, only changes logged from now on are read.
+        """
+        if (format not in CHANGELOG_FORMATS):
+            raise LDAPUtilsClientError, "Unknown change log format '%s'" % format
+
+        # Change log positions are specific to a single server
+        self.ldapConnection = ldapConnection.pinnedConnection()
+        self.baseDN = baseDN
+        self.format = format
+        if (position == None):
+            position = self._currentPosition()
+        # Last seen reqEnd (accesslog) or changeNumber (changelog)
+        self.position = position
+
+    def _currentPosition(self):
+        """
+        Determine the position of the most recent change log entry.
+        """
+        if (self.format == CHANGELOG_ACCESSLOG):
+            # Use the server's position, rather than our own clock, which
+            # may be ahead of the server's. Replicated logs record the CSN
+            # of the newest change on their suffix entry; CSNs begin with
+            # the time of the change.
+            suffix = self.ldapConnection.search(self.baseDN, ldap.SCOPE_BASE, '(objectClass=*)', ['contextCSN'])
+            if (len(suffix) > 0 and suffix[0].attributes.has_key('contextCSN')):
+                return max([csn.split('#')[0] for csn in suffix[0].attributes['contextCSN']])
+
+            # Otherwise, find the newest reqEnd among recent changes
+            position = time.strftime('%Y%m%d%H%M%S.000000Z', time.gmtime(time.time() - self.positionWindow))
+            filter = '(&(objectClass=auditWriteObject)(reqEnd>=%s))' % position
+            for entry in self.ldapConnection.iterSearch(self.baseDN, ldap.SCOPE_ONELEVEL, filter, ['reqEnd']):
+                if (entry.attributes.has_key('reqEnd')):
+                    position = max(position, entry.attributes['reqEnd'][0])
+            return position
+
+        # Retro change log servers publish the last change number in the root DSE
+        rootDSE = self.ldapConnection.search('', ldap.SCOPE_BASE, '(objectClass=*)', ['lastChangeNumber'])
+        if (len(rootDSE) > 0 and rootDSE[0].attributes.has_key('lastChangeNumber')):
+            return rootDSE[0].attributes['lastChangeNumber'][0]
+        return '0'
+
+    def poll(self):
+        """
+        Read all changes logged since the current position, and advance the
+        position past them. Returns the DNs of the modified entries, in the
+        order they were modified, omitting duplicates.
+        """
+        filter, attributes = self._pollSearch()
+        return self._changes(self.ldapConnection.iterSearch(self.baseDN, ldap.SCOPE_ONELEVEL, filter, attributes))
+
+    def asyncPoll(self):
+        """
+        Read changes without blocking, as per poll(). Must be called from
+        the reactor thread.
+        @result Returns a Deferred whose callback is invoked with the DNs of the modified entries.
+        """
+        filter, attributes = self._pollSearch()
+        d = self.ldapConnection.asyncSearch(self.baseDN, ldap.SCOPE_ONELEVEL, filter, attributes)
+        d.addCallback(self._changes)
+        return d
+
+    def _pollSearch(self):
+        """
+        Returns the filter and attributes of the search for changes logged
+        since the current position.
+        """
+        if (self.format == CHANGELOG_ACCESSLOG):
+            filter = '(&(objectClass=auditWriteObject)(reqResult=0)(reqEnd>=%s))' % self.position
+            return (filter, ['reqEnd', 'reqDN', 'reqNewRDN', 'reqNewSuperior'])
+        filter = '(changeNumber>=%d)' % (int(self.position) + 1)
+        return (filter, ['changeNumber', 'targetDN', 'newRDN', 'newSuperior'])
+
+    def _changes(self, entries):
+        """
+        Advance the position past the supplied change log entries, and
+        return the DNs they name.
+        """
+        positionAttr, targetAttr, newRDNAttr, newSuperiorAttr = self._pollSearch()[1]
+        changes = []
+        for entry in entries:
+            if (not entry.attributes.has_key(positionAttr) or not entry.attributes.has_key(targetAttr)):
+                continue
+            position = entry.attributes[positionAttr][0]
+
+            # reqEnd values are fixed-width, and sort lexically. The
+            # search filter is inclusive, so skip entries we have seen.
+            if (self.format == CHANGELOG_ACCESSLOG):
+                if (position <= self.position):
+                    continue
+                key = position
+            else:
+                key = int(position)
+            dn = entry.attributes[targetAttr][0]
+            changes.append((key, position, dn))
+
+            # Renamed entries are logged under their old DN
+            if (entry.attributes.has_key(newRDNAttr)):
+                newSuperior = None
+                if (entry.attributes.has_key(newSuperiorAttr)):
+                    newSuperior = entry.attributes[newSuperiorAttr][0]
+                changes.append((key, position, _renamedDN(dn, entry.attributes[newRDNAttr][0], newSuperior)))
+
+        # Servers are not required to return entries in any particular order
+        changes.sort()
+
+        result = []
+        seen = {}
+        for key, position, dn in changes:
+            self.position = position
+            normalized = normalizeDN(dn)
+            if (not seen.has_key(normalized)):
+                seen[normalized] = True
+                result.append(dn)
+
+        return result
+
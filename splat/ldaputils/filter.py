@@ -0,0 +1,347 @@
+# filter.py vi:ts=4:sw=4:expandtab:
+#
+# LDAP search filter support.
+# Authors:
+#       Landon Fuller <landonf@threerings.net>
+#       Will Barton <wbb4@opendarwin.org>
+#
+# Copyright (c) 2005 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+RFC 4515 search filter parser, allowing search filters to be evaluated
+against entries that have already been retrieved from the LDAP server.
+
+Values are compared case-insensitively, approximating the caseIgnore
+matching rules used by the majority of directory attributes. Ordering
+comparisons between integer values are numeric. Extensible match
+filters are not supported.
+"""
+
+class LDAPUtilsFilterError(Exception):
+    pass
+
+def parse(filter):
+    """
+    Parse an RFC 4515 search filter string.
+    @param filter: LDAP search filter. The enclosing parentheses may be omitted.
+    @result Returns a Filter instance.
+    """
+    if (not filter.startswith('(')):
+        filter = '(%s)' % filter
+
+    parser = _Parser(filter)
+    result = parser.parseFilter()
+    if (parser.pos != len(filter)):
+        raise LDAPUtilsFilterError, "Unexpected trailing characters in filter '%s'" % filter
+    return result
+
+class Filter(object):
+    """
+    Abstract search filter
+    """
+    def matches(self, entry):
+        """
+        Returns True if the entry matches the filter.
+        @param entry: ldaputils.client.Entry instance
+        """
+        raise NotImplementedError, \
+                "This method is not implemented in this abstract class"
+
+    def attributes(self):
+        """
+        Returns the list of attribute types the filter is evaluated against.
+        """
+        return [self.attribute]
+
+class AndFilter(Filter):
+    def __init__(self, filters):
+        self.filters = filters
+
+    def attributes(self):
+        return _unionAttributes(self.filters)
+
+    def matches(self, entry):
+        for filter in self.filters:
+            if (not filter.matches(entry)):
+                return False
+        return True
+
+class OrFilter(Filter):
+    def __init__(self, filters):
+        self.filters = filters
+
+    def attributes(self):
+        return _unionAttributes(self.filters)
+
+    def matches(self, entry):
+        for filter in self.filters:
+            if (filter.matches(entry)):
+                return True
+        return False
+
+class NotFilter(Filter):
+    def __init__(self, filter):
+        self.filter = filter
+
+    def attributes(self):
+        return self.filter.attributes()
+
+    def matches(self, entry):
+        return not self.filter.matches(entry)
+
+class PresenceFilter(Filter):
+    def __init__(self, attribute):
+        self.attribute = attribute
+
+    def matches(self, entry):
+        return len(_getValues(entry, self.attribute)) > 0
+
+class EqualityFilter(Filter):
+    def __init__(self, attribute, value):
+        self.attribute = attribute
+        self.value = _normalize(value)
+
+    def matches(self, entry):
+        for value in _getValues(entry, self.attribute):
+            if (_normalize(value) == self.value):
+                return True
+        return False
+
+class GreaterOrEqualFilter(Filter):
+    def __init__(self, attribute, value):
+        self.attribute = attribute
+        self.value = value
+
+    def matches(self, entry):
+        for value in _getValues(entry, self.attribute):
+            if (_compare(value, self.value) >= 0):
+                return True
+        return False
+
+class LessOrEqualFilter(Filter):
+    def __init__(self, attribute, value):
+        self.attribute = attribute
+        self.value = value
+
+    def matches(self, entry):
+        for value in _getValues(entry, self.attribute):
+            if (_compare(value, self.value) <= 0):
+                return True
+        return False
+
+class SubstringFilter(Filter):
+    def __init__(self, attribute, initial, any, final):
+        """
+        @param attribute: Attribute name
+        @param initial: Leading substring, or None
+        @param any: List of intermediate substrings
+        @param final: Trailing substring, or None
+        """
+        self.attribute = attribute
+        self.initial = initial
+        if (initial != None):
+            self.initial = _normalize(initial)
+        self.any = [_normalize(substring) for substring in any]
+        self.final = final
+        if (final != None):
+            self.final = _normalize(final)
+
+    def matches(self, entry):
+        for value in _getValues(entry, self.attribute):
+            if (self._matchesValue(_normalize(value))):
+                return True
+        return False
+
+    def _matchesValue(self, value):
+        start = 0
+        end = len(value)
+        if (self.initial != None):
+            if (not value.startswith(self.initial)):
+                return False
+            start = len(self.initial)
+
+        if (self.final != None):
+            if (not value.endswith(self.final) or end - len(self.final) < start):
+                return False
+            end = end - len(self.final)
+
+        for substring in self.any:
+            index = value.find(substring, start, end)
+            if (index == -1):
+                return False
+            start = index + len(substring)
+
+        return True
+
+class _Parser(object):
+    """
+    Recursive descent parser for the RFC 4515 filter grammar.
+    """
+    def __init__(self, filter):
+        self.filter = filter
+        self.pos = 0
+
+    def _error(self, message):
+        raise LDAPUtilsFilterError, "%s at position %d of filter '%s'" % (message, self.pos, self.filter)
+
+    def _peek(self):
+        if (self.pos >= len(self.filter)):
+            self._error("Unexpected end of filter")
+        return self.filter[self.pos]
+
+    def _expect(self, char):
+        if (self._peek() != char):
+            self._error("Expected '%s'" % char)
+        self.pos = self.pos + 1
+
+    def parseFilter(self):
+        self._expect('(')
+        char = self._peek()
+        if (char == '&'):
+            self.pos = self.pos + 1
+            result = AndFilter(self._parseFilterList())
+        elif (char == '|'):
+            self.pos = self.pos + 1
+            result = OrFilter(self._parseFilterList())
+        elif (char == '!'):
+            self.pos = self.pos + 1
+            result = NotFilter(self.parseFilter())
+        else:
+            result = self._parseItem()
+        self._expect(')')
+        return result
+
+    def _parseFilterList(self):
+        # An empty list is an absolute true or false filter (RFC 4526)
+        filters = []
+        while (self._peek() == '('):
+            filters.append(self.parseFilter())
+        return filters
+
+    def _parseItem(self):
+        # Attribute description
+        start = self.pos
+        while (self._peek() not in '=~<>:()'):
+            self.pos = self.pos + 1
+        attribute = self.filter[start:self.pos]
+        if (len(attribute) == 0):
+            self._error("Expected an attribute description")
+
+        # Filter type
+        char = self._peek()
+        if (char == ':'):
+            self._error("Extensible match filters are not supported")
+        elif (char in '~<>'):
+            self.pos = self.pos + 1
+            self._expect('=')
+        elif (char == '='):
+            self.pos = self.pos + 1
+        else:
+            self._error("Expected a filter type")
+
+        # Assertion value, split on unescaped asterisks
+        start = self.pos
+        while (self._peek() != ')'):
+            if (self._peek() == '('):
+                self._error("Unescaped '(' in assertion value")
+            self.pos = self.pos + 1
+        substrings = [self._unescape(value) for value in self.filter[start:self.pos].split('*')]
+
+        if (char == '='):
+            if (substrings == ['', '']):
+                return PresenceFilter(attribute)
+            elif (len(substrings) > 1):
+                initial = substrings[0] or None
+                final = substrings[-1] or None
+                any = [substring for substring in substrings[1:-1] if substring]
+                return SubstringFilter(attribute, initial, any, final)
+            else:
+                return EqualityFilter(attribute, substrings[0])
+
+        if (len(substrings) > 1):
+            self._error("Unescaped '*' in assertion value")
+        if (char == '~'):
+            # Approximate matching is server-defined; use equality
+            return EqualityFilter(attribute, substrings[0])
+        elif (char == '>'):
+            return GreaterOrEqualFilter(attribute, substrings[0])
+        else:
+            return LessOrEqualFilter(attribute, substrings[0])
+
+    def _unescape(self, value):
+        # Values escape special characters as a backslash followed by two
+        # hexadecimal digits
+        result = []
+        i = 0
+        while (i < len(value)):
+            if (value[i] == '\\'):
+                digits = value[i + 1:i + 3]
+                if (len(digits) != 2 or digits.strip('0123456789abcdefABCDEF') != ''):
+                    self._error("Invalid escape sequence '%s'" % value[i:i + 3])
+                result.append(chr(int(digits, 16)))
+                i = i + 3
+            else:
+                result.append(value[i])
+                i = i + 1
+        return ''.join(result)
+
+def _unionAttributes(filters):
+    result = []
+    for filter in filters:
+        for attribute in filter.attributes():
+            if (attribute.lower() not in [attr.lower() for attr in result]):
+                result.append(attribute)
+    return result
+
+def _getValues(entry, attribute):
+    """
+    Case-insensitively look up the values of an entry's attribute.
+    Returns an empty list if the attribute is not present.
+    """
+    attribute = attribute.lower()
+    for key, values in entry.attributes.iteritems():
+        if (key.lower() == attribute):
+            return values
+    return []
+
+def _normalize(value):
+    """
+    Normalize a value for case-insensitive comparison, ignoring
+    insignificant whitespace.
+    """
+    return ' '.join(value.lower().split())
+
+def _compare(value, assertion):
+    """
+    Compare an attribute value with an assertion value, numerically if
+    both are integers.
+    """
+    try:
+        return cmp(int(value), int(assertion))
+    except ValueError:
+        return cmp(_normalize(value), _normalize(assertion))
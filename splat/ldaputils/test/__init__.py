@@ -33,7 +33,7 @@
 
 import os
 
-__all__ = ['test_client']
+__all__ = ['test_client', 'test_filter']
 
 # Useful Constants
 INSTALL_DIR = os.path.dirname(__file__)
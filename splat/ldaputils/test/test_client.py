@@ -35,9 +35,11 @@
 """ LDAP Unit Tests """
 
 from twisted.trial import unittest
-import ldap
+from twisted.internet import defer, task
+import ldap, time
 
 from splat.ldaputils import client as ldapclient
+from splat.ldaputils import filter as ldapfilter
 
 # Useful Constants
 from splat.ldaputils.test import DATA_DIR
@@ -80,11 +82,49 @@ class ConnectionTestCase(unittest.TestCase):
         result = self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', ['uid',])
         self.assertEquals(result[0].attributes['uid'][0], 'john')
 
+    def test_iterSearch(self):
+        result = self.conn.iterSearch(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', ['uid',])
+        entries = list(result)
+        self.assertEquals(len(entries), 1)
+        self.assertEquals(entries[0].attributes['uid'][0], 'john')
+
+    def test_pagedSearch(self):
+        # Fetch every entry a page at a time, and ensure the paged results
+        # match the results of an unpaged search.
+        expected = [entry.dn for entry in self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(objectClass=*)', ['dn',])]
+        result = [entry.dn for entry in self.conn.iterSearch(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(objectClass=*)', ['dn',], pageSize=2)]
+        self.assertEquals(result, expected)
+
+        # The connection's default page size should be used, too.
+        self.conn.pageSize = 3
+        result = [entry.dn for entry in self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(objectClass=*)', ['dn',])]
+        self.assertEquals(result, expected)
+
     def test_compare(self):
         result = self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', [])
         self.assertEquals(self.conn.compare(result[0].dn, 'uid', 'john'), True)
         self.assertNotEqual(self.conn.compare(result[0].dn, 'uid', 'fred'), True)
 
+    def test_searchMany(self):
+        searches = [
+            (slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', ['uid',]),
+            ('uid=nobody,ou=People,dc=example,dc=com', ldap.SCOPE_BASE, '(objectClass=*)', ['uid',]),
+            (slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=sally)', ['uid',]),
+        ]
+        # Results are returned in order, with at most one search outstanding,
+        # and with all searches outstanding.
+        for depth in (1, None):
+            result = self.conn.searchMany(searches, depth)
+            self.assertEquals(len(result), 3)
+            self.assertEquals(result[0][0].attributes['uid'][0], 'john')
+            self.assertEquals(result[1], None)
+            self.assertEquals(result[2][0].attributes['uid'][0], 'sally')
+
+    def test_compareMany(self):
+        dn = self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', [])[0].dn
+        compares = [(dn, 'uid', 'john'), (dn, 'uid', 'fred'), (dn, 'uid', 'john')]
+        self.assertEquals(self.conn.compareMany(compares, 2), [True, False, True])
+
     def test_modify(self):
         # Acquire write privs
         self.conn.simple_bind(slapd.ROOTDN, slapd.ROOTPW)
@@ -129,6 +169,180 @@ class ConnectionTestCase(unittest.TestCase):
         self.assert_(not entry.attributes.has_key('loginShell'))
 
 
+class DeadConnection(object):
+    """ Connection to a server that has gone away """
+    def _fail(self, *args):
+        raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+    iterSearch = search = compare = modify = whoami = _fail
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    """ Test LDAP Connection Pool """
+    def setUp(self):
+        self.slapd = slapd.LDAPServer()
+        # Nothing listens on the last server
+        self.pool = ldapclient.ConnectionPool([slapd.SLAPD_URI, slapd.SLAPD_URI, 'ldap://127.0.0.1:1/'])
+        self.pool.simple_bind(slapd.ROOTDN, slapd.ROOTPW)
+
+    def tearDown(self):
+        self.slapd.stop()
+
+    def test_bind(self):
+        # Unavailable servers are skipped
+        self.assertNotEqual(self.pool.members[0].conn, None)
+        self.assertNotEqual(self.pool.members[1].conn, None)
+        self.assertEquals(self.pool.members[2].conn, None)
+
+        # Unless no server is available
+        pool = ldapclient.ConnectionPool(['ldap://127.0.0.1:1/'])
+        self.assertRaises(ldap.SERVER_DOWN, pool.simple_bind, slapd.ROOTDN, slapd.ROOTPW)
+
+    def test_search(self):
+        result = self.pool.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)')
+        self.assertEquals(len(result), 1)
+        self.assertEquals(result[0].dn, 'uid=john,ou=People,dc=example,dc=com')
+
+    def test_failover(self):
+        member = self.pool.members[0]
+        member.conn = DeadConnection()
+
+        # Modifications are sent to the first server, and fail over to the next
+        entry = self.pool.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)')[0]
+        mod = ldapclient.Modification(entry.dn)
+        mod.replace('description', 'Failed over')
+        self.pool.modify(mod)
+        self.assertEquals(member.conn, None)
+
+        result = self.pool.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', ['description'])
+        self.assertEquals(result[0].attributes['description'], ['Failed over'])
+
+        # The failed server is reconnected once its retry interval has elapsed
+        self.pool.checkHealth()
+        self.assertEquals(member.conn, None)
+        member.retryTime = 0
+        self.pool.checkHealth()
+        self.assertNotEqual(member.conn, None)
+        self.assertNotEqual(member.latency, None)
+
+    def test_pinnedConnection(self):
+        self.assert_(self.pool.pinnedConnection() is self.pool.members[0].conn)
+
+        # The next server is used once the first fails
+        conn = self.pool.pinnedConnection()
+        self.assertEquals(self.pool.connectionFailed(conn), True)
+        self.assert_(self.pool.pinnedConnection() is self.pool.members[1].conn)
+
+class TwistedConnectionTestCase(unittest.TestCase):
+    """ Test Non-Blocking LDAP Connection """
+    def setUp(self):
+        self.slapd = slapd.LDAPServer()
+        self.conn = ldapclient.TwistedConnection(slapd.SLAPD_URI)
+        self.conn.simple_bind(slapd.ROOTDN, slapd.ROOTPW)
+
+    def tearDown(self):
+        self.slapd.stop()
+
+    def _cbSearch(self, result):
+        self.assertEquals(len(result), 1)
+        self.assertEquals(result[0].attributes['uid'][0], 'john')
+
+    def test_asyncSearch(self):
+        d = self.conn.asyncSearch(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', ['uid',])
+        d.addCallback(self._cbSearch)
+        return d
+
+    def _cbPagedSearch(self, result, expected):
+        self.assertEquals([entry.dn for entry in result], expected)
+
+    def test_pagedSearch(self):
+        expected = [entry.dn for entry in self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(objectClass=*)', ['dn',])]
+        d = self.conn.asyncSearch(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(objectClass=*)', ['dn',], pageSize=2)
+        d.addCallback(self._cbPagedSearch, expected)
+        return d
+
+    def test_searchFailure(self):
+        d = self.conn.asyncSearch('ou=Nonexistent,dc=example,dc=com', ldap.SCOPE_SUBTREE, '(uid=john)')
+        return self.assertFailure(d, ldap.NO_SUCH_OBJECT)
+
+    def _consume(self, search, entries):
+        # Wait for the search whenever it has no entries available
+        for entry in search:
+            if (isinstance(entry, defer.Deferred)):
+                yield entry
+                continue
+            # No more than a page of entries is held
+            self.assert_(len(search.entries) < 2)
+            entries.append(entry)
+
+    def _cbIterSearch(self, result, entries, expected):
+        self.assertEquals([entry.dn for entry in entries], expected)
+
+    def test_asyncIterSearch(self):
+        expected = [entry.dn for entry in self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(objectClass=*)', ['dn',])]
+        self.assert_(len(expected) > 2)
+        search = self.conn.asyncIterSearch(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(objectClass=*)', ['dn',], pageSize=2)
+        entries = []
+        d = task.cooperate(self._consume(search, entries)).whenDone()
+        d.addCallback(self._cbIterSearch, entries, expected)
+        return d
+
+    def test_iterSearchFailure(self):
+        search = self.conn.asyncIterSearch('ou=Nonexistent,dc=example,dc=com', ldap.SCOPE_SUBTREE, '(uid=john)', pageSize=2)
+        d = task.cooperate(self._consume(search, [])).whenDone()
+        return self.assertFailure(d, ldap.NO_SUCH_OBJECT)
+
+    def _cbSearchMany(self, result):
+        self.assertEquals(len(result), 3)
+        self.assertEquals([entry.attributes['uid'][0] for entry in result[0]], ['john'])
+        self.assertEquals(result[1], None)
+        self.assertEquals([entry.attributes['uid'][0] for entry in result[2]], ['sally'])
+
+    def test_asyncSearchMany(self):
+        searches = [
+            ('uid=john,ou=People,dc=example,dc=com', ldap.SCOPE_BASE, '(objectClass=*)', ['uid']),
+            ('uid=nobody,ou=People,dc=example,dc=com', ldap.SCOPE_BASE, '(objectClass=*)', ['uid']),
+            ('uid=sally,ou=People,dc=example,dc=com', ldap.SCOPE_BASE, '(objectClass=*)', ['uid'])
+        ]
+        d = self.conn.asyncSearchMany(searches, depth=2)
+        d.addCallback(self._cbSearchMany)
+        return d
+
+    def _cbGetMemberships(self, memberships):
+        self.assertEquals(len(memberships), 3)
+        self.assert_(memberships[0].isMember('uid=john,ou=People,dc=example,dc=com'))
+        self.assert_(not memberships[1].isMember('uid=john,ou=People,dc=example,dc=com'))
+        self.assert_(memberships[2].isMember('uid=sally,ou=People,dc=example,dc=com'))
+
+    def test_asyncGetMemberships(self):
+        developers = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=developers))')
+        administrators = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))')
+        nested = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))', nested=True)
+        d = ldapclient.asyncGetMemberships(self.conn, [developers, administrators, nested])
+        d.addCallback(self._cbGetMemberships)
+        return d
+
+    def _cbCompare(self, result):
+        self.assertEquals(result, [True, False])
+
+    def test_asyncCompare(self):
+        dn = self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', [])[0].dn
+        d = defer.gatherResults([self.conn.asyncCompare(dn, 'uid', 'john'), self.conn.asyncCompare(dn, 'uid', 'fred')])
+        d.addCallback(self._cbCompare)
+        return d
+
+    def _cbModify(self, result, dn):
+        entry = self.conn.search(dn, ldap.SCOPE_BASE, '(objectClass=*)', ['description',])[0]
+        self.assertEquals(entry.attributes['description'], ['Test'])
+
+    def test_asyncModify(self):
+        dn = self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', [])[0].dn
+        mod = ldapclient.Modification(dn)
+        mod.replace('description', 'Test')
+        d = self.conn.asyncModify(mod)
+        d.addCallback(self._cbModify, dn)
+        return d
+
+
 class EntryTestCase(unittest.TestCase):
     """ Test LDAP Entry Objects """
     def setUp(self):
@@ -206,3 +420,360 @@ class GroupFilterTestCase(unittest.TestCase):
         # Try with a custom matching attribute
         filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfNames)(cn=notunique))', 'member')
         self.assert_(filter.isMember(self.conn, self.entry.dn))
+
+    def test_getMembership(self):
+        # Matching member
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=developers))')
+        membership = filter.getMembership(self.conn)
+        self.assert_(membership.isMember(self.entry.dn))
+        # DNs are compared in normalized form
+        self.assert_(membership.isMember('UID=John, ou=People,dc=example,dc=com'))
+        self.assertEquals(membership.groups, set(['cn=developers,ou=groups,dc=example,dc=com']))
+
+        # The group modification time should be known
+        self.assertNotEqual(membership.modTime, None)
+        self.assert_(membership.isModified(0))
+        self.assert_(not membership.isModified(membership.modTime + 1))
+
+        # Should not match
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))')
+        self.assert_(not filter.getMembership(self.conn).isMember(self.entry.dn))
+
+        # Try with a custom matching attribute
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfNames)(cn=notunique))', 'member')
+        self.assert_(filter.getMembership(self.conn).isMember(self.entry.dn))
+
+    def test_getMemberships(self):
+        developers = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=developers))')
+        administrators = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))')
+        notunique = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfNames)(cn=notunique))', 'member')
+
+        memberships = ldapclient.getMemberships(self.conn, [developers, administrators, notunique])
+        self.assertEquals(len(memberships), 3)
+        self.assert_(memberships[0].isMember(self.entry.dn))
+        self.assert_(not memberships[1].isMember(self.entry.dn))
+        self.assert_(memberships[2].isMember(self.entry.dn))
+        self.assertEquals(memberships[0].groups, developers.getMembership(self.conn).groups)
+
+        # Group DNs alone
+        memberships = ldapclient.getMemberships(self.conn, [developers], False)
+        self.assertEquals(memberships[0].members, set())
+        self.assertEquals(memberships[0].groups, set(['cn=developers,ou=groups,dc=example,dc=com']))
+
+
+    def test_nestedMembership(self):
+        # Nest developers within administrators, and administrators within
+        # developers, creating a cycle.
+        self.conn.simple_bind(slapd.ROOTDN, slapd.ROOTPW)
+        mod = ldapclient.Modification('cn=administrators,ou=Groups,dc=example,dc=com')
+        mod.add('uniqueMember', 'cn=developers,ou=Groups,dc=example,dc=com')
+        self.conn.modify(mod)
+        mod = ldapclient.Modification('cn=developers,ou=Groups,dc=example,dc=com')
+        mod.add('uniqueMember', 'cn=administrators,ou=Groups,dc=example,dc=com')
+        self.conn.modify(mod)
+
+        # Direct members only
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))')
+        self.assert_(not filter.getMembership(self.conn).isMember(self.entry.dn))
+
+        # Let the group modifications age, so they are not seen as newer than
+        # the cached membership.
+        time.sleep(1)
+
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))', nested=True)
+        membership = filter.getMembership(self.conn)
+        self.assert_(membership.isMember(self.entry.dn))
+        self.assert_(membership.isMember('uid=sally,ou=People,dc=example,dc=com'))
+        self.assertEquals(len(membership.groups), 2)
+
+        # Unmodified groups are served from the cache
+        self.assert_(filter.getMembership(self.conn) is membership)
+
+        # Modifying a group invalidates the cache
+        mod = ldapclient.Modification('cn=developers,ou=Groups,dc=example,dc=com')
+        mod.delete('uniqueMember', 'uid=john,ou=People,dc=example,dc=com')
+        self.conn.modify(mod)
+        membership = filter.getMembership(self.conn)
+        self.assert_(not membership.isMember(self.entry.dn))
+
+    def test_nestedMembershipDeletedGroup(self):
+        # Nest developers within administrators
+        self.conn.simple_bind(slapd.ROOTDN, slapd.ROOTPW)
+        mod = ldapclient.Modification('cn=administrators,ou=Groups,dc=example,dc=com')
+        mod.add('uniqueMember', 'cn=developers,ou=Groups,dc=example,dc=com')
+        self.conn.modify(mod)
+
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))', nested=True)
+        self.assert_(filter.getMembership(self.conn).isMember(self.entry.dn))
+
+        # Deleting the nested group, which modifies no other group,
+        # invalidates the cache
+        self.conn._ldap.delete_s('cn=developers,ou=Groups,dc=example,dc=com')
+        self.assert_(not filter.getMembership(self.conn).isMember(self.entry.dn))
+
+
+class GroupCacheTestCase(unittest.TestCase):
+    """ Test Shared Group Caches """
+    def setUp(self):
+        self.slapd = slapd.LDAPServer()
+        self.conn = ldapclient.Connection(slapd.SLAPD_URI)
+
+    def tearDown(self):
+        self.slapd.stop()
+
+    def test_getMembership(self):
+        cache = ldapclient.GroupCache(60)
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=developers))')
+        membership = cache.getMembership(filter, self.conn)
+        self.assert_(membership.isMember('uid=john,ou=People,dc=example,dc=com'))
+
+        # Equivalent filters share the cached membership
+        other = ldapclient.GroupFilter(slapd.BASEDN.upper(), ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=developers))', 'UNIQUEMEMBER')
+        self.assert_(cache.getMembership(other, self.conn) is membership)
+        self.assert_(cache.getMembership(other, self.conn, False) is membership)
+
+        # Memberships fetched without members are not re-used when
+        # members are requested
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))')
+        membership = cache.getMembership(filter, self.conn, False)
+        self.assert_(cache.getMembership(filter, self.conn) is not membership)
+
+        # Clearing the cache forces a fetch
+        membership = cache.getMembership(filter, self.conn)
+        cache.clear()
+        self.assert_(cache.getMembership(filter, self.conn) is not membership)
+
+    def test_getMemberships(self):
+        cache = ldapclient.GroupCache(60)
+        developers = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=developers))')
+        administrators = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))')
+        membership = cache.getMembership(developers, self.conn)
+
+        # Cached memberships are re-used, and the rest fetched
+        memberships = cache.getMemberships([developers, administrators, developers], self.conn)
+        self.assert_(memberships[0] is membership)
+        self.assert_(memberships[2] is membership)
+        self.assert_(not memberships[1].isMember('uid=john,ou=People,dc=example,dc=com'))
+        self.assert_(cache.getMembership(administrators, self.conn) is memberships[1])
+
+    def test_disabled(self):
+        cache = ldapclient.GroupCache(0)
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=developers))')
+        membership = cache.getMembership(filter, self.conn)
+        self.assert_(cache.getMembership(filter, self.conn) is not membership)
+
+
+class SearchSnapshotTestCase(unittest.TestCase):
+    """ Test Shared Search Snapshots """
+    def setUp(self):
+        self.slapd = slapd.LDAPServer()
+        self.conn = ldapclient.Connection(slapd.SLAPD_URI)
+
+    def tearDown(self):
+        self.slapd.stop()
+
+    def test_search(self):
+        snapshot = ldapclient.SearchSnapshot(slapd.BASEDN, ldap.SCOPE_SUBTREE, 60)
+        john = snapshot.addSearch('(uid=john)', ('uid',))
+        all = snapshot.addSearch('(objectClass=sshAccount)')
+
+        fetchTime, entries = snapshot.search(self.conn, john)
+        self.assertEquals(len(entries), 1)
+        self.assertEquals(entries[0].dn, 'uid=john,ou=People,dc=example,dc=com')
+        # Only the requested attributes are returned
+        self.assertEquals(entries[0].attributes.keys(), ['uid'])
+
+        # The snapshot is re-used
+        self.assertEquals(snapshot.search(self.conn, all)[0], fetchTime)
+        self.assert_(len(snapshot.search(self.conn, all)[1]) > 1)
+
+        # Filters must be supported by the local evaluator
+        self.assertRaises(ldapfilter.LDAPUtilsFilterError, snapshot.addSearch, '(uid:dn:=john)')
+
+    def test_filterAttributes(self):
+        snapshot = ldapclient.SearchSnapshot(slapd.BASEDN, ldap.SCOPE_SUBTREE, 60)
+        active = snapshot.addSearch('(&(objectClass=sshAccount)(accountStatus=active))', ('uid',))
+        homes = snapshot.addSearch('(&(objectClass=posixAccount)(uid=sally))', ('homeDirectory',))
+
+        # Filter attributes are fetched, though no search requests them
+        fetchTime, entries = snapshot.search(self.conn, active)
+        uids = [entry.attributes['uid'][0] for entry in entries]
+        uids.sort()
+        self.assertEquals(uids, ['john', 'sally'])
+        for entry in entries:
+            self.assertEquals(entry.attributes.keys(), ['uid'])
+
+        fetchTime, entries = snapshot.search(self.conn, homes)
+        self.assertEquals([entry.dn for entry in entries], ['uid=sally,ou=People,dc=example,dc=com'])
+        self.assertEquals(entries[0].attributes.keys(), ['homeDirectory'])
+
+    def _cbAsyncFetch(self, result, snapshot, handle):
+        # The snapshot is current, and is searched without a connection
+        fetchTime, entries = snapshot.search(None, handle)
+        self.assertEquals([entry.attributes['uid'][0] for entry in entries], ['john'])
+
+    def test_asyncFetch(self):
+        conn = ldapclient.TwistedConnection(slapd.SLAPD_URI)
+        conn.simple_bind('', '')
+        snapshot = ldapclient.SearchSnapshot(slapd.BASEDN, ldap.SCOPE_SUBTREE, 60)
+        handle = snapshot.addSearch('(uid=john)', ('uid',))
+
+        # Concurrent fetches are shared
+        d = defer.gatherResults([snapshot.asyncFetch(conn), snapshot.asyncFetch(conn)])
+        d.addCallback(self._cbAsyncFetch, snapshot, handle)
+        return d
+
+    def _cbAsyncFetchExpired(self, result, snapshot, handle):
+        # The fetched snapshot is searched, though it has already expired,
+        # rather than issuing a blocking search
+        fetchTime, entries = snapshot.search(None, handle, result)
+        self.assertEquals([entry.attributes['uid'][0] for entry in entries], ['john'])
+
+    def test_asyncFetchExpired(self):
+        conn = ldapclient.TwistedConnection(slapd.SLAPD_URI)
+        conn.simple_bind('', '')
+        snapshot = ldapclient.SearchSnapshot(slapd.BASEDN, ldap.SCOPE_SUBTREE, 0)
+        handle = snapshot.addSearch('(uid=john)', ('uid',))
+
+        d = snapshot.asyncFetch(conn)
+        d.addCallback(self._cbAsyncFetchExpired, snapshot, handle)
+        return d
+
+
+class DNTestCase(unittest.TestCase):
+    """ Test DN Utilities """
+    def test_normalizeDN(self):
+        self.assertEquals(ldapclient.normalizeDN('uid=John, ou=People,DC=example,dc=com'), 'uid=john,ou=people,dc=example,dc=com')
+
+    def test_isDescendant(self):
+        self.assert_(ldapclient.isDescendant('uid=john,ou=People,dc=example,dc=com', 'ou=people, dc=example,dc=com'))
+        self.assert_(ldapclient.isDescendant('ou=People,dc=example,dc=com', 'ou=People,dc=example,dc=com'))
+        self.assert_(not ldapclient.isDescendant('uid=john,ou=OtherPeople,dc=example,dc=com', 'ou=People,dc=example,dc=com'))
+
+
+class SyncReplConsumerTestCase(unittest.TestCase):
+    """ Test Content Synchronization Consumers """
+    def setUp(self):
+        if (ldapclient.syncrepl == None):
+            raise unittest.SkipTest('python-ldap syncrepl support unavailable, nothing to test')
+
+        self.slapd = slapd.LDAPServer()
+        self.conn = ldapclient.Connection(slapd.SLAPD_URI)
+        self.consumer = ldapclient.SyncReplConsumer(self.conn, slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', ['uid', 'description'])
+
+    def tearDown(self):
+        self.consumer.stop()
+        self.slapd.stop()
+
+    def _poll(self, condition):
+        # Poll the consumer until condition() is satisfied, or give up
+        # after a few seconds.
+        entries = []
+        for i in range(50):
+            entries.extend(self.consumer.poll())
+            if (condition(entries)):
+                break
+            time.sleep(0.1)
+        return entries
+
+    def test_poll(self):
+        self.consumer.start()
+
+        # The refresh phase returns the current content
+        entries = self._poll(lambda entries: self.consumer.refreshDone)
+        self.assert_(self.consumer.refreshDone)
+        self.assertEquals([entry.dn for entry in entries], ['uid=john,ou=People,dc=example,dc=com'])
+        self.assertNotEqual(self.consumer.cookie, None)
+
+        # Modify the entry via a second connection
+        conn = ldapclient.Connection(slapd.SLAPD_URI)
+        conn.simple_bind(slapd.ROOTDN, slapd.ROOTPW)
+        mod = ldapclient.Modification('uid=john,ou=People,dc=example,dc=com')
+        mod.replace('description', 'Persist')
+        conn.modify(mod)
+
+        # The modification is pushed to the consumer
+        entries = self._poll(lambda entries: len(entries) > 0)
+        self.assertEquals(len(entries), 1)
+        self.assertEquals(entries[0].attributes['description'][0], 'Persist')
+
+
+
+class LogConnection(object):
+    """ Connection to a server holding a fixed accesslog """
+    def __init__(self, entries, suffix=None):
+        self.entries = entries
+        # Attributes of the log's suffix entry
+        self.suffix = suffix
+
+    def pinnedConnection(self):
+        return self
+
+    def search(self, base_dn, scope, filter, attributes=None, pageSize=None):
+        if (self.suffix == None):
+            return []
+        return [ldapclient.Entry(base_dn, self.suffix)]
+
+    def iterSearch(self, base_dn, scope, filter, attributes=None, pageSize=None):
+        return iter(self.entries)
+
+    def asyncSearch(self, base_dn, scope, filter, attributes=None, pageSize=None):
+        return defer.succeed(self.entries)
+
+class ChangeLogConsumerTestCase(unittest.TestCase):
+    """ Test Change Log Consumers """
+    def test_currentPosition(self):
+        # The newest position logged by the server is used, whatever the
+        # local time
+        conn = LogConnection([
+            ldapclient.Entry('reqStart=20300101000002.000000Z,cn=accesslog', {'reqEnd': ['20300101000002.000001Z']}),
+            ldapclient.Entry('reqStart=20300101000001.000000Z,cn=accesslog', {'reqEnd': ['20300101000001.000001Z']}),
+        ])
+        consumer = ldapclient.ChangeLogConsumer(conn, 'cn=accesslog')
+        self.assertEquals(consumer.position, '20300101000002.000001Z')
+
+        # Preferably, as recorded by the log's suffix entry
+        conn.suffix = {'contextCSN': ['20300101000003.000000Z#000000#001#000000', '20300101000004.000000Z#000000#002#000000']}
+        consumer = ldapclient.ChangeLogConsumer(conn, 'cn=accesslog')
+        self.assertEquals(consumer.position, '20300101000004.000000Z')
+
+        # Only recent changes are considered, so an empty log is read from
+        # the start of that period
+        consumer = ldapclient.ChangeLogConsumer(LogConnection([]), 'cn=accesslog')
+        latest = time.strftime('%Y%m%d%H%M%S.000000Z', time.gmtime(time.time() - consumer.positionWindow + 60))
+        self.assert_(consumer.position > '00000000000000.000000Z')
+        self.assert_(consumer.position < latest)
+
+    def test_pollRename(self):
+        # Renamed entries are fetched under their new DN
+        conn = LogConnection([
+            ldapclient.Entry('reqStart=20300101000001.000000Z,cn=accesslog', {'reqEnd': ['20300101000001.000001Z'], 'reqDN': ['uid=john,ou=People,dc=example,dc=com'], 'reqNewRDN': ['uid=jim']}),
+            ldapclient.Entry('reqStart=20300101000002.000000Z,cn=accesslog', {'reqEnd': ['20300101000002.000001Z'], 'reqDN': ['uid=sally,ou=People,dc=example,dc=com'], 'reqNewRDN': ['uid=sally'], 'reqNewSuperior': ['ou=Former,dc=example,dc=com']}),
+        ])
+        consumer = ldapclient.ChangeLogConsumer(conn, 'cn=accesslog', position='20300101000000.000000Z')
+        dns = consumer.poll()
+        self.assert_('uid=jim,ou=People,dc=example,dc=com' in dns)
+        self.assert_('uid=sally,ou=Former,dc=example,dc=com' in dns)
+
+        # Likewise for retro change logs
+        conn = LogConnection([
+            ldapclient.Entry('changeNumber=1,cn=changelog', {'changeNumber': ['1'], 'targetDN': ['uid=john,ou=People,dc=example,dc=com'], 'newRDN': ['uid=jim']}),
+        ])
+        consumer = ldapclient.ChangeLogConsumer(conn, 'cn=changelog', ldapclient.CHANGELOG_RETRO, position='0')
+        self.assert_('uid=jim,ou=People,dc=example,dc=com' in consumer.poll())
+        self.assertEquals(consumer.position, '1')
+
+    def _cbAsyncPoll(self, result, consumer):
+        # Changes are read in order, and the position advanced past them
+        self.assertEquals(result, ['uid=john,ou=People,dc=example,dc=com', 'uid=sally,ou=People,dc=example,dc=com'])
+        self.assertEquals(consumer.position, '20300101000002.000001Z')
+
+    def test_asyncPoll(self):
+        conn = LogConnection([
+            ldapclient.Entry('reqStart=20300101000002.000000Z,cn=accesslog', {'reqEnd': ['20300101000002.000001Z'], 'reqDN': ['uid=sally,ou=People,dc=example,dc=com']}),
+            ldapclient.Entry('reqStart=20300101000001.000000Z,cn=accesslog', {'reqEnd': ['20300101000001.000001Z'], 'reqDN': ['uid=john,ou=People,dc=example,dc=com']}),
+        ])
+        consumer = ldapclient.ChangeLogConsumer(conn, 'cn=accesslog', position='20300101000000.000000Z')
+        d = consumer.asyncPoll()
+        d.addCallback(self._cbAsyncPoll, consumer)
+        return d
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# test_filter.py vi:ts=4:sw=4:expandtab:
+#
+# Authors:
+#       Landon Fuller <landonf@threerings.net>
+#       Will Barton <wbb4@opendarwin.org>
+#
+# Copyright (c) 2005 - 2006 Three Rings Design, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright owner nor the names of contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" LDAP Search Filter Unit Tests """
+
+from twisted.trial import unittest
+
+from splat.ldaputils import filter as ldapfilter
+
+# Test Cases
+class FakeEntry(object):
+    def __init__(self, attributes):
+        self.dn = 'uid=john,ou=People,dc=example,dc=com'
+        self.attributes = attributes
+
+class FilterTestCase(unittest.TestCase):
+    """ Test LDAP Search Filters """
+    def setUp(self):
+        self.entry = FakeEntry({
+            'objectClass': ['top', 'posixAccount', 'sshAccount'],
+            'uid': ['john'],
+            'cn': ['John  Doe'],
+            'uidNumber': ['1001'],
+            'modifyTimestamp': ['20060101120000Z'],
+            'description': ['(parenthesized)*'],
+        })
+
+    def _matches(self, filter):
+        return ldapfilter.parse(filter).matches(self.entry)
+
+    def test_equality(self):
+        self.assert_(self._matches('(uid=john)'))
+        self.assert_(self._matches('uid=john'))
+        # Attribute names and values are case-insensitive
+        self.assert_(self._matches('(OBJECTCLASS=PosixAccount)'))
+        # Insignificant whitespace is ignored
+        self.assert_(self._matches('(cn=john doe)'))
+        self.assert_(not self._matches('(uid=sally)'))
+        self.assert_(not self._matches('(mail=john)'))
+        # Approximate matches are treated as equality
+        self.assert_(self._matches('(uid~=John)'))
+
+    def test_presence(self):
+        self.assert_(self._matches('(uid=*)'))
+        self.assert_(not self._matches('(mail=*)'))
+
+    def test_substring(self):
+        self.assert_(self._matches('(cn=jo*)'))
+        self.assert_(self._matches('(cn=*doe)'))
+        self.assert_(self._matches('(cn=j*n*d*e)'))
+        self.assert_(not self._matches('(cn=*smith*)'))
+        # Substrings may not overlap
+        self.assert_(not self._matches('(uid=jo*ohn)'))
+
+    def test_ordering(self):
+        # Integers compare numerically
+        self.assert_(self._matches('(uidNumber>=1000)'))
+        self.assert_(self._matches('(uidNumber>=999)'))
+        self.assert_(not self._matches('(uidNumber<=999)'))
+        # Generalized times compare lexically
+        self.assert_(self._matches('(modifyTimestamp>=20051231000000Z)'))
+        self.assert_(not self._matches('(modifyTimestamp>=20060101120001Z)'))
+        self.assert_(self._matches('(modifyTimestamp<=20060101120000Z)'))
+
+    def test_boolean(self):
+        self.assert_(self._matches('(&(objectClass=posixAccount)(uid=john))'))
+        self.assert_(not self._matches('(&(objectClass=posixAccount)(uid=sally))'))
+        self.assert_(self._matches('(|(uid=sally)(uid=john))'))
+        self.assert_(not self._matches('(|(uid=sally)(uid=jane))'))
+        self.assert_(self._matches('(!(uid=sally))'))
+        self.assert_(self._matches('(&(|(uid=sally)(uid=john))(!(objectClass=purgeableAccount)))'))
+        # Absolute true and false
+        self.assert_(self._matches('(&)'))
+        self.assert_(not self._matches('(|)'))
+
+    def test_escapes(self):
+        self.assert_(self._matches('(description=\\28parenthesized\\29\\2a)'))
+        self.assert_(self._matches('(description=\\28*\\2a)'))
+        self.assert_(not self._matches('(description=\\28parenthesized\\29)'))
+
+    def test_attributes(self):
+        parsed = ldapfilter.parse('(&(|(uid=sally)(UID=john))(!(objectClass=purgeableAccount))(cn=*))')
+        self.assertEquals(parsed.attributes(), ['uid', 'objectClass', 'cn'])
+
+    def test_invalid(self):
+        for filter in ('(uid=john', '(uid=john))', '(=john)', '(uid)', '(&(uid=john)',
+                '(uid=\\2)', '(uid=\\zz)', '(uid>=jo*)', '(uid=jo(hn)', '(uid:caseExactMatch:=john)'):
+            self.assertRaises(ldapfilter.LDAPUtilsFilterError, ldapfilter.parse, filter)
@@ -34,18 +34,41 @@
 
 import splat
 from splat import SplatError
+from splat.ldaputils import client as ldapclient
+from splat.ldaputils import filter as ldapfilter
 
 import types
 import logging
-import ldap
+import ldap, ldap.filter
 import time
+import os, errno, zlib, itertools
+import cPickle
+
+from twisted.internet import defer
+
+try:
+    from hashlib import md5
+except ImportError:
+    # Python 2.4
+    from md5 import new as md5
 
 # Exceptions
 class SplatPluginError(SplatError):
     pass
 
+# Sharded helper process exit codes
+SHARD_ERR_NONE = 0
+SHARD_ERR_FINISH = 1
+SHARD_ERR_EXCEPTION = 2
+
 class HelperController(object):
-    def __init__(self, name, module, interval, searchBase, searchFilter, requireGroup, helperOptions):
+    # Initial delay, in seconds, before retrying an entry the helper
+    # failed to handle. The delay is doubled after each failure.
+    retryDelay = 60
+    # Maximum delay before retrying a failed entry (1 hour)
+    maxRetryDelay = 3600
+
+    def __init__(self, name, module, interval, searchBase, searchFilter, requireGroup, helperOptions, incremental=False, fullResync=0, memberOf=False, sharedSearch=False, shards=1, chunkSize=0, inFlight=10, minIdle=0, adaptive=False, twoPhase=False):
         """
         Initialize Splat Helper from module 
         @param name: Unique caller-assigned name. Helpers with non-unique names will overwrite previous additions when added to a daemon context.
@@ -55,6 +78,16 @@ class HelperController(object):
         @param searchFilter: LDAP Search filter
         @param requireGroup: Require any returned entries to be a member of a group supplied by addGroup().
         @param helperOptions: Dictionary of helper-specific options
+        @param incremental: Only request entries modified since the last successful run from the LDAP server. Defaults to False.
+        @param fullResync: When running incrementally, the interval in seconds at which all matching entries are requested regardless. An interval of '0' disables periodic resynchronization. Defaults to 0.
+        @param memberOf: Resolve group membership from the memberOf attribute of returned entries, and, if requireGroup is set, only request members of the groups from the LDAP server. Defaults to False.
+        @param sharedSearch: Satisfy runs considering all matching entries from a search snapshot shared with other helpers, if one is provided by the daemon context. Defaults to False.
+        @param shards: Partition the entries of each run by DN across this many forked processes, each running its own helper instance. The helper must be shardable. Defaults to 1, which processes all entries in the calling process.
+        @param chunkSize: Number of entries processed between each iteration of workIter() and workEntriesIter(). Defaults to 0, in which case all entries are processed in a single iteration.
+        @param inFlight: For AsyncHelper subclasses, the maximum number of entries for which the helper's work() may be outstanding at once. Defaults to 10.
+        @param minIdle: Minimum time, in seconds, between the end of one run and the start of the next. Defaults to 0.
+        @param adaptive: Stretch the run interval while runs are expensive, and shrink it back when they are cheap. Defaults to False.
+        @param twoPhase: As per incremental, but rather than requesting modified entries from the LDAP server, request only the modifyTimestamp and entryCSN of all matching entries, then the full attributes of those that are new, modified, or in a modified group. Defaults to False.
         """
         self.helperClass = None
         self.name = name
@@ -62,35 +95,116 @@ class HelperController(object):
         self.searchFilter = searchFilter
         self.searchBase = searchBase
         self.requireGroup = requireGroup
+        self.incremental = incremental
+        self.fullResync = fullResync
+        self.memberOf = memberOf
+        self.sharedSearch = sharedSearch
+        self.shards = shards
+        self.chunkSize = chunkSize
+        self.inFlight = inFlight
+        self.minIdle = minIdle
+        self.adaptive = adaptive
+        self.twoPhase = twoPhase
+        # Number of chunks processed by the current or last run, and the
+        # longest and most recent chunk processing time, in seconds
+        self.chunkCount = 0
+        self.maxChunkTime = 0
+        self.lastChunkTime = 0
         # Time of last successful run
         self._lastRun = 0
+        # Time of last successful run that considered all matching entries
+        self._lastFullRun = 0
+        # Entries the helper failed to handle, to be retried
+        self.retries = RetrySet(self.retryDelay, self.maxRetryDelay)
+        # Failed entries passed to the helper by the current full run,
+        # though not yet due to be retried, by normalized DN
+        self._awaitingRetry = {}
+        # Two-phase runs: the stamp of each entry as of the last successful
+        # run, by normalized DN, and the members of each group
+        self._stamps = {}
+        self._groupMembers = {}
+        # Configuration determining which entries are processed, and how.
+        # Groups are appended by addGroup().
+        self._config = [module, searchBase, searchFilter, requireGroup, memberOf, _sortedItems(helperOptions)]
 
         self.groupsCtx = {}
         self.groups = []
+        # Shared ldaputils.client.GroupCache, if any. Set by the daemon context.
+        self.groupCache = None
+        # Shared ldaputils.client.SearchSnapshot, if any, and our search handle
+        self.searchSnapshot = None
+        self._snapshotHandle = None
 
         p = __import__(module, globals(), locals(), ['__file__'])
         for attr in dir(p):
             obj = getattr(p, attr)
             if (isinstance(obj, (type, types.ClassType)) and issubclass(obj, Helper)):
-                # Skip abstract class
-                if (not obj == Helper):
+                # Skip abstract classes
+                if (not obj in (Helper, AsyncHelper)):
                     self.helperClass = obj
                     break
 
         if (self.helperClass == None):
             raise SplatPluginError, "Helper module %s not found" % module
 
+        # Asynchronous helpers must be driven by the reactor
+        self.asynchronous = issubclass(self.helperClass, AsyncHelper)
+        if (self.asynchronous and self.shards > 1):
+            raise SplatPluginError, "Asynchronous helper module %s can not be sharded" % module
+        # Each shard runs its own helper instance, and calls its finish()
+        if (not self.helperClass.shardable and self.shards > 1):
+            raise SplatPluginError, "Helper module %s can not be sharded" % module
+
+        self.defaultContext = self.helperClass.parseOptions(helperOptions)
+
         # Get the list of required attributes
+        self._updateSearchAttributes()
 
-        self.searchAttr = self.helperClass.attributes()
-        # If None, request all user attributes (LDAP_ALL_USER_ATTRIBUTES)
-        if (self.searchAttr == None):
-            self.searchAttr = ('*', )
+    def _updateSearchAttributes(self):
+        """
+        Determine the LDAP attributes required by the helper, for the
+        default context and all group contexts.
+        """
+        contexts = [self.defaultContext] + [self.groupsCtx[group] for group in self.groups]
+        searchAttr = ()
+        for context in contexts:
+            attributes = self.helperClass.attributesForContext(context)
+            # If None, request all user attributes (LDAP_ALL_USER_ATTRIBUTES)
+            if (attributes == None):
+                searchAttr = ('*', )
+                break
+            for attribute in attributes:
+                if (attribute not in searchAttr):
+                    searchAttr = searchAttr + (attribute,)
 
         # Always retrieve the modifyTimestamp operational attribute, too.
-        self.searchAttr = self.searchAttr + ('modifyTimestamp',)
+        searchAttr = searchAttr + ('modifyTimestamp',)
 
-        self.defaultContext = self.helperClass.parseOptions(helperOptions)
+        # Group membership is read from the entry itself
+        if (self.memberOf):
+            searchAttr = searchAttr + ('memberOf',)
+
+        # Attributes fetched by the first phase of a two-phase run, which
+        # are recorded from all runs
+        stampAttr = ('modifyTimestamp', 'entryCSN')
+        if (self.memberOf):
+            stampAttr = stampAttr + ('memberOf',)
+        if (self.twoPhase):
+            searchAttr = searchAttr + ('entryCSN',)
+
+        self.searchAttr = searchAttr
+        self.stampAttr = stampAttr
+
+    def setSearchSnapshot(self, snapshot):
+        """
+        Retrieve entries from a search snapshot shared with other helpers,
+        rather than searching the LDAP server, when considering all
+        matching entries. Raises ldaputils.filter.LDAPUtilsFilterError if
+        the search filter can not be evaluated locally.
+        @param snapshot: Instance of ldaputils.client.SearchSnapshot
+        """
+        self._snapshotHandle = snapshot.addSearch(self.searchFilter, self.searchAttr)
+        self.searchSnapshot = snapshot
 
     def addGroup(self, groupFilter, helperOptions = None):
         """
@@ -105,94 +219,818 @@ class HelperController(object):
 
         # Groups must be tested in the order they are added
         self.groups.append(groupFilter)
+        self._config.append((groupFilter.baseDN, groupFilter.scope, groupFilter.filter,
+                groupFilter.memberAttribute, groupFilter.nested, _sortedItems(helperOptions)))
+
+        # Group options may require additional attributes
+        self._updateSearchAttributes()
+
+    def configHash(self):
+        """
+        Return a hash of the configuration determining which entries
+        are processed by the helper, and how.
+        """
+        return md5(repr(self._config)).hexdigest()
+
+    def getCheckpoint(self):
+        """
+        Return the state required to resume processing after a restart
+        without considering every entry modified.
+        @return A (configuration hash, last run time, last full run time) tuple
+        """
+        # Entries awaiting a retry must be considered modified after a
+        # restart
+        lastRun = self._lastRun
+        retryLastRun = self.retries.lastRun()
+        if (retryLastRun != None):
+            lastRun = min(lastRun, retryLastRun)
+        return (self.configHash(), lastRun, self._lastFullRun)
+
+    def restoreCheckpoint(self, checkpoint):
+        """
+        Resume from a checkpoint returned by getCheckpoint(). Checkpoints
+        saved with a different configuration are ignored, and all entries
+        are considered modified by the next run.
+        @param checkpoint: Checkpoint returned by getCheckpoint()
+        @return True if the checkpoint was restored.
+        """
+        configHash, lastRun, lastFullRun = checkpoint
+        if (configHash != self.configHash()):
+            return False
+        self._lastRun = lastRun
+        self._lastFullRun = lastFullRun
+        return True
 
     def work(self, ldapConnection):
         """
         Find matching LDAP entries and fire off the helper
         """
+        self._exhaust(self.workIter(ldapConnection))
+
+    def workIter(self, ldapConnection):
+        """
+        Find matching LDAP entries and fire off the helper, yielding
+        after every chunkSize entries. Suitable for use with
+        twisted.internet.task.cooperate().
+        """
         logger = logging.getLogger(splat.LOG_NAME)
-        failure = False
 
         # Save the start time, used to determine the last successful run
         startTime = int(time.time())
 
+        # Resolve group membership once for the entire run
+        memberships = []
+        for d in self._fetchMemberships(ldapConnection, memberships):
+            yield d
+
+        # A cached group membership is only known to be current as of the
+        # time it was fetched; group modifications made since must still
+        # be considered by the next run.
+        for group, membership in memberships:
+            startTime = min(startTime, membership.fetchTime)
+
+        # Restrict the search to recently modified entries, if possible
+        fullRun = not self._canRunIncremental(memberships, startTime)
+        filters = [_parenthesize(self.searchFilter)]
+        if (not fullRun and not self.twoPhase):
+            filters.append('(modifyTimestamp>=%s)' % ldapclient.generalizedTime(self._lastRun))
+            logger.debug("Requesting entries modified since last run for helper %s" % self.name)
+
+        # Only request members of the required groups
+        noMembers = False
+        if (self.memberOf and self.requireGroup):
+            groupFilters = []
+            for group, membership in memberships:
+                for groupDN in sorted(membership.groups):
+                    groupFilters.append('(memberOf=%s)' % ldap.filter.escape_filter_chars(groupDN))
+            filters.append('(|%s)' % ''.join(groupFilters))
+            noMembers = (len(groupFilters) == 0)
+
+        if (len(filters) == 1):
+            searchFilter = filters[0]
+        else:
+            searchFilter = '(&%s)' % ''.join(filters)
+
         # TODO LDAP scope support
-        entries = ldapConnection.search(self.searchBase, ldap.SCOPE_SUBTREE, self.searchFilter, self.searchAttr)
+        # Entries are consumed as they are returned by the server, rather than
+        # collected up front, keeping memory usage bounded by the page size.
+        # Entries read from a non-blocking connection are interspersed with
+        # Deferreds, to be waited for whenever no entries are available.
+        stamps = {}
+        forceModified = False
+        if (noMembers):
+            # No groups, and therefore no entries, to be found
+            entries = []
+        elif (self.twoPhase and not fullRun):
+            # Scan the stamps of all matching entries, then fetch the
+            # full attributes of those that are stale
+            if (ldapConnection.nonBlocking):
+                scanned = ldapConnection.asyncIterSearch(self.searchBase, ldap.SCOPE_SUBTREE, searchFilter, self.stampAttr)
+            else:
+                scanned = ldapConnection.iterSearch(self.searchBase, ldap.SCOPE_SUBTREE, searchFilter, self.stampAttr)
+            entries = self._fetchStale(ldapConnection, searchFilter, scanned, memberships, stamps)
+            # Stale entries have been modified, though their
+            # modifyTimestamp may not show it
+            forceModified = True
+        elif (fullRun and self.searchSnapshot != None):
+            # Wait for the snapshot without blocking the reactor
+            snapshot = None
+            if (ldapConnection.nonBlocking):
+                fetched = []
+                d = self.searchSnapshot.asyncFetch(ldapConnection)
+                d.addCallback(fetched.append)
+                yield d
+                snapshot = fetched[0]
+            # Our filter is evaluated locally; group membership is still
+            # checked for each entry.
+            fetchTime, entries = self.searchSnapshot.search(ldapConnection, self._snapshotHandle, snapshot)
+            startTime = min(startTime, fetchTime)
+        elif (ldapConnection.nonBlocking):
+            entries = ldapConnection.asyncIterSearch(self.searchBase, ldap.SCOPE_SUBTREE, searchFilter, self.searchAttr)
+        else:
+            entries = ldapConnection.iterSearch(self.searchBase, ldap.SCOPE_SUBTREE, searchFilter, self.searchAttr)
+
+        # Entries that previously failed are not returned by an incremental
+        # search, and must be fetched once they are due to be retried
+        seen = {}
+        self._awaitingRetry = {}
+        entries = self._dueEntries(entries, seen, fullRun)
+        if (not fullRun):
+            entries = itertools.chain(entries, self._retryEntries(ldapConnection, seen))
+        elif (self.twoPhase):
+            # Record the stamps of all entries, for the next two-phase run
+            entries = self._recordStamps(entries, stamps)
+
+        failures = []
+        for chunk in self._processIter(entries, memberships, forceModified, failures):
+            yield chunk
+
+        # Entries the helper failed to handle are retried individually, and
+        # do not prevent the last-run timestamp from being updated. Failures
+        # affecting the whole run do.
+        #
+        # We use the start time, rather than the current time, as modifications
+        # may occur between when the run starts, and when the run finishes.
+        if (None not in failures):
+            self._lastRun = startTime
+            if (fullRun):
+                self._lastFullRun = startTime
+            if (self.twoPhase):
+                self._stamps = stamps
+                self._groupMembers = {}
+                for group, membership in memberships:
+                    self._groupMembers[group] = membership.members
+
+        if (len(self.retries) > 0):
+            logger.warning("Helper %s has failed to handle %d entries, which will be retried" % (self.name, len(self.retries)))
+
+    def workEntries(self, ldapConnection, entries):
+        """
+        Fire off the helper for the supplied LDAP entries, which are known
+        to have been modified; eg, as reported by a content synchronization
+        search. Entries are still subject to group filtering, but the
+        time of the last successful run is left untouched.
+        @param ldapConnection: A valid LDAP Connection instance
+        @param entries: Modified ldaputils.client.Entry instances
+        """
+        self._exhaust(self.workEntriesIter(ldapConnection, entries))
+
+    def _exhaust(self, iterator):
+        """
+        Synchronously run a work iterator to completion.
+        """
+        for chunk in iterator:
+            # Deferred results can only be waited for by the reactor
+            if (chunk != None):
+                raise SplatPluginError, "Helper %s must be run with workIter() or workEntriesIter() when asynchronous, or when using a non-blocking LDAP connection" % self.name
+
+    def workEntriesIter(self, ldapConnection, entries):
+        """
+        Fire off the helper for the supplied LDAP entries, as per
+        workEntries(), yielding after every chunkSize entries.
+        """
+        self._awaitingRetry = {}
+        memberships = []
+        for d in self._fetchMemberships(ldapConnection, memberships):
+            yield d
+        for chunk in self._processIter(self._dueEntries(entries, {}), memberships, True, []):
+            yield chunk
+
+    def _dueEntries(self, entries, seen, fullRun=False):
+        """
+        Skip entries the helper has failed to handle that are not yet due
+        to be retried, unless they have since been modified. Full runs
+        must pass every entry to the helper, so such entries are instead
+        passed as unmodified, and their retry left as scheduled.
+        @param seen: Dictionary to which the normalized DNs of any failed entries are added.
+        @param fullRun: True if the entries are all of those matching the search filter.
+        """
+        logger = logging.getLogger(splat.LOG_NAME)
+        now = time.time()
+        for entry in entries:
+            if (isinstance(entry, defer.Deferred)):
+                yield entry
+                continue
+            if (entry.dn in self.retries):
+                dn = ldapclient.normalizeDN(entry.dn)
+                seen[dn] = True
+                if (not self.retries.isDue(entry, now)):
+                    logger.debug("Not retrying entry %s for helper %s until %s" % (entry.dn, self.name, time.ctime(self.retries.nextRetry(entry.dn))))
+                    if (not fullRun):
+                        continue
+                    self._awaitingRetry[dn] = True
+            yield entry
+
+    def _retryEntries(self, ldapConnection, seen):
+        """
+        Fetch the entries due to be retried that were not otherwise
+        returned by the current run.
+        @param seen: Normalized DNs of failed entries already returned by the run.
+        """
+        dns = [dn for dn in self.retries.due(time.time()) if not seen.has_key(ldapclient.normalizeDN(dn))]
+        searches = [(dn, ldap.SCOPE_BASE, self.searchFilter, self.searchAttr) for dn in dns]
+        results = []
+        for d in _searchMany(ldapConnection, searches, results):
+            yield d
+
+        for dn, entries in zip(dns, results):
+            if (not entries):
+                # Deleted, or no longer matches our filter
+                self.retries.succeeded(dn)
+                continue
+
+            for entry in entries:
+                yield entry
+
+    def _stampOf(self, entry):
+        """
+        Returns the stamp of an entry: its entryCSN and, if group
+        membership is read from the entry, memberOf values. Entries whose
+        stamp has changed have been modified.
+        """
+        stamp = tuple(ldapfilter._getValues(entry, 'entryCSN'))
+        if (self.memberOf):
+            stamp = (stamp, tuple(sorted([ldapclient.normalizeDN(dn) for dn in ldapfilter._getValues(entry, 'memberOf')])))
+        return stamp
+
+    def _recordStamps(self, entries, stamps):
+        for entry in entries:
+            if (not isinstance(entry, defer.Deferred)):
+                stamps[ldapclient.normalizeDN(entry.dn)] = self._stampOf(entry)
+            yield entry
+
+    def _isStale(self, entry, memberships):
+        """
+        Determine whether an entry returned by the first phase of a
+        two-phase run must be fetched and passed to the helper.
+        """
+        dn = ldapclient.normalizeDN(entry.dn)
+        previous = self._stamps.get(dn)
+        stamp = self._stampOf(entry)
+
+        # Entries whose entryCSN or group memberships have changed
+        if (previous != None and previous != stamp):
+            return True
+
+        # Without a known entryCSN, rely on the modifyTimestamp
+        if (previous == None or len(ldapfilter._getValues(entry, 'entryCSN')) == 0):
+            if (not entry.attributes.has_key('modifyTimestamp')):
+                return True
+            modTime = entry.getModTime()
+            if (modTime == None or modTime >= self._lastRun):
+                return True
+
+        # Entries added to, or removed from, a modified group
+        for group, membership in memberships:
+            if (not membership.isModified(self._lastRun)):
+                continue
+            if (self.memberOf):
+                if (membership.matchesMemberOf(entry)):
+                    return True
+            elif (membership.isMember(dn) or dn in self._groupMembers.get(group, ())):
+                return True
+
+        return False
+
+    def _fetchStale(self, ldapConnection, searchFilter, scanned, memberships, stamps):
+        """
+        Fetch the full attributes of the stale entries returned by the
+        first phase of a two-phase run.
+        @param scanned: Entries returned by the first phase
+        @param stamps: Dictionary to which the stamps of all scanned entries are added.
+        @result Yields Entry instances, and any Deferreds to be waited for.
+        """
+        logger = logging.getLogger(splat.LOG_NAME)
+        dns = []
+        count = 0
+        for entry in scanned:
+            if (isinstance(entry, defer.Deferred)):
+                yield entry
+                continue
+            stamps[ldapclient.normalizeDN(entry.dn)] = self._stampOf(entry)
+            if (self._isStale(entry, memberships)):
+                dns.append(entry.dn)
+            count = count + 1
+
+        logger.debug("Requesting %d of %d entries for helper %s" % (len(dns), count, self.name))
+        searches = [(dn, ldap.SCOPE_BASE, searchFilter, self.searchAttr) for dn in dns]
+        results = []
+        for d in _searchMany(ldapConnection, searches, results):
+            yield d
+
+        for result in results:
+            # None if deleted since the first phase
+            if (result != None):
+                for entry in result:
+                    yield entry
+
+    def _fetchMemberships(self, ldapConnection, memberships):
+        """
+        Fetch the membership of all groups, in the order they were added,
+        from the shared group cache if one has been set. The memberships
+        list is extended with (GroupFilter, GroupMembership) tuples. Yields
+        a Deferred to be waited for if the connection is non-blocking.
+        """
+        # Member DNs are not required when membership is read from
+        # the entries' memberOf attribute
+        if (ldapConnection.nonBlocking):
+            if (self.groupCache != None):
+                d = self.groupCache.asyncGetMemberships(self.groups, ldapConnection, not self.memberOf)
+            else:
+                d = ldapclient.asyncGetMemberships(ldapConnection, self.groups, not self.memberOf)
+            d.addCallback(lambda result: memberships.extend(zip(self.groups, result)))
+            yield d
+        elif (self.groupCache != None):
+            memberships.extend(zip(self.groups, self.groupCache.getMemberships(self.groups, ldapConnection, not self.memberOf)))
+        else:
+            memberships.extend(zip(self.groups, ldapclient.getMemberships(ldapConnection, self.groups, not self.memberOf)))
+
+    def _processIter(self, entries, memberships, forceModified, failures):
+        """
+        Pass the supplied entries to a new helper instance, yielding after
+        every chunkSize entries. The DN of each entry the helper fails to
+        handle is appended to failures, as is None if the helper fails to
+        finish.
+
+        If the helper returns Deferred results, up to inFlight entries
+        are handled at once; a Deferred is yielded when the limit is
+        reached, and for the helper's outstanding results and finish().
+        """
+        if (self.shards > 1):
+            self._processSharded(entries, memberships, forceModified, failures)
+            return
+
+        logger = logging.getLogger(splat.LOG_NAME)
+        self.chunkCount = 0
+        self.maxChunkTime = 0
 
         # Instantiate a plugin instance
         plugin = self.helperClass()
 
+        # Outstanding asynchronous results, and any unexpected errors
+        # they have produced
+        pending = []
+        errors = []
+
+        def cbWork(failed, d, dn):
+            pending.remove(d)
+            self._entryDone(dn, failed, failures)
+
+        def ebWork(failure, d):
+            pending.remove(d)
+            errors.append(failure)
+
         # Iterate over the results
+        count = 0
+        chunkStart = time.time()
         for entry in entries:
-            context = None
-            entryModified = False
-            groupModified = False
-            # Find the group helper instance, if any
-            for group in self.groups:
-                if (group.isMember(ldapConnection, entry.dn)):
-                    context = self.groupsCtx[group]
-                    
-                    # Get the modifyTimestamp of this group. If the group has 
-                    # been modified, this entry might have just been added to 
-                    # the group, in which case we want to treat the entry as 
-                    # modified.
-                    groupEntry = ldapConnection.search(group.baseDN, group.scope, group.filter, ('modifyTimestamp',))[0]
-                    if (groupEntry.attributes.has_key('modifyTimestamp')):
-                        groupModTime = groupEntry.getModTime()
-                        if groupModTime != None and groupModTime >= self._lastRun:
-                            groupModified = True
-                    # If no timestamp, assume the group has been modified.
-                    else:
-                        groupModified = True
-                    
-                    # Break to outer loop
-                    break
-
-            if (context == None and self.requireGroup == False):
-                context = self.defaultContext
-            elif (context == None and self.requireGroup == True):
-                # Move on, empty handed
-                logger.debug("DN %s matched zero groups and requireGroup is enabled for helper %s" % (entry.dn, self.name))
+            # Wait for a non-blocking connection to read more entries
+            if (isinstance(entry, defer.Deferred)):
+                yield entry
                 continue
 
-            # Check if our entry has been modified
-            if (entry.attributes.has_key('modifyTimestamp')):
-                entryModTime = entry.getModTime()
-                # Go on to next entry if the modifyTimetamp is malformed
-                if entryModTime == None:
-                    continue
+            failed = self._processEntry(plugin, entry, memberships, forceModified)
+            if (isinstance(failed, defer.Deferred)):
+                pending.append(failed)
+                failed.addCallbacks(cbWork, ebWork, callbackArgs=(failed, entry.dn), errbackArgs=(failed,))
+            else:
+                self._entryDone(entry.dn, failed, failures)
 
-                if (entryModTime >= self._lastRun):
-                    entryModified = True
+            # Wait for an outstanding result before handling any more entries
+            if (len(pending) >= self.inFlight):
+                self._chunkDone(chunkStart)
+                yield defer.DeferredList(pending[:], fireOnOneCallback=True)
+                chunkStart = time.time()
 
-            # If there is no modifyTimestamp, just say entry has been modified
-            else:
-                entryModified = True
+            count = count + 1
+            if (self.chunkSize and count % self.chunkSize == 0):
+                self._chunkDone(chunkStart)
+                yield None
+                chunkStart = time.time()
 
-            try:
-                plugin.work(context, entry, entryModified or groupModified)
-            except splat.SplatError, e:
-                failure = True
-                logger.error("Helper invocation for '%s' failed with error: %s" % (self.name, e))
+        # Wait for all outstanding results
+        if (len(pending) > 0):
+            yield defer.DeferredList(pending[:])
+        if (len(errors) > 0):
+            errors[0].raiseException()
 
         # Let the plugin clean itself up
         try:
-            plugin.finish()
+            result = plugin.finish()
+            if (isinstance(result, defer.Deferred)):
+                d = result
+                result = []
+                d.addCallbacks(result.append, errors.append)
+                yield d
+                if (len(errors) > 0):
+                    errors[0].raiseException()
         except splat.SplatError, e:
-            failure = True
+            failures.append(None)
             logger.error("Helper finish invocation for '%s' failed with error: %s" % (self.name, e))
 
-        # If the entire run was successful, update the last-run timestamp.
-        #
-        # We use the start time, rather than the current time, as modifications
-        # may occur between when the run starts, and when the run finishes.
-        if (not failure):
-            self._lastRun = startTime
+        self._chunkDone(chunkStart)
+        if (self.chunkSize):
+            logger.debug("Helper %s processed %d entries in %d chunks, the longest taking %.3f seconds" % (self.name, count, self.chunkCount, self.maxChunkTime))
+
+    def _entryDone(self, dn, failed, failures):
+        """
+        Record whether the helper handled an entry, scheduling failed
+        entries to be retried.
+        """
+        # The entry was not retried, and remains scheduled as it was
+        if (len(self._awaitingRetry) > 0 and self._awaitingRetry.has_key(ldapclient.normalizeDN(dn))):
+            return
+        if (failed):
+            failures.append(dn)
+            self.retries.failed(dn, time.time(), self._lastRun)
+        else:
+            self.retries.succeeded(dn)
+
+    def _chunkDone(self, chunkStart):
+        """
+        Record the processing time of a chunk of entries.
+        """
+        self.lastChunkTime = time.time() - chunkStart
+        self.maxChunkTime = max(self.maxChunkTime, self.lastChunkTime)
+        self.chunkCount = self.chunkCount + 1
+
+    def _processEntry(self, plugin, entry, memberships, forceModified):
+        """
+        Pass a single entry to the helper instance, if it matches our groups.
+        Returns True if the helper reported a failure, or, if the helper
+        returned a Deferred result, a Deferred whose callback is invoked
+        with the same.
+        """
+        logger = logging.getLogger(splat.LOG_NAME)
+        context = None
+        entryModified = False
+        groupModified = False
+        # Find the group helper instance, if any
+        for group, membership in memberships:
+            if (self.memberOf):
+                isMember = membership.matchesMemberOf(entry)
+            else:
+                isMember = membership.isMember(entry.dn)
+
+            if (isMember):
+                context = self.groupsCtx[group]
+                
+                # If the group has been modified, this entry might have
+                # just been added to the group, in which case we want to
+                # treat the entry as modified. If no timestamp, assume
+                # the group has been modified.
+                groupModified = membership.isModified(self._lastRun)
+                
+                # Break to outer loop
+                break
+
+        if (context == None and self.requireGroup == False):
+            context = self.defaultContext
+        elif (context == None and self.requireGroup == True):
+            # Move on, empty handed
+            logger.debug("DN %s matched zero groups and requireGroup is enabled for helper %s" % (entry.dn, self.name))
+            return False
+
+        # Check if our entry has been modified. Entries being retried are
+        # always considered modified, and those awaiting a retry never are.
+        if (len(self._awaitingRetry) > 0 and self._awaitingRetry.has_key(ldapclient.normalizeDN(entry.dn))):
+            entryModified = False
+        elif (forceModified or entry.dn in self.retries):
+            entryModified = True
+        elif (entry.attributes.has_key('modifyTimestamp')):
+            entryModTime = entry.getModTime()
+            # Go on to next entry if the modifyTimetamp is malformed
+            if entryModTime == None:
+                return False
+
+            if (entryModTime >= self._lastRun):
+                entryModified = True
+
+        # If there is no modifyTimestamp, just say entry has been modified
+        else:
+            entryModified = True
+
+        try:
+            result = plugin.work(context, entry, entryModified or groupModified)
+        except splat.SplatError, e:
+            logger.error("Helper invocation for '%s' failed with error: %s" % (self.name, e))
+            return True
+
+        if (isinstance(result, defer.Deferred)):
+            result.addCallbacks(self._cbWork, self._ebWork)
+            return result
+
+        return False
+
+    def _cbWork(self, result):
+        return False
+
+    def _ebWork(self, failure):
+        failure.trap(splat.SplatError)
+        logger = logging.getLogger(splat.LOG_NAME)
+        logger.error("Helper invocation for '%s' failed with error: %s" % (self.name, failure.value))
+        return True
+
+    def _processSharded(self, entries, memberships, forceModified, failures):
+        """
+        Partition the supplied entries by DN across forked processes, each
+        passing its share to its own helper instance. Entries are streamed
+        to the processes as they are read, so that paged searches are never
+        held in memory in their entirety. Each process reports the DNs of
+        entries the helper failed to handle, which are appended to failures,
+        as is None if any process fails to complete. Must not be called
+        from a thread other than the daemon's main thread.
+        """
+        logger = logging.getLogger(splat.LOG_NAME)
+
+        children = []
+        for shard in range(self.shards):
+            entryPipe = os.pipe()
+            resultPipe = os.pipe()
+            pid = os.fork()
+            if (pid == 0):
+                # Only the parent may hold the other shards' entry pipes open
+                for other in children:
+                    other[3].close()
+                os.close(entryPipe[1])
+                os.close(resultPipe[0])
+                status = SHARD_ERR_NONE
+                try:
+                    inf = os.fdopen(entryPipe[0], 'r')
+                    plugin = self.helperClass()
+                    failedDNs = []
+                    while (1):
+                        try:
+                            entry, awaitingRetry = cPickle.load(inf)
+                        except EOFError:
+                            break
+                        if (awaitingRetry):
+                            self._awaitingRetry[ldapclient.normalizeDN(entry.dn)] = True
+                        if (self._processEntry(plugin, entry, memberships, forceModified)):
+                            failedDNs.append(entry.dn)
+                    inf.close()
+
+                    try:
+                        plugin.finish()
+                    except splat.SplatError, e:
+                        logger.error("Helper finish invocation for '%s' failed with error: %s" % (self.name, e))
+                        status = SHARD_ERR_FINISH
+
+                    # Results are only written once all entries have been
+                    # read, so that neither process can block the other
+                    outf = os.fdopen(resultPipe[1], 'w')
+                    for dn in failedDNs:
+                        outf.write(dn + '\n')
+                    outf.close()
+                except Exception, e:
+                    logger.error("Helper shard %d for '%s' failed with error: %s" % (shard, self.name, e))
+                    os._exit(SHARD_ERR_EXCEPTION)
+                os._exit(status)
+
+            os.close(entryPipe[0])
+            os.close(resultPipe[1])
+            children.append((shard, pid, os.fdopen(resultPipe[0], 'r'), os.fdopen(entryPipe[1], 'w')))
+
+        # Hand each entry to its shard, retaining only the DN
+        dns = []
+        lost = {}
+        for entry in entries:
+            dns.append(entry.dn)
+            shard = _shardOf(entry.dn, self.shards)
+            if (lost.has_key(shard)):
+                continue
+            try:
+                awaitingRetry = self._awaitingRetry.has_key(ldapclient.normalizeDN(entry.dn))
+                cPickle.dump((entry, awaitingRetry), children[shard][3], cPickle.HIGHEST_PROTOCOL)
+            except IOError, e:
+                # The shard has exited, and will report its failure below
+                lost[shard] = True
+
+        failed = {}
+        for shard, pid, inf, outf in children:
+            try:
+                outf.close()
+            except IOError, e:
+                pass
+            failedDNs = [line.rstrip('\n') for line in inf.readlines()]
+            inf.close()
+
+            while (1):
+                try:
+                    result = os.waitpid(pid, 0)
+                except OSError, e:
+                    if (e.errno == errno.EINTR):
+                        continue
+                    raise
+                break
+
+            if (len(failedDNs) > 0):
+                logger.error("Helper shard %d for '%s' failed for %d entries: %s" % (shard, self.name, len(failedDNs), ', '.join(failedDNs)))
+            for dn in failedDNs:
+                failed[dn] = True
+
+            if (not os.WIFEXITED(result[1]) or os.WEXITSTATUS(result[1]) != SHARD_ERR_NONE):
+                failures.append(None)
+                logger.error("Helper shard %d for '%s' did not complete successfully" % (shard, self.name))
+
+        for dn in dns:
+            self._entryDone(dn, failed.has_key(dn), failures)
+
+    def _canRunIncremental(self, memberships, startTime):
+        """
+        Determine whether a run starting at startTime may restrict its search
+        to entries modified since the last successful run.
+        """
+        if (not (self.incremental or self.twoPhase)):
+            return False
+
+        # The first run always considers every entry
+        if (self._lastRun == 0):
+            return False
+
+        # Periodically resynchronize all entries
+        if (self.fullResync and startTime - self._lastFullRun >= self.fullResync):
+            return False
+
+        # Two-phase runs find the members of modified groups themselves
+        if (self.twoPhase):
+            return True
+
+        # Entries added to a modified group have not necessarily been modified
+        # themselves, and would be missed by an incremental search.
+        for group, membership in memberships:
+            if (membership.isModified(self._lastRun)):
+                return False
+
+        return True
+
+def _searchMany(ldapConnection, searches, results):
+    """
+    Issue several searches at once, as per Connection.searchMany(),
+    extending results with theirs. Yields a Deferred to be waited for if
+    the connection is non-blocking.
+    """
+    if (ldapConnection.nonBlocking):
+        d = ldapConnection.asyncSearchMany(searches)
+        d.addCallback(results.extend)
+        yield d
+    else:
+        results.extend(ldapConnection.searchMany(searches))
+
+def _shardOf(dn, shards):
+    """
+    Assign a DN to one of the given number of shards.
+    """
+    return (zlib.crc32(ldapclient.normalizeDN(dn)) & 0xffffffff) % shards
+
+def _parenthesize(filter):
+    """
+    Enclose an LDAP search filter in parentheses, if necessary, so that
+    it may be combined with other filters.
+    """
+    if (filter.startswith('(')):
+        return filter
+    return '(%s)' % filter
+
+class RetrySet(object):
+    """
+    Entries a helper has failed to handle. Each entry is retried after
+    a delay that doubles with each successive failure, until the helper
+    handles it successfully.
+    """
+    def __init__(self, initialDelay, maxDelay):
+        """
+        @param initialDelay: Delay, in seconds, before an entry is first retried.
+        @param maxDelay: Maximum delay, in seconds, between retries.
+        """
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        # Retry state, keyed by normalized DN
+        self._retries = {}
+
+    def __len__(self):
+        return len(self._retries)
+
+    def __contains__(self, dn):
+        # Avoid normalizing every DN of every run
+        if (len(self._retries) == 0):
+            return False
+        return self._retries.has_key(ldapclient.normalizeDN(dn))
+
+    def failed(self, dn, failTime, lastRun):
+        """
+        Record a failure to handle an entry, and schedule its next retry.
+        @param dn: Entry DN
+        @param failTime: Time of the failure, in seconds since the epoch.
+        @param lastRun: The helper's last run time, recorded when the entry first fails.
+        """
+        key = ldapclient.normalizeDN(dn)
+        retry = self._retries.get(key)
+        if (retry == None):
+            retry = _Retry(dn, lastRun)
+            self._retries[key] = retry
+
+        retry.failTime = failTime
+        retry.nextRetry = failTime + min(self.initialDelay * 2 ** retry.attempts, self.maxDelay)
+        retry.attempts = retry.attempts + 1
+
+    def succeeded(self, dn):
+        """
+        Forget an entry that has been handled successfully.
+        """
+        if (len(self._retries) > 0):
+            self._retries.pop(ldapclient.normalizeDN(dn), None)
+
+    def isDue(self, entry, now):
+        """
+        Returns False if the entry has failed and is not yet due to be
+        retried, unless it has been modified since it failed.
+        @param entry: ldaputils.client.Entry instance
+        @param now: Current time, in seconds since the epoch.
+        """
+        retry = self._retries.get(ldapclient.normalizeDN(entry.dn))
+        if (retry == None or now >= retry.nextRetry):
+            return True
+
+        if (entry.attributes.has_key('modifyTimestamp')):
+            modTime = entry.getModTime()
+            if (modTime != None and modTime >= retry.failTime):
+                return True
+        return False
+
+    def nextRetry(self, dn):
+        """
+        Returns the time at which the entry is due to be retried, or None.
+        """
+        retry = self._retries.get(ldapclient.normalizeDN(dn))
+        if (retry == None):
+            return None
+        return retry.nextRetry
+
+    def due(self, now):
+        """
+        Returns the DNs of all entries due to be retried.
+        @param now: Current time, in seconds since the epoch.
+        """
+        return [retry.dn for retry in self._retries.values() if now >= retry.nextRetry]
+
+    def lastRun(self):
+        """
+        Returns the earliest last run time recorded by failed(), or None
+        if no entries have failed. Entries modified since then include
+        all entries awaiting a retry.
+        """
+        if (len(self._retries) == 0):
+            return None
+        return min([retry.lastRun for retry in self._retries.values()])
+
+class _Retry(object):
+    def __init__(self, dn, lastRun):
+        self.dn = dn
+        self.lastRun = lastRun
+        self.attempts = 0
+        self.failTime = 0
+        self.nextRetry = 0
+
+def _sortedItems(options):
+    """
+    Return the items of an option dictionary in a stable order, or None.
+    """
+    if (options == None):
+        return None
+    items = options.items()
+    items.sort()
+    return items
 
 class Helper(object):
     """
     Abstract class for Splat helper plugins
     """
+    # Set to True by helpers that handle each entry independently of the
+    # others, and may therefore be run in several sharded processes at
+    # once, each calling finish() on its own share of the entries.
+    shardable = False
+
     @classmethod
     def attributes(self):
         """
@@ -202,6 +1040,17 @@ class Helper(object):
         raise NotImplementedError, \
                 "This method is not implemented in this abstract class"
     
+    @classmethod
+    def attributesForContext(self, context):
+        """
+        Return the LDAP attributes required for the given configuration
+        context, as returned by parseOptions(). Return None to have all
+        available attributes returned. Defaults to the attributes
+        returned by attributes(); override this if the required
+        attributes depend on the helper's options.
+        """
+        return self.attributes()
+
     @classmethod
     def _parseBooleanOption(self, option):
         """
@@ -239,3 +1088,15 @@ class Helper(object):
         flushing modifications to disk, etc.
         """
         pass
+
+class AsyncHelper(Helper):
+    """
+    Abstract class for asynchronous Splat helper plugins. The work() and
+    finish() methods may return Deferreds, allowing the helper to overlap
+    I/O for multiple entries. Failures should be reported by raising, or
+    errbacking with, a SplatError.
+
+    Asynchronous helpers are always run on the reactor thread, with up to
+    the service's InFlight entries outstanding at once.
+    """
+    pass
@@ -36,8 +36,10 @@
 """ Splat Daemon Unit Tests """
 
 from twisted.trial import unittest
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
+from twisted.python import failure
 
+import splat
 from splat import daemon 
 from splat import plugin
 from splat.ldaputils import client as ldapclient
@@ -45,6 +47,8 @@ from splat.ldaputils import client as ldapclient
 import test_plugin
 from splat.ldaputils.test import slapd
 
+import ldap, os
+
 # Useful Constants
 from splat.test import DATA_DIR
 
@@ -57,6 +61,7 @@ class MockHelper(plugin.Helper):
     # Last instance failure. This is obviously
     # not safe outside of testing
     failure = None
+    shardable = True
 
     def __init__(self):
         super(plugin.Helper, self).__init__()
@@ -89,6 +94,18 @@ class ErrorHelper(MockHelper):
         super(MockHelper, self).__init__()
         self.exception = True
 
+class ServerDownHelper(MockHelper):
+    def work(self, context, ldapEntry, modified):
+        raise ldap.SERVER_DOWN, "Forced connection failure"
+
+# Change source returning no changes
+class ChangeSource(object):
+    cookie = None
+    position = None
+
+    def poll(self):
+        return []
+
 # Test Cases
 class ContextTestCase(unittest.TestCase):
     """ Test Splat Helper """
@@ -97,6 +114,8 @@ class ContextTestCase(unittest.TestCase):
         conn = ldapclient.Connection(slapd.SLAPD_URI)
         self.ctx = daemon.Context(conn)
         self.hc = plugin.HelperController('test', 'splat.test.test_daemon', 1, 'ou=People,dc=example,dc=com', '(uid=john)', False, None)
+        # The first Helper subclass found is ErrorHelper
+        self.hc.helperClass = MockHelper
 
         self.done = False
         self.failure = None
@@ -113,6 +132,30 @@ class ContextTestCase(unittest.TestCase):
     def test_addHelper(self):
         self.ctx.addHelper(self.hc)
 
+        # Helpers share the context's group cache
+        self.assert_(self.hc.groupCache is self.ctx.groupCache)
+
+    def test_addHelperSharedSearch(self):
+        hc = plugin.HelperController('shared', 'splat.test.test_daemon', 1, 'ou=People,dc=example,dc=com', '(uid=john)', False, None, sharedSearch=True)
+        other = plugin.HelperController('other', 'splat.test.test_daemon', 1, 'OU=People, dc=example,dc=com', '(uid=sally)', False, None, sharedSearch=True)
+        self.ctx.addHelper(hc)
+        self.ctx.addHelper(other)
+
+        # Helpers searching the same base share a snapshot
+        self.assertNotEqual(hc.searchSnapshot, None)
+        self.assert_(hc.searchSnapshot is other.searchSnapshot)
+
+        # Filters that can not be evaluated locally are rejected
+        hc = plugin.HelperController('extensible', 'splat.test.test_daemon', 1, 'ou=People,dc=example,dc=com', '(uid:dn:=john)', False, None, sharedSearch=True)
+        self.assertRaises(splat.SplatError, self.ctx.addHelper, hc)
+
+    def test_addHelperChangeSource(self):
+        self.ctx.addHelper(self.hc, daemon.CHANGE_SOURCE_SYNCREPL)
+        self.assertEquals(self.ctx.changeSources['test'], daemon.CHANGE_SOURCE_SYNCREPL)
+
+        # Unknown change sources are rejected
+        self.assertRaises(splat.SplatError, self.ctx.addHelper, self.hc, 'carrier pigeon')
+
     def test_removeHelper(self):
         # Remove an unstarted task
         self.ctx.addHelper(self.hc)
@@ -128,12 +171,12 @@ class ContextTestCase(unittest.TestCase):
         self.assertNotEqual(result, self.ctx)
 
     def _ebDaemonError(self, failure):
-        failure.trap(FakeException)
+        failure.trap(ldap.SERVER_DOWN)
 
     def test_daemonContextErrorHandling(self):
         self.ctx.addHelper(self.hc)
-        # Force a run error
-        self.hc.helperClass = ErrorHelper
+        # Force a connection error, which stops the context
+        self.hc.helperClass = ServerDownHelper
 
         d = self.ctx.start()
         d.addCallback(self._cbDaemonError)
@@ -141,6 +184,129 @@ class ContextTestCase(unittest.TestCase):
 
         return d
 
+    def _cbServiceFailure(self, result, other):
+        self.assertEquals(result, self.ctx)
+        # The failed service backed off, while the other kept running
+        failures, until = self.ctx.backoffs['test']
+        self.assertEquals(failures, 1)
+        self.assert_(not self.ctx.backoffs.has_key('other'))
+        self.assertNotEqual(other._lastRun, 0)
+
+    def test_serviceRetry(self):
+        self.ctx.clock = task.Clock()
+        self.ctx.addHelper(self.hc)
+        invoked = []
+        self.ctx._invokeHelper = invoked.append
+
+        # The failed service is run once its backoff expires
+        self.ctx._serviceFailed('test', failure.Failure(splat.SplatError("Forced failure")))
+        self.ctx.clock.advance(self.ctx.initialBackoff - 1)
+        self.assertEquals(invoked, [])
+        self.ctx.clock.advance(1)
+        self.assertEquals(invoked, ['test'])
+
+        # Unless the service is removed first
+        self.ctx._serviceFailed('test', failure.Failure(splat.SplatError("Forced failure")))
+        self.ctx.removeHelper('test')
+        self.ctx.clock.advance(self.ctx.maxBackoff)
+        self.assertEquals(invoked, ['test'])
+
+    def test_serviceFailure(self):
+        other = plugin.HelperController('other', 'splat.test.test_daemon', 1, 'ou=People,dc=example,dc=com', '(uid=john)', False, None)
+        other.helperClass = MockHelper
+        self.ctx.addHelper(self.hc)
+        self.ctx.addHelper(other)
+        # Force a run error, which only affects the failing service
+        self.hc.helperClass = ErrorHelper
+
+        d = self.ctx.start()
+        d.addCallback(self._cbServiceFailure, other)
+
+        # Stop once both helpers have run
+        reactor.callLater(2.5, self.ctx.stop)
+
+        return d
+
+    def _cbRestart(self, result):
+        # The context is re-used with a new connection
+        self.hc.helperClass = MockHelper
+        self.hc._lastRun = 42
+        conn = ldapclient.Connection(slapd.SLAPD_URI)
+        self.ctx.setConnection(conn)
+        self.assert_(self.ctx.ldapConnection is conn)
+
+        d = self.ctx.start()
+        d.addCallback(self._cbRestarted)
+
+        # The connection of a running context can not be replaced
+        self.assertRaises(splat.SplatError, self.ctx.setConnection, conn)
+        self.ctx.stop()
+        return d
+
+    def _cbRestarted(self, result):
+        self.assertEquals(result, self.ctx)
+        # Helper controller state was preserved
+        self.assert_(self.ctx.svc['test'] is self.hc)
+        self.assertEquals(self.hc._lastRun, 42)
+
+    def test_setConnection(self):
+        self.ctx.addHelper(self.hc)
+        # Force a connection error
+        self.hc.helperClass = ServerDownHelper
+
+        d = self.ctx.start()
+        d.addCallbacks(self._cbDaemonError, self._ebDaemonError)
+        d.addCallback(self._cbRestart)
+
+        return d
+
+    def _cbStateDir(self, result, stateDir):
+        self.assertEquals(result, self.ctx)
+        # The helper's progress was saved
+        checkpoint = self.hc.getCheckpoint()
+        self.assertNotEqual(checkpoint[1], 0)
+        self.assertEquals(daemon.readStateFile(os.path.join(stateDir, 'test.state')), '%s %d %d' % checkpoint)
+
+        # And is restored by a new context
+        hc = plugin.HelperController('test', 'splat.test.test_daemon', 1, 'ou=People,dc=example,dc=com', '(uid=john)', False, None)
+        hc.helperClass = MockHelper
+        ctx = daemon.Context(self.ctx.ldapConnection, stateDir=stateDir)
+        ctx.addHelper(hc)
+        self.assertEquals(hc.getCheckpoint(), checkpoint)
+
+    def test_stateDirSyncCookie(self):
+        stateDir = self.mktemp()
+        os.mkdir(stateDir)
+        ctx = daemon.Context(self.ctx.ldapConnection, stateDir=stateDir)
+        ctx.addHelper(self.hc, daemon.CHANGE_SOURCE_SYNCREPL)
+
+        # The cookie is saved once the entries sent before it are handled
+        ctx._cbPollSync(None, 'test', 'rid=000,csn=20090101000000.000000Z#000000#000#000000')
+        checkpoint = self.hc.getCheckpoint()
+        value = daemon.readStateFile(os.path.join(stateDir, 'test.state'))
+        self.assert_(value.startswith('%s %d %d ' % checkpoint))
+
+        # And a new context resumes content synchronization from it
+        hc = plugin.HelperController('test', 'splat.test.test_daemon', 1, 'ou=People,dc=example,dc=com', '(uid=john)', False, None)
+        hc.helperClass = MockHelper
+        ctx = daemon.Context(self.ctx.ldapConnection, stateDir=stateDir)
+        ctx.addHelper(hc, daemon.CHANGE_SOURCE_SYNCREPL)
+        self.assertEquals(ctx.syncCookies['test'], 'rid=000,csn=20090101000000.000000Z#000000#000#000000')
+        self.assertEquals(hc.getCheckpoint(), checkpoint)
+
+    def test_stateDir(self):
+        stateDir = self.mktemp()
+        os.mkdir(stateDir)
+        self.ctx = daemon.Context(self.ctx.ldapConnection, stateDir=stateDir)
+        self.ctx.addHelper(self.hc)
+        d = self.ctx.start()
+        d.addCallback(self._cbStateDir, stateDir)
+
+        # Stop once the helper has run
+        reactor.callLater(1.5, self.ctx.stop)
+
+        return d
+
     def test_start(self):
         self.ctx.addHelper(self.hc)
         d = self.ctx.start()
@@ -167,3 +333,184 @@ class ContextTestCase(unittest.TestCase):
         self.ctx.stop()
 
         return d
+
+    def _cbWorkersResult(self, result, ctx):
+        self.assertEquals(result, ctx)
+        # The helper was run, and completed, before the context stopped
+        self.assertNotEqual(self.hc._lastRun, 0)
+        self.assertEquals(ctx.queues['test'], [])
+
+    def test_workers(self):
+        ctx = daemon.Context(self.ctx.ldapConnection, workers=2)
+        ctx.addHelper(self.hc)
+        d = ctx.start()
+        d.addCallback(self._cbWorkersResult, ctx)
+
+        # Stop once the helper has been started
+        reactor.callLater(1.5, ctx.stop)
+
+        return d
+
+    def _deferToThread(self, f, *args):
+        self.threaded.append(f)
+        return defer.maybeDeferred(f, *args)
+
+    def test_workersPoll(self):
+        # With workers, change sources are read in the thread pool
+        self.threaded = []
+        self.patch(daemon.threads, 'deferToThread', self._deferToThread)
+        ctx = daemon.Context(self.ctx.ldapConnection, workers=2)
+        ctx.addHelper(self.hc, daemon.CHANGE_SOURCE_SYNCREPL)
+
+        consumer = ChangeSource()
+        ctx.syncConsumers['test'] = consumer
+        ctx._pollSync()
+        self.assertEquals(self.threaded, [consumer.poll])
+
+        changeLog = ChangeSource()
+        ctx.changeLog = changeLog
+        ctx.changeLogConfig = ('cn=accesslog', ldapclient.CHANGELOG_ACCESSLOG, None, 1)
+        d = ctx._pollChangeLog()
+        self.assertEquals(self.threaded, [consumer.poll, changeLog.poll])
+        return d
+
+    def test_nonBlockingShards(self):
+        ctx = daemon.Context(ldapclient.TwistedConnection(slapd.SLAPD_URI, 2))
+        hc = plugin.HelperController('sharded', 'splat.test.test_daemon', 1, 'ou=People,dc=example,dc=com', '(uid=john)', False, None, shards=2)
+        self.assertRaises(splat.SplatError, ctx.addHelper, hc)
+
+    def test_workersShards(self):
+        ctx = daemon.Context(self.ctx.ldapConnection, workers=2)
+        hc = plugin.HelperController('sharded', 'splat.test.test_daemon', 1, 'ou=People,dc=example,dc=com', '(uid=john)', False, None, shards=2)
+        self.assertRaises(splat.SplatError, ctx.addHelper, hc)
+
+    def test_nonBlocking(self):
+        conn = ldapclient.TwistedConnection(slapd.SLAPD_URI, 2)
+        conn.simple_bind('', '')
+        ctx = daemon.Context(conn)
+        ctx.addHelper(self.hc)
+        d = ctx.start()
+        d.addCallback(self._cbWorkersResult, ctx)
+
+        # Stop once the helper has been started
+        reactor.callLater(1.5, ctx.stop)
+
+        return d
+
+
+class ServiceTimerTestCase(unittest.TestCase):
+    """ Test Service Timers """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.runs = []
+        # Duration of each run
+        self.duration = 0
+
+    def _tick(self):
+        self.runs.append(self.clock.seconds())
+        if (self.duration):
+            d = defer.Deferred()
+            self.clock.callLater(self.duration, d.callback, None)
+            return d
+
+    def _newTimer(self, interval, minIdle=0, adaptive=False, phase=None, jitter=0):
+        timer = daemon.ServiceTimer('test', self._tick, interval, minIdle, adaptive, phase, jitter)
+        timer.clock = self.clock
+        return timer
+
+    def test_interval(self):
+        timer = self._newTimer(10)
+        timer.start(False)
+        self.clock.pump([5, 5, 10, 10])
+        self.assertEquals(self.runs, [10, 20, 30])
+        timer.stop()
+        self.clock.pump([10, 10])
+        self.assertEquals(len(self.runs), 3)
+
+    def test_runOnce(self):
+        timer = self._newTimer(0)
+        timer.start()
+        self.clock.pump([0, 10, 10])
+        self.assertEquals(self.runs, [0])
+        self.assert_(not timer.running)
+
+    def test_overrun(self):
+        # Runs take 25 seconds, overrunning a 10 second interval. Missed
+        # ticks are coalesced.
+        self.duration = 25
+        timer = self._newTimer(10)
+        timer.start()
+        self.clock.pump([0] + [5] * 12)
+        self.assertEquals(self.runs, [0, 30, 60])
+        self.assertEquals(timer.overruns, 2)
+        self.assertEquals(timer.skipped, 4)
+        self.assertEquals(timer.maxDuration, 25)
+
+    def test_minIdle(self):
+        # Runs finishing 2 seconds before the next tick skip it
+        self.duration = 8
+        timer = self._newTimer(10, minIdle=5)
+        timer.start()
+        self.clock.pump([0] + [1] * 40)
+        self.assertEquals(self.runs, [0, 20, 40])
+        self.assertEquals(timer.overruns, 0)
+
+    def test_adaptive(self):
+        self.duration = 6
+        timer = self._newTimer(10, adaptive=True)
+        timer.start()
+        self.clock.pump([0] + [1] * 6)
+        self.assertEquals(timer.interval, 20)
+
+        # Cheap runs shrink the interval back
+        self.duration = 0
+        self.clock.pump([1] * 60)
+        self.assertEquals(timer.interval, 10)
+
+
+    def test_phase(self):
+        # Runs are aligned to the phase, regardless of the start time
+        self.clock.advance(15)
+        timer = self._newTimer(10, phase=3)
+        timer.start(False)
+        self.clock.pump([1] * 20)
+        self.assertEquals(self.runs, [23, 33])
+
+    def test_jitter(self):
+        timer = self._newTimer(10, jitter=2)
+        timer.start(False)
+        self.clock.pump([0.5] * 70)
+        self.assertEquals(len(self.runs), 3)
+        # Jitter does not accumulate
+        for i in range(len(self.runs)):
+            self.assert_(self.runs[i] >= (i + 1) * 10 and self.runs[i] <= (i + 1) * 10 + 2)
+
+    def test_phaseOffset(self):
+        offset = daemon.phaseOffset('test', 600, 'host1.example.com')
+        self.assertEquals(offset, daemon.phaseOffset('test', 600, 'host1.example.com'))
+        self.assert_(offset >= 0 and offset < 600)
+
+        # Offsets differ between hosts
+        offsets = [daemon.phaseOffset('test', 600, 'host%d.example.com' % i) for i in range(10)]
+        self.assert_(len(set(offsets)) > 1)
+
+        self.assertEquals(daemon.phaseOffset('test', 0), 0)
+
+
+class StateFileTestCase(unittest.TestCase):
+    """ Test State Files """
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def test_readWrite(self):
+        # Missing state files read as None
+        self.assertEquals(daemon.readStateFile(self.path), None)
+
+        daemon.writeStateFile(self.path, '20081104133357.000001Z')
+        self.assertEquals(daemon.readStateFile(self.path), '20081104133357.000001Z')
+
+        # Rewrite the state, and make sure no temporary file is left behind
+        daemon.writeStateFile(self.path, '42')
+        self.assertEquals(daemon.readStateFile(self.path), '42')
+        self.assert_(not os.path.exists(self.path + '.tmp'))
+
@@ -36,7 +36,9 @@
 """ LDAP Unit Tests """
 
 from twisted.trial import unittest
+from twisted.internet import defer, task
 
+import splat
 from splat import plugin
 
 from splat.ldaputils import client as ldapclient
@@ -54,6 +56,7 @@ class MockHelper(plugin.Helper):
     success = None
     context = None
     modified = None
+    shardable = True
 
     def __init__(self):
         MockHelper.success = False
@@ -194,3 +197,323 @@ class HelperWithControllerTestCase(unittest.TestCase):
         # Try again, making sure the entry isn't modified this time
         self.hc.work(self.conn)
         self.assertEquals(MockHelper.modified, False)
+
+    def test_incremental(self):
+        self.hc.incremental = True
+        self.hc.fullResync = 0
+        time.sleep(1)
+
+        # The first run always considers every entry
+        self.hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.modified, True)
+
+        # The unmodified entry should not be returned by the server
+        self.hc.work(self.conn)
+        self.assertEquals(MockHelper.success, False)
+
+        # Up the modTimestamp
+        self.conn.simple_bind(slapd.ROOTDN, slapd.ROOTPW)
+        entry = self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(uid=john)', None)[0]
+        mod = ldapclient.Modification(entry.dn)
+        mod.replace('description', 'Up the date')
+        self.conn.modify(mod)
+
+        self.hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.modified, True)
+
+    def test_fullResync(self):
+        self.hc.incremental = True
+        self.hc.fullResync = 1
+        time.sleep(1)
+        self.hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+
+        # Once the resync interval has elapsed, unmodified entries are
+        # requested again.
+        time.sleep(1)
+        self.hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.modified, False)
+
+    def test_checkpoint(self):
+        time.sleep(1)
+        self.hc.work(self.conn)
+        checkpoint = self.hc.getCheckpoint()
+        self.assertNotEqual(checkpoint[1], 0)
+
+        # A new controller with the same configuration resumes from the
+        # checkpoint, and does not consider the entry modified
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(uid=john)', False, {'test':'value'})
+        self.assertEquals(hc.restoreCheckpoint(checkpoint), True)
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.modified, False)
+
+        # Checkpoints do not survive configuration changes
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(uid=john)', False, {'test':'other'})
+        self.assertEquals(hc.restoreCheckpoint(checkpoint), False)
+
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(uid=john)', False, {'test':'value'})
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=developers))', 'uniqueMember')
+        hc.addGroup(filter)
+        self.assertEquals(hc.restoreCheckpoint(checkpoint), False)
+
+    def test_workIter(self):
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(uid=john)', False, {'test':'value'}, chunkSize=1)
+
+        # One chunk is yielded per entry, and the helper is finished after
+        # the last chunk
+        chunks = list(hc.workIter(self.conn))
+        self.assertEquals(len(chunks), 1)
+        self.assertEquals(MockHelper.success, True)
+        self.assertNotEqual(hc._lastRun, 0)
+
+        # Chunk processing times are recorded, including finish()
+        self.assertEquals(hc.chunkCount, 2)
+        self.assert_(hc.maxChunkTime >= hc.lastChunkTime)
+
+    def _cbNonBlocking(self, result, hc, dns, expected):
+        dns.sort()
+        self.assertEquals(dns, expected)
+        self.assertNotEqual(hc._lastRun, 0)
+
+    def test_nonBlocking(self):
+        dns = []
+        class CollectingHelper(MockHelper):
+            def work(self, context, ldapEntry, modified):
+                dns.append(ldapEntry.dn)
+
+        conn = ldapclient.TwistedConnection(slapd.SLAPD_URI, 1)
+        conn.simple_bind('', '')
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(objectClass=posixAccount)', False, {'test':'value'})
+        hc.helperClass = CollectingHelper
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=developers))', 'uniqueMember')
+        hc.addGroup(filter, {'test':'value', 'group':'developers'})
+
+        # Every entry of a multi-page result is handed to the helper
+        expected = [entry.dn for entry in self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(objectClass=posixAccount)', ['dn'])]
+        expected.sort()
+        self.assert_(len(expected) > 1)
+        d = task.cooperate(hc.workIter(conn)).whenDone()
+        d.addCallback(self._cbNonBlocking, hc, dns, expected)
+        return d
+
+    def test_asyncHelper(self):
+        results = []
+        class AsyncMockHelper(plugin.AsyncHelper):
+            def work(self, context, ldapEntry, modified):
+                d = defer.Deferred()
+                results.append(d)
+                return d
+
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(objectClass=sshAccount)', False, {'test':'value'}, inFlight=1)
+        hc.helperClass = AsyncMockHelper
+        hc.asynchronous = True
+
+        # The in-flight limit is reached with the first entry
+        iterator = hc.workIter(self.conn)
+        d = iterator.next()
+        self.assertEquals(len(results), 1)
+        self.assert_(not d.called)
+        results[0].callback(None)
+        self.assert_(d.called)
+
+        # Fail the remaining entries
+        for d in iterator:
+            results[-1].errback(splat.SplatError("Forced failure"))
+        self.assert_(len(results) > 1)
+        self.assertEquals(hc._lastRun, 0)
+
+        # Asynchronous helpers can not be run synchronously
+        self.assertRaises(plugin.SplatPluginError, hc.work, self.conn)
+
+    def test_shards(self):
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(uid=john)', False, {'test':'value'}, shards=2)
+
+        # Entries are handled in forked processes; a successful run updates
+        # the last run time
+        hc.work(self.conn)
+        self.assertNotEqual(hc._lastRun, 0)
+
+        # The run fails if any shard fails. MockHelper only accepts john.
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(objectClass=sshAccount)', False, {'test':'value'}, shards=2)
+        hc.work(self.conn)
+        self.assertEquals(hc._lastRun, 0)
+
+    def test_shardable(self):
+        # Helpers that aggregate entries in finish() can not be sharded
+        self.assertRaises(plugin.SplatPluginError, plugin.HelperController, 'test', 'splat.helpers.opennms', 5, 'dc=example,dc=com', '(uid=john)', False, {}, shards=2)
+
+    def test_retry(self):
+        class FailingHelper(MockHelper):
+            fail = True
+            def work(self, context, ldapEntry, modified):
+                MockHelper.modified = modified
+                if (FailingHelper.fail):
+                    raise splat.SplatError, "Forced failure"
+                MockHelper.success = True
+
+        # Retry failed entries immediately
+        self.patch(plugin.HelperController, 'retryDelay', 0)
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(uid=john)', False, {'test':'value'}, incremental=True)
+        hc.helperClass = FailingHelper
+        time.sleep(1)
+
+        # A failed entry does not prevent the last run time from advancing
+        hc.work(self.conn)
+        self.assertNotEqual(hc._lastRun, 0)
+        self.assert_('uid=john,ou=People,dc=example,dc=com' in hc.retries)
+
+        # The unmodified entry is fetched again, and considered modified
+        FailingHelper.fail = False
+        time.sleep(1)
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.modified, True)
+        self.assertEquals(len(hc.retries), 0)
+
+    def test_retryFullRun(self):
+        class FailingHelper(MockHelper):
+            fail = True
+            def work(self, context, ldapEntry, modified):
+                MockHelper.modified = modified
+                MockHelper.success = True
+                if (FailingHelper.fail):
+                    raise splat.SplatError, "Forced failure"
+
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(uid=john)', False, {'test':'value'})
+        hc.helperClass = FailingHelper
+        hc.work(self.conn)
+        nextRetry = hc.retries.nextRetry('uid=john,ou=People,dc=example,dc=com')
+
+        # Full runs still pass entries that are not yet due to be retried
+        # to the helper, as unmodified, leaving the retry scheduled
+        FailingHelper.fail = False
+        MockHelper.success = False
+        time.sleep(1)
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.modified, False)
+        self.assertEquals(hc.retries.nextRetry('uid=john,ou=People,dc=example,dc=com'), nextRetry)
+
+    def test_memberOf(self):
+        # memberOf is only maintained by the server when groups are modified,
+        # so add the user to a group.
+        self.conn.simple_bind(slapd.ROOTDN, slapd.ROOTPW)
+        entry = self.conn.search(slapd.BASEDN, ldap.SCOPE_SUBTREE, 'cn=administrators', None)[0]
+        mod = ldapclient.Modification(entry.dn)
+        mod.add('uniqueMember', 'uid=john,ou=People,dc=example,dc=com')
+        self.conn.modify(mod)
+
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(uid=john)', True, {'test':'value'}, memberOf=True)
+        self.assert_('memberOf' in hc.searchAttr)
+
+        # Add a group that will not match
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=nobody))', 'uniqueMember')
+        hc.addGroup(filter, {'test':'value', 'group':'nobody'})
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, False)
+
+        # Add a group that will match
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))', 'uniqueMember')
+        hc.addGroup(filter, {'test':'value', 'group':'administrators'})
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.context['group'], 'administrators')
+
+    def test_twoPhase(self):
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(uid=john)', True, {'test':'value'}, fullResync=0, twoPhase=True)
+        self.assert_('entryCSN' in hc.searchAttr)
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=developers))', 'uniqueMember')
+        hc.addGroup(filter, {'test':'value', 'group':'developers'})
+        filter = ldapclient.GroupFilter(slapd.BASEDN, ldap.SCOPE_SUBTREE, '(&(objectClass=groupOfUniqueNames)(cn=administrators))', 'uniqueMember')
+        hc.addGroup(filter, {'test':'value', 'group':'administrators'})
+        time.sleep(1)
+
+        # The first run always considers every entry
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.modified, True)
+
+        # The unmodified entry is scanned, but not fetched
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, False)
+        self.assert_(hc._stamps.has_key('uid=john,ou=people,dc=example,dc=com'))
+
+        # Modified entries are fetched
+        self.conn.simple_bind(slapd.ROOTDN, slapd.ROOTPW)
+        mod = ldapclient.Modification('uid=john,ou=People,dc=example,dc=com')
+        mod.replace('description', 'Up the date')
+        self.conn.modify(mod)
+        # The modification must be older than the next run
+        time.sleep(1)
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.modified, True)
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, False)
+
+        # As are entries added to a modified group
+        mod = ldapclient.Modification('cn=administrators,ou=Groups,dc=example,dc=com')
+        mod.add('uniqueMember', 'uid=john,ou=People,dc=example,dc=com')
+        self.conn.modify(mod)
+        time.sleep(1)
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.context['group'], 'developers')
+
+    def test_twoPhaseStamp(self):
+        hc = plugin.HelperController('test', 'splat.test.test_plugin', 5, 'dc=example,dc=com', '(uid=john)', False, {'test':'value'}, fullResync=0, twoPhase=True)
+        time.sleep(1)
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+
+        # Entries whose stamp alone has changed, such as those whose
+        # memberOf values were updated by the server, are fetched and
+        # considered modified
+        hc._stamps['uid=john,ou=people,dc=example,dc=com'] = ('0',)
+        MockHelper.success = False
+        hc.work(self.conn)
+        self.assertEquals(MockHelper.success, True)
+        self.assertEquals(MockHelper.modified, True)
+
+class RetrySetTestCase(unittest.TestCase):
+    """ Test Failed Entry Retries """
+    def setUp(self):
+        self.retries = plugin.RetrySet(60, 200)
+        self.dn = 'uid=john,ou=People,dc=example,dc=com'
+
+    def test_backoff(self):
+        self.retries.failed(self.dn, 100, 42)
+        self.assert_('UID=john, ou=People,dc=example,dc=com' in self.retries)
+        self.assertEquals(self.retries.nextRetry(self.dn), 160)
+        self.assertEquals(self.retries.due(159), [])
+        self.assertEquals(self.retries.due(160), [self.dn])
+
+        # The delay doubles with each failure, up to the maximum
+        self.retries.failed(self.dn, 160, 150)
+        self.assertEquals(self.retries.nextRetry(self.dn), 280)
+        self.retries.failed(self.dn, 280, 270)
+        self.assertEquals(self.retries.nextRetry(self.dn), 480)
+
+        # The last run time of the first failure is kept
+        self.assertEquals(self.retries.lastRun(), 42)
+
+        self.retries.succeeded(self.dn)
+        self.assertEquals(len(self.retries), 0)
+        self.assertEquals(self.retries.lastRun(), None)
+
+    def test_isDue(self):
+        entry = ldapclient.Entry(self.dn, {'modifyTimestamp': ['19700101000050Z']})
+        self.assert_(self.retries.isDue(entry, 0))
+
+        self.retries.failed(self.dn, 100, 0)
+        self.assert_(not self.retries.isDue(entry, 150))
+        self.assert_(self.retries.isDue(entry, 160))
+
+        # Entries modified since they failed are due immediately
+        self.retries.failed(self.dn, 100, 0)
+        entry = ldapclient.Entry(self.dn, {'modifyTimestamp': ['19700101000200Z']})
+        self.assert_(self.retries.isDue(entry, 150))